@@ -64,11 +64,46 @@ import shutil
 import threading
 import traceback
 import re
+import hashlib
+import tempfile
+import Queue
+import multiprocessing
+import select
+import fcntl
+import errno
+import zlib
+import atexit
+import stat
 from contextlib import contextmanager
 
+from bein import fastcopy
+
 
 # miscellaneous types
 
+class _OutputFile(object):
+    """Output of a program too long to keep in memory.
+
+    The output is in the temporary file *path*, which is removed when
+    the object is garbage collected.
+    """
+    __slots__ = ['path']
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """Return the whole output as a string."""
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def __del__(self):
+        try:
+            os.remove(self.path)
+        except Exception:
+            pass
+
+
 class ProgramOutput(object):
     """Object passed to return_value functions when binding programs.
 
@@ -76,7 +111,16 @@ class ProgramOutput(object):
     finished to create a return value from their output.  The output
     is passed as a ``ProgramObject``, containing all the information
     available to bein about that program.
+
+    *stdout* and *stderr* are lists of lines, strings, or ``None`` if
+    the stream was not captured.  Each is kept as a single string, or
+    in a temporary file if it was too long to keep in memory, and the
+    ``stdout`` and ``stderr`` attributes split it into a list of lines
+    each time they are read.  ``stdout_bytes`` and ``stderr_bytes``
+    give it as one string.
     """
+    __slots__ = ['return_code', 'pid', 'arguments', '_stdout', '_stderr']
+
     def __init__(self, return_code, pid, arguments, stdout, stderr):
         self.return_code = return_code
         self.pid = pid
@@ -84,6 +128,111 @@ class ProgramOutput(object):
         self.stdout = stdout
         self.stderr = stderr
 
+    @staticmethod
+    def _compact(value):
+        if isinstance(value, list):
+            return ''.join(value)
+        else:
+            return value
+
+    @staticmethod
+    def _bytes(value):
+        if isinstance(value, _OutputFile):
+            return value.read()
+        else:
+            return value
+
+    @staticmethod
+    def _lines(value):
+        if value == None:
+            return None
+        else:
+            return ProgramOutput._bytes(value).splitlines(True)
+
+    def _set_stdout(self, value):
+        self._stdout = self._compact(value)
+
+    def _set_stderr(self, value):
+        self._stderr = self._compact(value)
+
+    stdout = property(lambda self: self._lines(self._stdout), _set_stdout)
+    stderr = property(lambda self: self._lines(self._stderr), _set_stderr)
+    stdout_bytes = property(lambda self: self._bytes(self._stdout))
+    stderr_bytes = property(lambda self: self._bytes(self._stderr))
+
+    def __getstate__(self):
+        return (self.return_code, self.pid, self.arguments,
+                self.stdout_bytes, self.stderr_bytes)
+
+    def __setstate__(self, state):
+        (self.return_code, self.pid, self.arguments,
+         self._stdout, self._stderr) = state
+
+
+class Future(object):
+    """The value of a computation which is still running.
+
+    ``wait()`` blocks until the computation has finished, then returns
+    its value, or raises the exception it failed with.  ``done()``
+    tells whether it has finished without blocking.
+    """
+    def __init__(self):
+        self.return_value = None
+        self.exception = None
+        self._finished = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """Return ``True`` if the computation has finished."""
+        return self._finished.is_set()
+
+    def wait(self):
+        """Block until the computation finishes and return its value."""
+        self._finished.wait()
+        if self.exception != None:
+            raise self.exception
+        else:
+            return self.return_value
+
+    def add_done_callback(self, callback):
+        """Call *callback* with this Future once it has finished."""
+        with self._lock:
+            if not(self.done()):
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, return_value=None, exception=None):
+        with self._lock:
+            self.return_value = return_value
+            self.exception = exception
+            self._finished.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for c in callbacks:
+            c(self)
+
+
+def gather(futures):
+    """Wait for all of *futures* and return a list of their values.
+
+    The values are in the same order as *futures*.
+    """
+    return [f.wait() for f in futures]
+
+def as_completed(futures):
+    """Iterate over *futures* in the order in which they finish.
+
+    *futures* must be ``Future`` objects, such as those returned by
+    ``run_async``.
+    """
+    finished = Queue.Queue()
+    for f in futures:
+        f.add_done_callback(finished.put)
+    for i in range(len(futures)):
+        yield finished.get()
+
 
 class ProgramFailed(Exception):
     """Thrown when a program bound by ``@program`` exits with a value other than 0."""
@@ -102,16 +251,540 @@ def unique_filename_in(path=None):
     """
     if path == None:
         path = os.getcwd()
-    def random_string():
-        return "".join([random.choice(string.letters + string.digits) 
-                        for x in range(20)])
     while True:
-        filename = random_string()
+        filename = _random_filename()
         files = [f for f in os.listdir(path) if f.startswith(filename)]
         if files == []:
             break
     return filename
 
+def _random_filename():
+    return "".join([random.choice(string.letters + string.digits) 
+                    for x in range(20)])
+
+def _reserve_filename_in(path, location=None):
+    """Create an empty file with a random, unused name in *path*.
+
+    Returns the name of the file, which the caller can then replace
+    with the real contents.  Unlike ``unique_filename_in``, *path* is
+    never listed, so this takes the same time however many files
+    *path* holds.  The name is reserved atomically by creating the
+    file exclusively, so concurrent callers never get the same name.
+    It does not check that no file has the name as a prefix.  That
+    check is only needed when random names are mixed with other names
+    built from them, as happens in working directories.
+
+    If *location* is given, it is a function which takes a filename
+    and returns the path where the file of that name belongs, for
+    directories which are split into subdirectories.
+    """
+    while True:
+        filename = _random_filename()
+        if location == None:
+            file_path = os.path.join(path, filename)
+        else:
+            file_path = location(filename)
+            _make_parent_directory(file_path)
+        try:
+            fd = os.open(file_path,
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError, ose:
+            if ose.errno == errno.EEXIST:
+                continue
+            raise
+        os.close(fd)
+        return filename
+
+def _make_parent_directory(path):
+    """Create the directory containing *path* if it does not exist."""
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError, ose:
+        if ose.errno != errno.EEXIST:
+            raise
+
+def _move_file(src, dst):
+    """Rename *src* to *dst* if possible, and return whether it was moved.
+
+    Only regular files with no other hard links are moved, so a file
+    linked from elsewhere is never taken away from it.  If *src* and
+    *dst* are on different filesystems, nothing is done.
+    """
+    st = os.lstat(src)
+    if not(stat.S_ISREG(st.st_mode)) or st.st_nlink != 1:
+        return False
+    try:
+        os.rename(src, dst)
+        return True
+    except OSError, ose:
+        if ose.errno == errno.EXDEV:
+            return False
+        raise
+
+_write_bits = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+def _make_read_only(path):
+    """Remove all write permissions from the file *path*."""
+    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) & ~_write_bits)
+
+def _is_read_only(path):
+    """Return whether no one has write permission on the file *path*."""
+    return os.stat(path).st_mode & _write_bits == 0
+
+def _export_copy(src, dst):
+    """Copy *src* out of a repository to *dst* and make it writable by its owner."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    fastcopy.copy(src, dst)
+    os.chmod(dst, stat.S_IMODE(os.stat(dst).st_mode) | stat.S_IWUSR)
+
+def _content_hash(filename):
+    """Return the SHA1 hex digest of the contents of *filename*."""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(1024*1024)
+            if not(block):
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def _stage_file(src, dst, staging='copy', writable=False):
+    """Put the contents of the file *src* at *dst*.
+
+    With *staging* set to ``'copy'``, *dst* is a plain copy.  With
+    ``'link'``, no data is copied if possible: *dst* is a hard link to
+    *src*, or failing that a reflink, or failing that a symbolic link.
+    Since writing to a hard or symbolic link would change *src*, they
+    are only made if *src* is read-only, and a reflink or copy is
+    made read-only in their place.  If *writable* is true, *dst* must
+    be independent of *src*, so only a reflink or, failing that, a
+    copy is made, and it is left writable.
+    """
+    if staging == 'copy':
+        fastcopy.copyfile(src, dst)
+    elif staging == 'link':
+        shared = not(writable) and _is_read_only(src)
+        if shared:
+            try:
+                os.link(src, dst)
+                return
+            except OSError, ose:
+                pass
+        try:
+            fastcopy.reflink(src, dst)
+        except (IOError, OSError), e:
+            if shared:
+                os.symlink(os.path.abspath(src), dst)
+                return
+            fastcopy.copyfile(src, dst)
+        if not(writable):
+            _make_read_only(dst)
+    else:
+        raise ValueError("Unknown staging mode %s; must be 'copy' or 'link'." % staging)
+
+
+class _StreamCapture(object):
+    """Collects one output stream of a running program.
+
+    The stream is read as it is produced, so the program never blocks
+    on a full pipe.  Up to *spool_size* bytes are kept in memory, and
+    if the stream is longer it all goes to a temporary file.  If
+    *limit* is not ``None``, only the first and last *limit* bytes
+    are retained when the stream is finished.  If *callback* is
+    given, it is called with each line of the stream as it arrives.
+    """
+    def __init__(self, limit=None, callback=None, spool_size=1024*1024):
+        self.limit = limit
+        self.callback = callback
+        self.spool_size = spool_size
+        self.chunks = []
+        self.size = 0
+        self.spool = None
+        self.spool_file = None
+        self.partial_line = ''
+        self.thread = None
+        self.error = None
+
+    def feed(self, data):
+        """Add *data* read from the stream."""
+        if self.spool == None and self.size + len(data) > self.spool_size:
+            (fd, path) = tempfile.mkstemp(prefix='bein_output_')
+            self.spool = _OutputFile(path)
+            self.spool_file = os.fdopen(fd, 'wb')
+            self.spool_file.write(''.join(self.chunks))
+            self.chunks = []
+        if self.spool == None:
+            self.chunks.append(data)
+        else:
+            self.spool_file.write(data)
+        self.size += len(data)
+        if self.callback != None:
+            lines = (self.partial_line + data).split('\n')
+            self.partial_line = lines.pop()
+            for l in lines:
+                self.callback(l + '\n')
+
+    def close(self):
+        """Mark the end of the stream."""
+        if self.callback != None and self.partial_line != '':
+            self.callback(self.partial_line)
+        self.partial_line = ''
+
+    def safe_feed(self, data):
+        """Like :meth:`feed`, but record an exception instead of raising it.
+
+        Once capturing the stream has failed, such as when the
+        callback raises an exception, the rest of the stream is
+        thrown away, and :meth:`output` raises the exception.  The
+        stream must still be read to its end, so the program does not
+        block on a full pipe.
+        """
+        if self.error == None:
+            try:
+                self.feed(data)
+            except Exception:
+                self.error = sys.exc_info()
+
+    def safe_close(self):
+        """Like :meth:`close`, but record an exception instead of raising it."""
+        if self.error == None:
+            try:
+                self.close()
+            except Exception:
+                self.error = sys.exc_info()
+
+    def read(self, stream):
+        """Read the file object *stream* to its end in this thread."""
+        fd = stream.fileno()
+        while True:
+            data = os.read(fd, 65536)
+            if not(data):
+                break
+            self.safe_feed(data)
+        stream.close()
+        self.safe_close()
+
+    def drain(self, stream):
+        """Read the file object *stream* to its end in a separate thread."""
+        self.thread = threading.Thread(target=self.read, args=(stream,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def output(self):
+        """Wait for the end of the stream and return it for a ProgramOutput.
+
+        The stream is returned as a string, or as an _OutputFile if it
+        was spooled to disk and is not cut down by *limit*.
+        """
+        if self.thread != None:
+            self.thread.join()
+        if self.spool_file != None:
+            self.spool_file.close()
+        if self.error != None:
+            raise self.error[0], self.error[1], self.error[2]
+        if self.limit == None or self.size <= 2*self.limit:
+            if self.spool == None:
+                return ''.join(self.chunks)
+            else:
+                return self.spool
+        if self.spool == None:
+            data = ''.join(self.chunks)
+            head = data[:self.limit]
+            tail = data[self.size - self.limit:]
+        else:
+            with open(self.spool.path, 'rb') as f:
+                head = f.read(self.limit)
+                f.seek(self.size - self.limit)
+                tail = f.read(self.limit)
+        if not(head.endswith('\n')):
+            head += '\n'
+        return head + "[... %d bytes omitted ...]\n" % (self.size - 2*self.limit) + tail
+
+
+class _WorkerPool(object):
+    """A bounded set of threads running jobs from a queue.
+
+    Jobs are functions of no arguments, and are run in the order they
+    were submitted by at most *size* threads at a time.  Threads are
+    started as jobs arrive, and exit after :meth:`shutdown` once the
+    queue is empty.  Jobs are responsible for handling their own
+    exceptions.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.jobs = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, job):
+        """Queue *job* to be run by one of the threads."""
+        with self.lock:
+            self.jobs.put(job)
+            if len(self.threads) < self.size:
+                t = threading.Thread(target=self._work)
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job == None:
+                break
+            try:
+                job()
+            except:
+                traceback.print_exc()
+
+    def shutdown(self):
+        """Let the threads exit once all queued jobs have run."""
+        with self.lock:
+            for t in self.threads:
+                self.jobs.put(None)
+            self.threads = []
+
+
+class _EventLoop(object):
+    """Runs any number of programs from a single thread.
+
+    Each program is registered with its running ``subprocess.Popen``,
+    the ``_StreamCapture`` for each of its piped output streams, and a
+    function to call with its return code once it has exited.  One
+    thread polls all the pipes, feeds the captures, and reaps the
+    programs.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.streams = {}
+        self.running = []
+        self.poller = select.poll()
+        (self.wakeup_read, self.wakeup_write) = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self.poller.register(self.wakeup_read, select.POLLIN)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, sp, captures, on_exit):
+        """Watch *sp*, whose piped streams are the keys of *captures*."""
+        with self.lock:
+            self.pending.append((sp, captures, on_exit))
+        os.write(self.wakeup_write, 'x')
+
+    def _run(self):
+        while True:
+            with self.lock:
+                pending = self.pending
+                self.pending = []
+            for (sp, captures, on_exit) in pending:
+                job = [sp, len(captures), on_exit]
+                for (stream, capture) in captures.iteritems():
+                    self.streams[stream.fileno()] = (stream, capture, job)
+                    self.poller.register(stream.fileno(), select.POLLIN)
+                self.running.append(job)
+
+            # Programs whose streams are all closed have to be polled
+            # until they exit, so don't block indefinitely while there
+            # are any.
+            if [j for j in self.running if j[1] == 0] != []:
+                timeout = 50
+            else:
+                timeout = None
+            for (fd, event) in self.poller.poll(timeout):
+                if fd == self.wakeup_read:
+                    os.read(fd, 4096)
+                    continue
+                # A failing capture only fails its own program, when
+                # its on_exit function collects the output.
+                (stream, capture, job) = self.streams[fd]
+                data = os.read(fd, 65536)
+                if data:
+                    capture.safe_feed(data)
+                else:
+                    self.poller.unregister(fd)
+                    del self.streams[fd]
+                    stream.close()
+                    capture.safe_close()
+                    job[1] -= 1
+
+            still_running = []
+            for job in self.running:
+                if job[1] == 0 and job[0].poll() != None:
+                    try:
+                        job[2](job[0].returncode)
+                    except:
+                        traceback.print_exc()
+                else:
+                    still_running.append(job)
+            self.running = still_running
+
+_event_loop_instance = None
+_event_loop_lock = threading.Lock()
+
+def _event_loop():
+    """Return the process's _EventLoop, starting it if necessary."""
+    global _event_loop_instance
+    with _event_loop_lock:
+        if _event_loop_instance == None:
+            _event_loop_instance = _EventLoop()
+        return _event_loop_instance
+
+
+def _wait_for_file(path, timeout=600):
+    """Block until *path* exists, checking less and less often.
+
+    Output files of batch jobs can take a while to show up on network
+    filesystems.  Raises IOError if *path* still does not exist after
+    *timeout* seconds.
+    """
+    delay = 0.05
+    waited = 0
+    while not(os.path.exists(path)):
+        if waited >= timeout:
+            raise IOError("File %s did not appear after %d seconds." % (path, timeout))
+        time.sleep(delay)
+        waited += delay
+        delay = min(delay*2, 5)
+
+
+class _LSFMonitor(object):
+    """Tracks all submitted LSF jobs from a single thread.
+
+    Jobs are submitted with ``bsub`` without ``-K``, so submission
+    returns at once.  The thread queries the state of all outstanding
+    jobs with a few ``bjobs`` calls per round.  The time between
+    rounds doubles, up to *max_interval* seconds, while nothing
+    changes.  Each job is identified by its LSF job id and array
+    index, which is 0 for jobs that are not part of an array.
+    """
+    min_interval = 0.5
+    max_interval = 30
+    bjobs_batch = 500
+    missing_polls = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.misses = {}
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, cmds, n_elements=None):
+        """Run the ``bsub`` command *cmds* and return the job id and Futures.
+
+        If *n_elements* is ``None``, returns the job id and a Future
+        which resolves to the job's return code.  Otherwise the
+        command submits a job array of *n_elements* elements, indexed
+        from 1, and a list of Futures, one per element, is returned in
+        place of the single Future.
+        """
+        sp = subprocess.Popen(cmds, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+        (output, ignore) = sp.communicate()
+        m = re.search(r'Job <(\d+)>', output)
+        if sp.returncode != 0 or m == None:
+            raise ValueError("Submitting to LSF failed: " + output)
+        job_id = m.groups()[0]
+        if n_elements == None:
+            keys = [(job_id, '0')]
+        else:
+            keys = [(job_id, str(i)) for i in range(1, n_elements+1)]
+        futures = [Future() for k in keys]
+        with self.lock:
+            idle = self.jobs == {}
+            for (k,f) in zip(keys, futures):
+                self.jobs[k] = f
+        if idle:
+            self.wakeup.set()
+        if n_elements == None:
+            return (job_id, futures[0])
+        else:
+            return (job_id, futures)
+
+    def _states(self, job_ids):
+        """Return a dictionary of (status, exit code) for each (job id, index)."""
+        states = {}
+        for i in range(0, len(job_ids), self.bjobs_batch):
+            cmds = ["bjobs", "-noheader", "-a", "-o",
+                    "jobid jobindex stat exit_code"] + \
+                    job_ids[i:i+self.bjobs_batch]
+            nullerr = open(os.path.devnull, 'w')
+            try:
+                sp = subprocess.Popen(cmds, stdout=subprocess.PIPE,
+                                      stderr=nullerr)
+                (output, ignore) = sp.communicate()
+            finally:
+                nullerr.close()
+            for line in output.splitlines():
+                fields = line.split()
+                if len(fields) == 4:
+                    states[(fields[0], fields[1])] = (fields[2], fields[3])
+        return states
+
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            with self.lock:
+                keys = self.jobs.keys()
+            if keys == []:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                interval = self.min_interval
+                continue
+            try:
+                states = self._states(sorted(set([k[0] for k in keys])))
+            except OSError, ose:
+                states = {}
+            changed = False
+            for k in keys:
+                if states.has_key(k):
+                    self.misses.pop(k, None)
+                    (stat, exit_code) = states[k]
+                    if stat == 'DONE':
+                        return_code = 0
+                    elif stat == 'EXIT':
+                        try:
+                            return_code = int(exit_code)
+                        except ValueError:
+                            return_code = 1
+                    else:
+                        continue
+                else:
+                    # LSF forgets finished jobs after a while, and
+                    # bjobs can fail transiently.  Give up on a job
+                    # only after it has been missing for several rounds.
+                    self.misses[k] = self.misses.get(k, 0) + 1
+                    if self.misses[k] < self.missing_polls:
+                        continue
+                    del self.misses[k]
+                    return_code = -1
+                with self.lock:
+                    f = self.jobs.pop(k)
+                f._finish(return_code)
+                changed = True
+            if changed:
+                interval = self.min_interval
+            else:
+                interval = min(interval*2, self.max_interval)
+            time.sleep(interval)
+
+_lsf_monitor_instance = None
+_lsf_monitor_lock = threading.Lock()
+
+def _lsf_monitor():
+    """Return the process's _LSFMonitor, starting it if necessary."""
+    global _lsf_monitor_instance
+    with _lsf_monitor_lock:
+        if _lsf_monitor_instance == None:
+            _lsf_monitor_instance = _LSFMonitor()
+        return _lsf_monitor_instance
+
 
 # programs
 
@@ -181,7 +854,15 @@ class program(object):
             a = touch.nonblocking(ex, "myfile1", via="lsf")
             a.wait()
 
-    You can force local execution with ``via="local"``.
+    For very many short programs, ``run_async`` starts a program
+    without dedicating a thread to it, and returns a ``Future`` that
+    works with ``gather`` and ``as_completed``.
+
+    You can force local execution with ``via="local"``.  Local jobs
+    are queued and run at most ``max_local_jobs`` at a time, which
+    defaults to the number of processors of the machine.  Set it for
+    a MiniLIMS or for a single execution (see ``MiniLIMS`` and
+    ``execution``).
 
     Some programs do not accept an output file as an argument and only
     write to ``stdout``.  Alternately, you might need to capture
@@ -189,12 +870,96 @@ class program(object):
     keyword arguments ``stdout`` and ``stderr`` to specify files to
     write these streams to.  If they are omitted, then both streams
     are captured and returned in the ``ProgramOutput`` object.
+
+    Captured streams are read while the program runs, and are spooled
+    to temporary files once they grow past ``spool_size`` bytes.  The
+    ``ProgramOutput`` keeps such a stream in its file, and only reads
+    it when its ``stdout`` or ``stderr`` is asked for.  To
+    keep only the beginning and end of a verbose stream, set
+    ``stdout_limit`` or ``stderr_limit`` on the binding (or on
+    ``program`` itself for all bindings) to a number of bytes; the
+    first and last that many bytes are kept.  To follow the output as
+    it is produced, pass a function of one argument as the keyword
+    argument ``on_stdout`` or ``on_stderr``.  It is called with each
+    line of the stream as it arrives.
     """
+    stdout_limit = None
+    stderr_limit = None
+    spool_size = 1024*1024
+    lsf_array_size = 1000
+
     def __init__(self, gen_args):
         self.gen_args = gen_args
         self.__doc__ = gen_args.__doc__
         self.__name__ = gen_args.__name__
 
+    def _streams(self, kwargs):
+        """Remove the stream keyword arguments from *kwargs*.
+
+        Returns a tuple of the files to redirect stdout and stderr
+        to, or ``None`` for a stream to capture, and the callbacks for
+        each stream.  The files are only opened by ``_popen`` when
+        the program starts, so programs waiting in a pool hold no
+        file descriptors.
+        """
+        stdout = kwargs.pop('stdout', None)
+        stderr = kwargs.pop('stderr', None)
+        on_stdout = kwargs.pop('on_stdout', None)
+        on_stderr = kwargs.pop('on_stderr', None)
+        return (stdout, stderr, on_stdout, on_stderr)
+
+    def _popen(self, ex, arguments, stdout, stderr):
+        """Start *arguments* in *ex*'s working directory, and return the Popen.
+
+        *stdout* and *stderr* are as returned by ``_streams``.  Streams
+        without a file are pipes.
+        """
+        files = [s != None and open(s, 'w') or subprocess.PIPE
+                 for s in [stdout, stderr]]
+        try:
+            return subprocess.Popen(arguments, bufsize=-1, stdout=files[0],
+                                    stderr=files[1], close_fds=True,
+                                    cwd = ex.working_directory)
+        except OSError, ose:
+            raise ValueError("Program %s does not seem to exist in your $PATH." % arguments[0])
+        finally:
+            for f in files:
+                if isinstance(f, file):
+                    f.close()
+
+    def _run(self, ex, arguments, stdout, stderr, on_stdout, on_stderr):
+        """Run *arguments* in *ex*'s working directory and return its ProgramOutput."""
+        sp = self._popen(ex, arguments, stdout, stderr)
+
+        # The first captured stream is read in this thread, and only
+        # the second needs a thread of its own.
+        captures = []
+        if stdout == None:
+            stdout_capture = _StreamCapture(self.stdout_limit, on_stdout,
+                                            self.spool_size)
+            captures.append((stdout_capture, sp.stdout))
+        else:
+            stdout_capture = None
+
+        if stderr == None:
+            stderr_capture = _StreamCapture(self.stderr_limit, on_stderr,
+                                            self.spool_size)
+            captures.append((stderr_capture, sp.stderr))
+        else:
+            stderr_capture = None
+
+        for (capture, stream) in captures[1:]:
+            capture.drain(stream)
+        if captures != []:
+            captures[0][0].read(captures[0][1])
+
+        return_code = sp.wait()
+        stdout_value = stdout_capture and stdout_capture.output()
+        stderr_value = stderr_capture and stderr_capture.output()
+
+        return ProgramOutput(return_code, sp.pid, arguments,
+                             stdout_value, stderr_value)
+
     def __call__(self, ex, *args, **kwargs):
         """Run a program locally, and block until it completes.
 
@@ -206,47 +971,15 @@ class program(object):
         """
         if not(isinstance(ex,Execution)):
             raise ValueError("First argument to program " + self.gen_args.__name__ + " must be an Execution.")
-        elif ex.id != None:
+        elif ex.finished_at != None:
             raise SyntaxError("Program being called on an execution that has already terminated.")
 
-        if kwargs.has_key('stdout'):
-            stdout = open(kwargs['stdout'],'w')
-            kwargs.pop('stdout')
-        else:
-            stdout = subprocess.PIPE
-
-        if kwargs.has_key('stderr'):
-            stderr = open(kwargs['stderr'],'w')
-            kwargs.pop('stderr')
-        else:
-            stderr = subprocess.PIPE
-
-
+        (stdout, stderr, on_stdout, on_stderr) = self._streams(kwargs)
         d = self.gen_args(*args, **kwargs)
-
-        try:
-            sp = subprocess.Popen(d["arguments"], bufsize=-1, stdout=stdout,
-                                  stderr=stderr,
-                                  cwd = ex.working_directory)
-        except OSError, ose:
-            raise ValueError("Program %s does not seem to exist in your $PATH." % d['arguments'][0])
-
-        return_code = sp.wait()
-        if isinstance(stdout,file):
-            stdout_value = None
-        else:
-            stdout_value = sp.stdout.readlines()
-            
-        if isinstance(stderr,file):
-            stderr_value = None
-        else:
-            stderr_value = sp.stderr.readlines()
-                
-        po = ProgramOutput(return_code, sp.pid,
-                           d["arguments"], 
-                           stdout_value, stderr_value)
+        po = self._run(ex, d["arguments"], stdout, stderr,
+                       on_stdout, on_stderr)
         ex.report(po)
-        if return_code == 0:
+        if po.return_code == 0:
             z = d["return_value"]
             if callable(z):
                 return z(po)
@@ -289,7 +1022,7 @@ class program(object):
         """
         if not(isinstance(ex,Execution)):
             raise ValueError("First argument to a program must be an Execution.")
-        elif ex.id != None:
+        elif ex.finished_at != None:
             raise SyntaxError("Program being called on an execution that has already terminated.")
 
         if kwargs.has_key('via'):
@@ -309,18 +1042,7 @@ class program(object):
         If you need to pass a ``via`` keyword argument to your
         function, you will have to call this method directly.
         """
-        if kwargs.has_key('stdout'):
-            stdout = open(kwargs['stdout'],'w')
-            kwargs.pop('stdout')
-        else:
-            stdout = subprocess.PIPE
-
-        if kwargs.has_key('stderr'):
-            stderr = open(kwargs['stderr'],'w')
-            kwargs.pop('stderr')
-        else:
-            stderr = subprocess.PIPE
-
+        (stdout, stderr, on_stdout, on_stderr) = self._streams(kwargs)
         d = self.gen_args(*args, **kwargs)
 
         class Future(object):
@@ -338,30 +1060,9 @@ class program(object):
         v = threading.Event()
         def g():
             try:
-                try:
-                    sp = subprocess.Popen(d["arguments"], bufsize=-1, 
-                                          stdout=stdout,
-                                          stderr=stderr,
-                                          cwd = ex.working_directory)
-                except OSError, ose:
-                    raise ValueError("Program %s does not seem to exist in your $PATH." % d['arguments'][0])
-
-                return_code = sp.wait()
-                if isinstance(stdout,file):
-                    stdout_value = None
-                else:
-                    stdout_value = sp.stdout.readlines()
-
-                if isinstance(stderr,file):
-                    stderr_value = None
-                else:
-                    stderr_value = sp.stderr.readlines()
-
-                f.program_output = ProgramOutput(return_code, sp.pid,
-                                                 d["arguments"], 
-                                                 stdout_value,
-                                                 stderr_value)
-                if return_code == 0:
+                f.program_output = self._run(ex, d["arguments"], stdout, stderr,
+                                             on_stdout, on_stderr)
+                if f.program_output.return_code == 0:
                     z = d["return_value"]
                     if callable(z):
                         f.return_value = z(f.program_output)
@@ -371,8 +1072,71 @@ class program(object):
             except Exception, e:
                 f.return_value = e
                 v.set()
-        a = threading.Thread(target=g)
-        a.start()
+        ex.local_pool().submit(g)
+        return f
+
+    def run_async(self, ex, *args, **kwargs):
+        """Start a program and return a Future without tying up a thread.
+
+        Takes the same arguments as ``nonblocking``, except *via*, and
+        returns a ``Future``.  Instead of a thread per program, all
+        programs started with ``run_async`` are watched by a single
+        event loop thread, so thousands of them can run at once.  The
+        program is reported to *ex* as soon as it exits.  The Future's
+        ``wait()`` returns the same value as calling the program
+        directly, or raises ``ProgramFailed``.  Use ``gather`` and
+        ``as_completed`` to wait on many of them::
+
+            with execution(lims) as ex:
+                fs = [touch.run_async(ex, "myfile%d" % i) for i in range(1000)]
+                for f in as_completed(fs):
+                    print f.wait()
+        """
+        if not(isinstance(ex,Execution)):
+            raise ValueError("First argument to a program must be an Execution.")
+        elif ex.finished_at != None:
+            raise SyntaxError("Program being called on an execution that has already terminated.")
+
+        (stdout, stderr, on_stdout, on_stderr) = self._streams(kwargs)
+        d = self.gen_args(*args, **kwargs)
+        f = Future()
+        try:
+            sp = self._popen(ex, d["arguments"], stdout, stderr)
+        except ValueError, ve:
+            f._finish(exception=ve)
+            return f
+
+        captures = {}
+        if stdout != None:
+            stdout_capture = None
+        else:
+            stdout_capture = _StreamCapture(self.stdout_limit, on_stdout,
+                                            self.spool_size)
+            captures[sp.stdout] = stdout_capture
+        if stderr != None:
+            stderr_capture = None
+        else:
+            stderr_capture = _StreamCapture(self.stderr_limit, on_stderr,
+                                            self.spool_size)
+            captures[sp.stderr] = stderr_capture
+
+        def finished(return_code):
+            try:
+                po = ProgramOutput(return_code, sp.pid, d["arguments"],
+                                   stdout_capture and stdout_capture.output(),
+                                   stderr_capture and stderr_capture.output())
+                ex.report(po)
+                if return_code == 0:
+                    z = d["return_value"]
+                    if callable(z):
+                        f._finish(z(po))
+                    else:
+                        f._finish(z)
+                else:
+                    f._finish(exception=ProgramFailed(po))
+            except Exception, e:
+                f._finish(exception=e)
+        _event_loop().add(sp, captures, finished)
         return f
 
     def lsf(self, ex, *args, **kwargs):
@@ -381,7 +1145,13 @@ class program(object):
         return self._lsf(ex, *args, **kwargs)
 
     def _lsf(self, ex, *args, **kwargs):
-        """Method called by ``nonblocking`` to run via LSF."""
+        """Method called by ``nonblocking`` to run via LSF.
+
+        The job is submitted without blocking, and the single thread
+        of ``_LSFMonitor`` watches for it to finish.  ``wait()`` on
+        the returned Future blocks until then, and reads the job's
+        output.
+        """
         if not(isinstance(ex,Execution)):
             raise ValueError("First argument to a program must be an Execution.")
 
@@ -409,56 +1179,117 @@ class program(object):
         remote_cmd += " > "+stdout
         remote_cmd = " ( "+remote_cmd+" ) >& "+stderr
         cmds = ["bsub","-cwd",ex.remote_working_directory,"-o","/dev/null",
-                "-e","/dev/null","-K","-r",remote_cmd]
+                "-e","/dev/null","-r",remote_cmd]
+        (job_id, job) = _lsf_monitor().submit(cmds)
+        return self._lsf_future(ex, d, int(job_id), job, cmds, stdout, stderr,
+                                load_stdout, load_stderr)
+
+    def _lsf_future(self, ex, d, job_id, job, cmds, stdout, stderr,
+                    load_stdout, load_stderr):
+        """Return the Future for an LSF job started by ``_lsf`` or ``map``.
+
+        *job* is the Future from ``_LSFMonitor`` giving the job's
+        return code.  *stdout* and *stderr* are the files in the
+        working directory the job writes its streams to, which are
+        read into the ProgramOutput if *load_stdout* and *load_stderr*
+        are true.
+        """
         class Future(object):
             def __init__(self):
                 self.program_output = None
                 self.return_value = None
             def wait(self):
-                v.wait()
-                ex.report(self.program_output)
+                if self.program_output == None:
+                    return_code = job.wait()
+                    stdout_path = os.path.join(ex.working_directory, stdout)
+                    stderr_path = os.path.join(ex.working_directory, stderr)
+                    _wait_for_file(stdout_path)
+                    _wait_for_file(stderr_path)
+                    if load_stdout:
+                        with open(stdout_path, 'r') as fo:
+                            stdout_value = fo.read()
+                    else:
+                        stdout_value = None
+                    if load_stderr:
+                        with open(stderr_path, 'r') as fe:
+                            stderr_value = fe.read()
+                    else:
+                        stderr_value = None
+                    self.program_output = ProgramOutput(return_code, job_id, cmds,
+                                                        stdout_value, stderr_value)
+                    ex.report(self.program_output)
+                    if return_code == 0:
+                        z = d["return_value"]
+                        if callable(z):
+                            self.return_value = z(self.program_output)
+                        else:
+                            self.return_value = z
                 return self.return_value
-        f = Future()
-        v = threading.Event()
-        def g():
-            try:
-                nullout = open(os.path.devnull, 'w')
-                sp = subprocess.Popen(cmds, bufsize=-1, stdout=nullout, 
-                                      stderr=nullout)
-                return_code = sp.wait()
-                while not(os.path.exists(os.path.join(ex.working_directory,
-                                                      stdout))):
-                    pass # We need to wait until the files actually show up
-                if load_stdout:
-                    with open(os.path.join(ex.working_directory,stdout), 'r') as fo:
-                        stdout_value = fo.readlines()
-                else:
-                    stdout_value = None
+        return Future()
 
-                while not(os.path.exists(os.path.join(ex.working_directory,stderr))):
-                    pass # We need to wait until the files actually show up
-                if load_stderr:
-                    with open(os.path.join(ex.working_directory,stderr), 'r') as fe:
-                        stderr_value = fe.readlines()
-                else:
-                    stderr_value = None
+    def map(self, ex, arguments, via='local', **kwargs):
+        """Run the program once for each element of *arguments*.
 
-                f.program_output = ProgramOutput(return_code, sp.pid,
-                                                 cmds, stdout_value, stderr_value)
-                if return_code == 0:
-                    z = d["return_value"]
-                    if callable(z):
-                        f.return_value = z(f.program_output)
-                    else:
-                        f.return_value = z
-                v.set()
-            except:
-                f.return_value = None
-                v.set()
-                raise
-        a = threading.Thread(target=g)
-        a.start()
-        return(f)
+        Each element of *arguments* is a tuple of positional arguments
+        for one run of the program, or a single value for programs of
+        one argument.  Keyword arguments other than *via* are passed to
+        every run.  Returns a list of Futures, one per element, as
+        ``nonblocking`` would.  For instance::
+
+            futures = bowtie.map(ex, [(index, r) for r in reads],
+                                 args="-Sra", via="lsf")
+            samfiles = [f.wait() for f in futures]
+
+        With ``via="lsf"``, all the runs are submitted as one LSF job
+        array (or one per ``lsf_array_size`` runs), rather than one
+        job each.  ``stdout`` and ``stderr`` cannot be redirected.
+        """
+        if not(isinstance(ex,Execution)):
+            raise ValueError("First argument to a program must be an Execution.")
+        elif ex.finished_at != None:
+            raise SyntaxError("Program being called on an execution that has already terminated.")
+        if kwargs.has_key('stdout') or kwargs.has_key('stderr'):
+            raise ValueError("map cannot redirect stdout or stderr.")
+
+        arguments = [isinstance(a, tuple) and a or (a,) for a in arguments]
+        if via == 'local':
+            return [self._local(ex, *a, **kwargs) for a in arguments]
+        elif via == 'lsf':
+            futures = []
+            for i in range(0, len(arguments), self.lsf_array_size):
+                futures.extend(self._lsf_array(ex, arguments[i:i+self.lsf_array_size],
+                                               kwargs))
+            return futures
+        else:
+            raise ValueError("Unknown value for via: %s" % via)
+
+    def _lsf_array(self, ex, arguments, kwargs):
+        """Submit one run per element of *arguments* as an LSF job array.
+
+        The command for element *i* (counting from 1) is written to the
+        file *prefix*.*i* in the working directory, and the array runs
+        ``/bin/sh`` *prefix*``.$LSB_JOBINDEX``.  As for ``_lsf``, the
+        ``bsub`` command line is recorded as the arguments of each
+        element, with ``$LSB_JOBINDEX`` replaced by its index.
+        """
+        prefix = unique_filename_in(ex.working_directory)
+        elements = []
+        for (i, a) in enumerate(arguments):
+            d = self.gen_args(*a, **kwargs)
+            stdout = unique_filename_in(ex.working_directory)
+            stderr = unique_filename_in(ex.working_directory)
+            with open(os.path.join(ex.working_directory, "%s.%d" % (prefix, i+1)), 'w') as script:
+                script.write("( %s > %s ) 2> %s\n" % (" ".join(d["arguments"]),
+                                                       stdout, stderr))
+            elements.append((d, stdout, stderr))
+        cmds = ["bsub","-cwd",ex.remote_working_directory,"-o","/dev/null",
+                "-e","/dev/null","-r","-J","%s[1-%d]" % (prefix, len(elements)),
+                "/bin/sh %s.$LSB_JOBINDEX" % prefix]
+        (job_id, jobs) = _lsf_monitor().submit(cmds, n_elements=len(elements))
+        return [self._lsf_future(ex, d, int(job_id), job,
+                                 cmds[:-1] + ["/bin/sh %s.%d" % (prefix, i+1)],
+                                 stdout, stderr, True, True)
+                for (i, ((d, stdout, stderr), job)) in enumerate(zip(elements, jobs))]
 
 
 class Execution(object):
@@ -476,16 +1307,48 @@ class Execution(object):
     into the LIMS repository from the execution's working directory.
     ``use`` fetches a file from the LIMS repository into the working
     directory.
+
+    If *journal* is ``True``, programs passed to ``report`` are
+    written to the MiniLIMS at once instead of being kept in
+    ``programs`` (see :func:`execution`).  If *eager_import* is
+    ``True``, files passed to ``add`` are copied into the MiniLIMS
+    by up to ``import_threads`` background threads while the
+    execution goes on.
     """
-    def __init__(self, lims, working_directory):
+    import_threads = 4
+
+    def __init__(self, lims, working_directory, max_local_jobs=None,
+                 journal=False, eager_import=False):
         self.lims = lims
         self.working_directory = working_directory
+        self.journal = journal
+        self.eager_import = eager_import
+        self._imports = {}
+        self._last_added = {}
+        self._import_pool = None
         self.programs = []
+        self._journaled_programs = 0
+        self._journal_lock = threading.Lock()
+        self.finalizer = None
         self.files = []
         self.used_files = []
         self.started_at = int(time.time())
         self.finished_at = None
         self.id = None
+        if max_local_jobs == None and lims != None:
+            max_local_jobs = lims.max_local_jobs
+        if max_local_jobs == None:
+            max_local_jobs = multiprocessing.cpu_count()
+        self.max_local_jobs = max_local_jobs
+        self._local_pool = None
+        self._local_pool_lock = threading.Lock()
+
+    def local_pool(self):
+        """Return the pool running this execution's local nonblocking programs."""
+        with self._local_pool_lock:
+            if self._local_pool == None:
+                self._local_pool = _WorkerPool(self.max_local_jobs)
+            return self._local_pool
 
     def path_to_file(self, id_or_alias):
         """Fetch the path to *id_or_alias* in the attached LIMS."""
@@ -501,9 +1364,15 @@ class Execution(object):
 
         When the Execution finishes, all programs added to the
         Execution with 'report', in the order the were added, are
-        written into the MiniLIMS repository.
+        written into the MiniLIMS repository.  A journaled Execution
+        writes each one as it is added instead.
         """
-        self.programs.append(program)
+        if self.journal and self.id != None:
+            with self._journal_lock:
+                self.lims._journal_program(self.id, self._journaled_programs, program)
+                self._journaled_programs += 1
+        else:
+            self.programs.append(program)
     def add(self, filename, description="", associate_to_id=None, 
             associate_to_filename=None, template=None, alias=None):
         """Add a file to the MiniLIMS object from this execution.
@@ -515,7 +1384,9 @@ class Execution(object):
         the file in the MiniLIMS repository.
 
         Note that the file is not actually added to the repository
-        until the execution finishes.
+        until the execution finishes.  If the Execution imports files
+        eagerly, the file is copied into the repository right away,
+        and must not be changed afterwards.
         """
         if filename == None:
             if description == "":
@@ -527,11 +1398,61 @@ class Execution(object):
         else:
             self.files.append((filename,description,associate_to_id,
                                associate_to_filename,template,alias))
+            if self.eager_import and self.lims != None:
+                self._start_import(len(self.files) - 1)
+            self._last_added[filename] = len(self.files) - 1
+
+    def _start_import(self, i):
+        """Start copying the i'th file added into the MiniLIMS in the background.
+
+        Records as ``_imports[i]`` the index of the file it is named
+        from by association, or ``None``, and a Future of the
+        (repository_name, blob) pair it is copied to, for
+        ``MiniLIMS.write``.  A file associated to a file which has not
+        been added yet is left for ``MiniLIMS.write`` to copy, since
+        its name is not known.
+        """
+        (filename, description, associate_to_id, associate_to_filename,
+         template, alias) = self.files[i]
+        target_index = None
+        if associate_to_filename != None and associate_to_id == None:
+            if not(self._last_added.has_key(associate_to_filename)) or \
+                    not(self._imports.has_key(self._last_added[associate_to_filename])):
+                return
+            target_index = self._last_added[associate_to_filename]
+            target = self._imports[target_index][1]
+        path = os.path.join(self.working_directory, filename)
+        f = Future()
+        def job():
+            try:
+                if associate_to_id != None:
+                    fileid = self.lims.resolve_alias(associate_to_id)
+                    repository_name = template % \
+                        self.lims.fetch_file(fileid)['repository_name']
+                elif associate_to_filename != None:
+                    repository_name = template % target.wait()[0]
+                else:
+                    repository_name = None
+                f._finish(self.lims._copy_file_to_repository(path, repository_name))
+            except Exception, e:
+                f._finish(exception=e)
+        if self._import_pool == None:
+            self._import_pool = _WorkerPool(self.import_threads)
+        self._import_pool.submit(job)
+        self._imports[i] = (target_index, f)
+
     def finish(self):
         """Set the time when the execution finished."""
         self.finished_at = int(time.time())
-
-    def use(self, file_or_alias):
+        with self._local_pool_lock:
+            if self._local_pool != None:
+                self._local_pool.shutdown()
+                self._local_pool = None
+        if self._import_pool != None:
+            self._import_pool.shutdown()
+            self._import_pool = None
+
+    def use(self, file_or_alias, staging=None, writable=False):
         """Fetch a file from the MiniLIMS repository.
 
         fileid should be an integer assigned to a file in the MiniLIMS
@@ -539,23 +1460,80 @@ class Execution(object):
         repository.  The file is copied into the execution's working
         directory with a unique filename.  'use' returns the unique
         filename it copied the file into.
+
+        *staging* overrides the MiniLIMS's staging mode for this call.
+        In ``'link'`` mode, the file is hard linked, reflinked, or
+        symbolically linked into the working directory instead of
+        being copied, and is read-only.  Pass *writable* as
+        ``True`` if you need to modify it; you then get a reflink or a
+        copy.
         """
         fileid = self.lims.resolve_alias(file_or_alias)
+        if staging == None:
+            staging = self.lims.staging
         try:
             filename = [x for (x,) in 
-                        self.lims.db.execute("select exportfile(?,?)", 
-                                             (fileid, self.working_directory))][0]
+                        self.lims.db.execute("select exportfile(?,?,?,?)", 
+                                             (fileid, self.working_directory,
+                                              staging, writable))][0]
             for (f,t) in self.lims.associated_files_of(fileid):
-                self.lims.db.execute("select exportfile(?,?)",
-                                     (f, os.path.join(self.working_directory,t % filename)))
+                self.lims.db.execute("select exportfile(?,?,?,?)",
+                                     (f, os.path.join(self.working_directory,t % filename),
+                                      staging, writable))
             self.used_files.append(fileid)
             return filename
         except ValueError, v:
             raise ValueError("Tried to use a nonexistent file id " + str(fileid))
 
 
+def _finalize(ex, description, exception_string):
+    """Write ex to its MiniLIMS, remove its working directory, and return its id."""
+    try:
+        if ex.lims != None:
+            ex.id = ex.lims.write(ex, description, exception_string, move=True)
+    finally:
+        shutil.rmtree(ex.working_directory, ignore_errors=True)
+    return ex.id
+
+# Executions finalized in the background are written one at a time,
+# in the order they finished, by a single thread.
+_finalizer_pool = _WorkerPool(1)
+_pending_finalizers = set()
+_pending_finalizers_lock = threading.Lock()
+
+def _finalize_in_background(ex, description, exception_string):
+    """Queue _finalize for ex, and return a Future of its id."""
+    f = Future()
+    with _pending_finalizers_lock:
+        _pending_finalizers.add(f)
+    def done(f):
+        with _pending_finalizers_lock:
+            _pending_finalizers.discard(f)
+    f.add_done_callback(done)
+    def job():
+        try:
+            f._finish(_finalize(ex, description, exception_string))
+        except Exception, e:
+            f._finish(exception=e)
+    _finalizer_pool.submit(job)
+    return f
+
+@atexit.register
+def _flush_finalizers():
+    """Wait for all executions being finalized in the background."""
+    while True:
+        with _pending_finalizers_lock:
+            pending = list(_pending_finalizers)
+        if pending == []:
+            break
+        for f in pending:
+            f._finished.wait()
+
+
 @contextmanager
-def execution(lims = None, description="", remote_working_directory=None):
+def execution(lims = None, description="", remote_working_directory=None,
+              max_local_jobs=None, journal=False, finalize_in_background=False,
+              eager_import=False):
     """Create an ``Execution`` connected to the given MiniLIMS object.
     
     ``execution`` is a ``contextmanager``, so it can be used in a ``with``
@@ -595,10 +1573,42 @@ def execution(lims = None, description="", remote_working_directory=None):
     an execution may create a directory lK4321fdr21 in /scratch/abc.
     On the worker node, it would be /nfs/boris/scratch/abc/lK4321fd21,
     so you pass /nfs/boris/scratch/abc as *remote_working_directory*.
+
+    *max_local_jobs* limits how many programs started with
+    ``nonblocking(via="local")`` run at once in this execution.
+    Further programs wait in a queue.  It defaults to the MiniLIMS's
+    setting, or to the number of processors of the machine.
+
+    Normally nothing is written to the MiniLIMS until the ``with``
+    block is finished, so if the process is killed on the way, there
+    is no record of the execution.  If *journal* is ``True``, the
+    execution is recorded in the MiniLIMS when it starts, with its
+    ``id`` set at once and its ``finished_at`` left ``None``, and each
+    program is recorded as it finishes rather than being kept in
+    memory.  At the end, the execution's finishing time, exception,
+    and files are written as usual.
+
+    Writing the execution copies all the files it added into the
+    MiniLIMS, which can take a long time.  If *finalize_in_background*
+    is ``True``, the ``with`` block returns at once, and the execution
+    is written and its working directory deleted by a background
+    thread.  ``ex.finalizer`` is then a ``Future`` whose ``wait()``
+    returns the execution ID, and ``ex.id`` is set once it is done.
+    Before the Python process exits, it waits for all executions
+    being finalized to be written.
+
+    If *eager_import* is ``True``, each file passed to ``ex.add`` is
+    copied into the MiniLIMS right away by a background thread, so
+    the copying overlaps with the rest of the execution, and only the
+    records of the files are written at the end.  Files must then not
+    be changed after they are added.
     """
     execution_dir = unique_filename_in(os.getcwd())
     os.mkdir(os.path.join(os.getcwd(), execution_dir))
-    ex = Execution(lims,os.path.join(os.getcwd(), execution_dir))
+    ex = Execution(lims,os.path.join(os.getcwd(), execution_dir),
+                   max_local_jobs=max_local_jobs,
+                   journal=journal and lims != None,
+                   eager_import=eager_import)
     if remote_working_directory == None:
         ex.remote_working_directory = ex.working_directory
     else:
@@ -607,6 +1617,8 @@ def execution(lims = None, description="", remote_working_directory=None):
     os.chdir(os.path.join(os.getcwd(), execution_dir))
     exception_string = None
     try:
+        if ex.journal:
+            ex.id = lims.journal(ex, description)
         yield ex
     except:
         (exc_type, exc_value, exc_traceback) = sys.exc_info()
@@ -615,15 +1627,62 @@ def execution(lims = None, description="", remote_working_directory=None):
         raise
     finally:
         ex.finish()
-        try:
-            if lims != None:
-                ex.id = lims.write(ex, description, exception_string)
-        finally:
-            os.chdir("..")
-            shutil.rmtree(ex.working_directory, ignore_errors=True)
-            cleaned_up = True
-        assert(cleaned_up)
+        os.chdir("..")
+        if finalize_in_background:
+            ex.finalizer = _finalize_in_background(ex, description, exception_string)
+        else:
+            _finalize(ex, description, exception_string)
+
+
+def _compress_output(text):
+    """Compress the captured output text of a program for storage."""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return sqlite3.Binary(zlib.compress(text))
 
+def _decompress_output(data):
+    """Return the output text stored by _compress_output as data."""
+    if data == None:
+        return u""
+    return zlib.decompress(data).decode('utf-8', 'replace')
+
+def _output_text(value):
+    """Return the output value of a program as unicode for indexing."""
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    else:
+        return value
+
+def _chunks(xs, n):
+    """Split the list xs into lists of at most n elements."""
+    return [xs[i:i+n] for i in range(0, len(xs), n)]
+
+class _LazyProgram(dict):
+    """A program's dictionary from ``fetch_executions(lazy=True)``.
+
+    ``stdout`` and ``stderr`` are read from the database the first time
+    either is looked up, with ``[]`` or ``get``.
+    """
+    def __init__(self, lims, execution, pos, fields):
+        dict.__init__(self, fields)
+        self._lims = lims
+        self._key = (execution, pos)
+
+    def __missing__(self, key):
+        if key in ('stdout', 'stderr'):
+            output = self._lims.db.execute("""select stdout, stderr from program_output
+                                              where execution=? and pos=?""",
+                                           self._key).fetchone() or (None, None)
+            self['stdout'] = _decompress_output(output[0])
+            self['stderr'] = _decompress_output(output[1])
+            return self[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
 class MiniLIMS(object):
     """Encapsulates a database and directory to track executions and files.
@@ -640,13 +1699,16 @@ class MiniLIMS(object):
 
     Basic file operations:
       * :meth:`import_file`
+      * :meth:`import_files`
       * :meth:`export_file`
       * :meth:`path_to_file`
       * :meth:`copy_file`
 
     Fetching files and executions:
       * :meth:`fetch_file`
+      * :meth:`fetch_files`
       * :meth:`fetch_execution`
+      * :meth:`fetch_executions`
 
     Deleting files and executions:
       * :meth:`delete_file`
@@ -655,6 +1717,8 @@ class MiniLIMS(object):
     Searching files and executions:      
       * :meth:`search_files`
       * :meth:`search_executions`
+      * :meth:`iter_files`
+      * :meth:`iter_executions`
 
     File aliases:
       * :meth:`resolve_alias`
@@ -665,22 +1729,149 @@ class MiniLIMS(object):
       * :meth:`associate_file`
       * :meth:`delete_file_association`
       * :meth:`associated_files_of`
+
+    Repository maintenance:
+      * :meth:`deduplicate`
+      * :meth:`set_layout`
+
+    If *content_addressed* is ``True``, files added to the repository
+    are stored only once per distinct content.  Each distinct content
+    is kept as a blob in the ``blobs`` directory of the repository,
+    named by its SHA1 hash, and the entries in the ``files``
+    directory are hard links to it.  The ``blob`` table counts how
+    many files refer to each blob, and a blob is removed when the last
+    file referring to it is deleted.  Repositories can be opened with
+    and without *content_addressed* interchangeably.  Files stored
+    before content addressing was turned on can be moved into the
+    blob store with :meth:`deduplicate`.
+
+    *staging* sets how :meth:`Execution.use` puts files into working
+    directories.  The default, ``'copy'``, copies them.  ``'link'``
+    avoids copying data where the filesystem allows it (see
+    :meth:`Execution.use`).  So that links cannot be used to change
+    them, files are made read-only when they are stored in the
+    repository.  :meth:`export_file` and :meth:`Execution.use` with
+    *writable* set give copies you can change.
+
+    *max_local_jobs* is the default number of local nonblocking
+    programs each execution against this MiniLIMS runs at once (see
+    :func:`execution`).
+
+    The ``files``, ``memopad``, and ``blobs`` directories are flat by
+    default.  With very many files, that slows down the filesystem.
+    A repository created with *layout* set to ``'sharded'`` puts each
+    file in a two level subdirectory named for the first hex digits of
+    the MD5 hash of its name, such as ``files/3f/a2/<name>``.  The
+    layout of an existing repository is changed with
+    :meth:`set_layout`.
+
+    :meth:`search_files` and :meth:`search_executions` use full-text
+    indexes of names, descriptions, and program arguments.  If
+    *index_output* is ``True``, the stdout and stderr of the programs
+    in executions written through this MiniLIMS are indexed as well.
+    This roughly doubles the space they take in the database.  The
+    indexes use the first of the SQLite modules in
+    ``MiniLIMS.text_index_modules`` which is available when the
+    repository is created or upgraded, FTS5 or else FTS4.  Matches
+    are only ranked by FTS5.  If SQLite has neither, there are no
+    indexes, and *with_text* is matched as a substring of names,
+    descriptions, and arguments, with ``*`` matching anything.
+    Repositories shared with machines whose SQLite lacks FTS5
+    should be created with ``MiniLIMS.text_index_modules`` set to
+    ``['fts4']``.
+
+    A MiniLIMS can be used from several threads and processes at
+    once.  Each thread (and each process a MiniLIMS object is carried
+    into by ``fork``) gets its own connection to the database from
+    :attr:`db`.  The database is in SQLite's write-ahead log mode, so
+    readers do not block writers or each other, and writers wait up
+    to ``busy_timeout`` seconds for each other instead of failing with
+    "database is locked".  Write-ahead logging needs all processes
+    using the repository to be on the same machine.  For repositories
+    on network filesystems shared between machines, set
+    ``MiniLIMS.journal_mode`` to ``'delete'`` before opening them.
     """
-    def __init__(self, path):
+    busy_timeout = 60.0
+    journal_mode = 'wal'
+    text_index_modules = ['fts5', 'fts4']
+    import_threads = 4
+
+    def __init__(self, path, content_addressed=False, staging='copy',
+                 max_local_jobs=None, layout=None, index_output=False):
         self.path = os.path.abspath(path)
         self.file_path = os.path.join(self.path, 'files')
         self.memopad_path = os.path.join(self.path, 'memopad')
+        self.blob_path = os.path.join(self.path, 'blobs')
+        self.content_addressed = content_addressed
+        self.staging = staging
+        self.max_local_jobs = max_local_jobs
+        self.index_output = index_output
+        self._connections = threading.local()
         if not(os.path.exists(self.path)):
             os.mkdir(self.path)
             os.mkdir(os.path.join(self.path, 'files'))
             os.mkdir(os.path.join(self.path, 'memopad'))
-            self.db = sqlite3.connect(os.path.join(self.path, 'metadata.db'))
             self.initialize_database(self.db)
+            with self._transaction() as db:
+                db.execute("""update setting set value=? where key='layout'""",
+                           (layout or 'flat',))
         else:
-            self.db = sqlite3.connect(os.path.join(self.path, 'metadata.db'))
-        self.db.create_function("importfile",1,self._copy_file_to_repository)
-        self.db.create_function("deletefile",1,self._delete_repository_file)
-        self.db.create_function("exportfile",2,self._export_file_from_repository)
+            self.upgrade_database(self.db)
+        self.layout = self.db.execute("""select value from setting
+                                         where key='layout'""").fetchone()[0]
+        self.text_index = self._text_index(self.db)
+        if layout != None and layout != self.layout:
+            raise ValueError("MiniLIMS %s has layout %s, not %s.  Use set_layout to change it." % \
+                                 (self.path, self.layout, layout))
+        if content_addressed and not(os.path.exists(self.blob_path)):
+            os.mkdir(self.blob_path)
+
+    @property
+    def db(self):
+        """The connection to the MiniLIMS database for the current thread.
+
+        Connections are opened the first time a thread asks for one.
+        A connection inherited across ``fork`` is never used, since
+        SQLite connections must not be shared between processes.
+        """
+        connection = getattr(self._connections, 'db', None)
+        if connection == None or connection[0] != os.getpid():
+            connection = (os.getpid(), self._connect())
+            self._connections.db = connection
+        return connection[1]
+
+    def _connect(self):
+        # Transactions begin IMMEDIATE, taking the write lock when
+        # they start, so a writer waits out busy_timeout for another
+        # writer rather than failing when it upgrades a read lock.
+        db = sqlite3.connect(os.path.join(self.path, 'metadata.db'),
+                             timeout=self.busy_timeout,
+                             isolation_level='IMMEDIATE')
+        db.execute("pragma journal_mode = %s" % self.journal_mode)
+        if self.journal_mode == 'wal':
+            db.execute("pragma synchronous = NORMAL")
+        db.create_function("deletefile",1,self._delete_repository_file)
+        db.create_function("exportfile",4,self._export_file_from_repository)
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """Run the body of a ``with`` statement as one transaction.
+
+        The transaction is committed if the body finishes and rolled
+        back if it raises.  Every method which writes to the database
+        goes through here, since a failed statement left uncommitted
+        keeps this thread's connection holding the write lock, and
+        every other writer then fails with "database is locked".
+        """
+        db = self.db
+        try:
+            yield db
+        except:
+            (exc_type, exc_value, exc_traceback) = sys.exc_info()
+            db.rollback()
+            raise exc_type, exc_value, exc_traceback
+        db.commit()
 
     def initialize_database(self, db):
         """Sets up a new MiniLIMS database.
@@ -721,7 +1912,8 @@ class MiniLIMS(object):
                created timestamp default current_timestamp, 
                description text not null default '',
                origin text not null default 'execution', 
-               origin_value integer default null
+               origin_value integer default null,
+               blob text default null
         )""")
         self.db.execute("""
         CREATE TABLE if not exists execution_use (
@@ -860,31 +2052,732 @@ class MiniLIMS(object):
             call text,
             inserted timestamp default current_timestamp
         )""")
-        self.db.commit()
+        self.upgrade_database(db)
+
+    def upgrade_database(self, db):
+        """Brings an older MiniLIMS database up to the current schema.
+
+        The version of a database's schema is kept in SQLite's
+        ``user_version`` pragma.  Each function in
+        ``MiniLIMS.migrations`` takes a MiniLIMS and its database and
+        upgrades it from one version to the next, so a database at
+        version *n* is upgraded by running every migration from the
+        *n*-th on.  This is run on every database that is opened, and
+        at the end of :meth:`initialize_database`, so new databases
+        get the current schema the same way.  To change the schema,
+        append a migration to the list; never edit one that has
+        shipped.
+        """
+        version = db.execute("pragma user_version").fetchone()[0]
+        if version >= len(MiniLIMS.migrations):
+            return
+        # Run the migrations in one transaction, holding the write
+        # lock, so other processes opening the repository at the same
+        # time wait and then see the upgraded schema.  The sqlite3
+        # module commits before schema changes unless it is left out
+        # of transaction handling, so do that here.
+        db.commit()
+        isolation_level = db.isolation_level
+        db.isolation_level = None
+        try:
+            db.execute("begin immediate")
+            try:
+                version = db.execute("pragma user_version").fetchone()[0]
+                for migration in MiniLIMS.migrations[version:]:
+                    migration(self, db)
+                    version += 1
+                db.execute("pragma user_version = %d" % version)
+                db.execute("commit")
+            except:
+                db.execute("rollback")
+                raise
+        finally:
+            db.isolation_level = isolation_level
+
+    def _add_blob_store(self, db):
+        """Migration: set up the tables and triggers of the content addressed store.
+
+        Repositories from before schema versions were tracked may
+        already have these, so this checks before adding anything.
+        """
+        columns = [c[1] for c in db.execute("pragma table_info(file)")]
+        if not('blob' in columns):
+            db.execute("""alter table file add column blob text default null""")
+        db.execute("""
+        CREATE TABLE if not exists blob (
+            hash text primary key,
+            refcount integer not null default 0
+        )""")
+        self.db.execute("""
+        CREATE TRIGGER if not exists add_blob_reference AFTER INSERT ON file
+        FOR EACH ROW WHEN NEW.blob IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO blob(hash, refcount) VALUES (NEW.blob, 0);
+            UPDATE blob SET refcount = refcount + 1 WHERE hash = NEW.blob;
+        END
+        """)
+        self.db.execute("""
+        CREATE TRIGGER if not exists drop_blob_reference AFTER DELETE ON file
+        FOR EACH ROW WHEN OLD.blob IS NOT NULL
+        BEGIN
+            UPDATE blob SET refcount = refcount - 1 WHERE hash = OLD.blob;
+        END
+        """)
+        self.db.execute("""
+        CREATE TRIGGER if not exists change_blob_reference AFTER UPDATE OF blob ON file
+        FOR EACH ROW WHEN OLD.blob IS NOT NEW.blob
+        BEGIN
+            UPDATE blob SET refcount = refcount - 1 WHERE hash = OLD.blob;
+            INSERT OR IGNORE INTO blob(hash, refcount) 
+                   SELECT NEW.blob, 0 WHERE NEW.blob IS NOT NULL;
+            UPDATE blob SET refcount = refcount + 1 WHERE hash = NEW.blob;
+        END
+        """)
+
+    def _add_settings(self, db):
+        """Migration: add the setting table, which holds the repository's layout."""
+        db.execute("""
+        CREATE TABLE if not exists setting (
+            key text primary key,
+            value text
+        )""")
+        db.execute("""insert or ignore into setting(key,value)
+                      values ('layout','flat')""")
+
+    def _add_indexes(self, db):
+        """Migration: index the columns that lookups and joins go through."""
+        db.execute("""CREATE INDEX if not exists file_origin
+                      ON file(origin, origin_value)""")
+        db.execute("""CREATE INDEX if not exists program_execution
+                      ON program(execution)""")
+        db.execute("""CREATE INDEX if not exists argument_execution
+                      ON argument(execution, program)""")
+        db.execute("""CREATE INDEX if not exists execution_use_file
+                      ON execution_use(file)""")
+        db.execute("""CREATE INDEX if not exists execution_use_execution
+                      ON execution_use(execution)""")
+        db.execute("""CREATE INDEX if not exists file_alias_file
+                      ON file_alias(file)""")
+        db.execute("""CREATE INDEX if not exists file_association_associated_to
+                      ON file_association(associated_to)""")
+        db.execute("""CREATE INDEX if not exists file_association_fileid
+                      ON file_association(fileid)""")
+
+    def _materialize_immutability(self, db):
+        """Migration: keep immutability in columns instead of computing it in views.
+
+        A file is immutable if an execution used it, or if it is
+        associated to a file which an execution used.  An execution
+        is immutable if any of the files it added is.  The views
+        which worked this out grouped the whole file,
+        file_association, and execution_use tables, and the triggers
+        which protect immutable rows queried them for every row
+        deleted or updated.  Instead, ``file.use_count`` counts the
+        executions using a file, ``file.immutable`` is kept up to date
+        from it whenever execution_use or file_association change,
+        and ``execution.immutable_outputs`` counts the immutable files
+        an execution added.  The views are kept, reading the columns.
+        """
+        for trigger in ['prevent_file_delete', 'prevent_argument_delete',
+                        'prevent_argument_update', 'prevent_command_delete',
+                        'prevent_command_update', 'prevent_execution_delete',
+                        'prevent_execution_update', 'prevent_immutable_file_update']:
+            db.execute("DROP TRIGGER if exists %s" % trigger)
+        for view in ['execution_immutability', 'file_immutability',
+                     'file_direct_immutability']:
+            db.execute("DROP VIEW if exists %s" % view)
+        db.execute("""alter table file add column use_count integer not null default 0""")
+        db.execute("""alter table file add column immutable integer not null default 0""")
+        db.execute("""alter table execution add column
+                      immutable_outputs integer not null default 0""")
+
+        # Recompute file.immutable for the file with id %(id)s and the
+        # files associated to it.
+        update_immutable = """
+            UPDATE file SET immutable = (use_count > 0 OR EXISTS
+                (SELECT 1 FROM file_association AS fa, file AS target
+                 WHERE fa.fileid = file.id AND target.id = fa.associated_to
+                 AND target.use_count > 0))
+            WHERE id = %(id)s OR id IN
+                (SELECT fileid FROM file_association WHERE associated_to = %(id)s);
+            """
+        db.execute("""update file set use_count =
+                      (select count(*) from execution_use where file = file.id)""")
+        db.execute("""update file set immutable = (use_count > 0 or exists
+                          (select 1 from file_association as fa, file as target
+                           where fa.fileid = file.id and target.id = fa.associated_to
+                           and target.use_count > 0))""")
+        db.execute("""update execution set immutable_outputs =
+                      (select count(*) from file where origin = 'execution'
+                       and origin_value = execution.id and immutable = 1)""")
+
+        db.execute("""
+        CREATE TRIGGER count_file_use AFTER INSERT ON execution_use
+        FOR EACH ROW BEGIN
+            UPDATE file SET use_count = use_count + 1 WHERE id = NEW.file;
+        """ + update_immutable % {'id': 'NEW.file'} + """
+        END""")
+        db.execute("""
+        CREATE TRIGGER uncount_file_use AFTER DELETE ON execution_use
+        FOR EACH ROW BEGIN
+            UPDATE file SET use_count = use_count - 1 WHERE id = OLD.file;
+        """ + update_immutable % {'id': 'OLD.file'} + """
+        END""")
+        db.execute("""
+        CREATE TRIGGER recount_file_use AFTER UPDATE OF file ON execution_use
+        FOR EACH ROW BEGIN
+            UPDATE file SET use_count = use_count - 1 WHERE id = OLD.file;
+        """ + update_immutable % {'id': 'OLD.file'} + """
+            UPDATE file SET use_count = use_count + 1 WHERE id = NEW.file;
+        """ + update_immutable % {'id': 'NEW.file'} + """
+        END""")
+        db.execute("""
+        CREATE TRIGGER add_association_immutability AFTER INSERT ON file_association
+        FOR EACH ROW BEGIN
+        """ + update_immutable % {'id': 'NEW.fileid'} + """
+        END""")
+        db.execute("""
+        CREATE TRIGGER drop_association_immutability AFTER DELETE ON file_association
+        FOR EACH ROW BEGIN
+        """ + update_immutable % {'id': 'OLD.fileid'} + """
+        END""")
+        db.execute("""
+        CREATE TRIGGER change_association_immutability AFTER UPDATE ON file_association
+        FOR EACH ROW BEGIN
+        """ + update_immutable % {'id': 'OLD.fileid'} + \
+                   update_immutable % {'id': 'NEW.fileid'} + """
+        END""")
+        # execution_use and file_association rows may name a file id
+        # before the file exists, so count them when it is added.
+        db.execute("""
+        CREATE TRIGGER add_file_immutability AFTER INSERT ON file
+        FOR EACH ROW BEGIN
+            UPDATE file SET use_count =
+                (SELECT count(*) FROM execution_use WHERE file = NEW.id)
+            WHERE id = NEW.id;
+        """ + update_immutable % {'id': 'NEW.id'} + """
+        END""")
+        db.execute("""
+        CREATE TRIGGER drop_file_immutability AFTER DELETE ON file
+        FOR EACH ROW BEGIN
+        """ + update_immutable % {'id': 'OLD.id'} + """
+        END""")
+        db.execute("""
+        CREATE TRIGGER count_immutable_output AFTER UPDATE OF immutable ON file
+        FOR EACH ROW WHEN OLD.immutable != NEW.immutable AND NEW.origin = 'execution'
+        BEGIN
+            UPDATE execution SET immutable_outputs =
+                immutable_outputs + NEW.immutable - OLD.immutable
+            WHERE id = NEW.origin_value;
+        END""")
+        db.execute("""
+        CREATE TRIGGER add_execution_immutability AFTER INSERT ON execution
+        FOR EACH ROW BEGIN
+            UPDATE execution SET immutable_outputs =
+                (SELECT count(*) FROM file WHERE origin = 'execution'
+                 AND origin_value = NEW.id AND immutable = 1)
+            WHERE id = NEW.id;
+        END""")
+
+        db.execute("""
+        CREATE VIEW file_direct_immutability AS
+        SELECT id, use_count > 0 AS immutable FROM file
+        """)
+        db.execute("""
+        CREATE VIEW file_immutability AS
+        SELECT id, immutable FROM file
+        """)
+        db.execute("""
+        CREATE VIEW execution_immutability AS
+        SELECT id, immutable_outputs > 0 AS immutable FROM execution
+        """)
+
+        db.execute("""
+        CREATE TRIGGER prevent_file_delete BEFORE DELETE ON file
+        FOR EACH ROW WHEN OLD.immutable = 1
+        BEGIN
+            SELECT RAISE(FAIL, 'File is immutable; cannot delete it.');
+        END
+        """)
+        db.execute("""
+        CREATE TRIGGER prevent_argument_delete BEFORE DELETE ON argument
+        FOR EACH ROW WHEN
+            (SELECT immutable_outputs FROM execution WHERE id = OLD.execution) > 0
+        BEGIN
+            SELECT RAISE(FAIL, 'Execution is immutable; cannot delete argument.');
+        END
+        """)
+        db.execute("""
+        CREATE TRIGGER prevent_argument_update BEFORE UPDATE ON argument
+        FOR EACH ROW WHEN
+            (SELECT immutable_outputs FROM execution WHERE id = OLD.execution) > 0
+        BEGIN
+            SELECT RAISE(FAIL, 'Execution is immutable; cannot update command arguments.');
+        END
+        """)
+        db.execute("""
+        CREATE TRIGGER prevent_command_delete BEFORE DELETE ON program
+        FOR EACH ROW WHEN
+            (SELECT immutable_outputs FROM execution WHERE id = OLD.execution) > 0
+        BEGIN
+            SELECT RAISE(FAIL, 'Execution is immutable; cannot delete command.');
+        END
+        """)
+        db.execute("""
+        CREATE TRIGGER prevent_command_update BEFORE UPDATE ON program
+        FOR EACH ROW WHEN
+            (SELECT immutable_outputs FROM execution WHERE id = OLD.execution) > 0
+        BEGIN
+            SELECT RAISE(FAIL, 'Execution is immutable; cannot update commands.');
+        END
+        """)
+        db.execute("""
+        CREATE TRIGGER prevent_execution_delete BEFORE DELETE ON execution
+        FOR EACH ROW WHEN OLD.immutable_outputs > 0
+        BEGIN
+            SELECT RAISE(FAIL, 'Execution is immutable; cannot delete.');
+        END
+        """)
+        # The trigger this replaces compared OLD.temp_dir, a column
+        # execution has never had, so firing it was an error.
+        db.execute("""
+        CREATE TRIGGER prevent_execution_update BEFORE UPDATE ON execution
+        FOR EACH ROW WHEN OLD.immutable_outputs > 0 AND
+            (OLD.id != NEW.id OR OLD.started_at != NEW.started_at OR
+             OLD.finished_at != NEW.finished_at OR
+             OLD.working_directory != NEW.working_directory)
+        BEGIN
+            SELECT RAISE(FAIL, 'Execution is immutable; cannot update anything but description.');
+        END
+        """)
+        db.execute("""
+        CREATE TRIGGER prevent_immutable_file_update BEFORE UPDATE ON file
+        FOR EACH ROW WHEN OLD.immutable = 1 AND
+            (OLD.id != NEW.id OR OLD.external_name != NEW.external_name OR
+             OLD.repository_name != NEW.repository_name OR
+             OLD.created != NEW.created OR OLD.origin != NEW.origin OR
+             OLD.origin_value != NEW.origin_value)
+        BEGIN
+            SELECT RAISE(FAIL, 'File is immutable; cannot update except description.');
+        END
+        """)
+
+    def _add_text_index(self, db):
+        """Migration: add full-text indexes for search_files and search_executions.
+
+        file_text, execution_text, and argument_text index the
+        external names and descriptions of files, the descriptions of
+        executions, and the arguments of programs.  They use the first
+        module of ``text_index_modules`` which SQLite has, FTS5 or
+        FTS4, and read their text from the indexed table, and triggers
+        keep them up to date, except that new arguments are indexed
+        by :meth:`write` with one statement per execution, since a
+        trigger per argument row made writing executions with many
+        programs several times slower.  program_text holds its own
+        copy of the stdout and stderr of programs, which is only
+        written for MiniLIMS objects with *index_output* set.  If
+        SQLite has neither module, no tables are made, and searches
+        fall back to ``LIKE``.
+        """
+        module = None
+        for m in self.text_index_modules:
+            try:
+                db.execute("CREATE VIRTUAL TABLE temp.text_probe USING %s(x)" % m)
+                db.execute("DROP TABLE temp.text_probe")
+                module = m
+                break
+            except sqlite3.OperationalError:
+                pass
+        if module == None:
+            return
+        if module == 'fts5':
+            db.execute("""CREATE VIRTUAL TABLE file_text USING
+                          fts5(external_name, description, content='file', content_rowid='id')""")
+            db.execute("""CREATE VIRTUAL TABLE execution_text USING
+                          fts5(description, content='execution', content_rowid='id')""")
+            db.execute("""CREATE VIRTUAL TABLE argument_text USING
+                          fts5(argument, content='argument')""")
+            db.execute("""CREATE VIRTUAL TABLE program_text USING fts5(stdout, stderr)""")
+        else:
+            # FTS4 tables use the rowid of their content table, which
+            # is the id of files and executions.
+            db.execute("""CREATE VIRTUAL TABLE file_text USING
+                          fts4(external_name, description, content='file')""")
+            db.execute("""CREATE VIRTUAL TABLE execution_text USING
+                          fts4(description, content='execution')""")
+            db.execute("""CREATE VIRTUAL TABLE argument_text USING
+                          fts4(argument, content='argument')""")
+            db.execute("""CREATE VIRTUAL TABLE program_text USING fts4(stdout, stderr)""")
+        for (text, table, key, columns) in \
+                [('file_text', 'file', 'id', ['external_name', 'description']),
+                 ('execution_text', 'execution', 'id', ['description']),
+                 ('argument_text', 'argument', 'rowid', ['argument'])]:
+            d = {'text': text, 'table': table, 'key': key,
+                 'columns': ", ".join(columns),
+                 'new': ", ".join(["NEW." + c for c in columns]),
+                 'old': ", ".join(["OLD." + c for c in columns])}
+            if table != 'argument':
+                db.execute("""
+                CREATE TRIGGER %(text)s_insert AFTER INSERT ON %(table)s
+                FOR EACH ROW BEGIN
+                    INSERT INTO %(text)s(rowid, %(columns)s) VALUES (NEW.%(key)s, %(new)s);
+                END""" % d)
+            if module == 'fts5':
+                db.execute("""
+                CREATE TRIGGER %(text)s_delete AFTER DELETE ON %(table)s
+                FOR EACH ROW BEGIN
+                    INSERT INTO %(text)s(%(text)s, rowid, %(columns)s)
+                    VALUES ('delete', OLD.%(key)s, %(old)s);
+                END""" % d)
+                db.execute("""
+                CREATE TRIGGER %(text)s_update AFTER UPDATE OF %(columns)s ON %(table)s
+                FOR EACH ROW BEGIN
+                    INSERT INTO %(text)s(%(text)s, rowid, %(columns)s)
+                    VALUES ('delete', OLD.%(key)s, %(old)s);
+                    INSERT INTO %(text)s(rowid, %(columns)s) VALUES (NEW.%(key)s, %(new)s);
+                END""" % d)
+            else:
+                # FTS4 reads the old text from the content table, so
+                # it must be removed before the row changes.
+                db.execute("""
+                CREATE TRIGGER %(text)s_delete BEFORE DELETE ON %(table)s
+                FOR EACH ROW BEGIN
+                    DELETE FROM %(text)s WHERE rowid = OLD.%(key)s;
+                END""" % d)
+                db.execute("""
+                CREATE TRIGGER %(text)s_update_old BEFORE UPDATE OF %(columns)s ON %(table)s
+                FOR EACH ROW BEGIN
+                    DELETE FROM %(text)s WHERE rowid = OLD.%(key)s;
+                END""" % d)
+                db.execute("""
+                CREATE TRIGGER %(text)s_update AFTER UPDATE OF %(columns)s ON %(table)s
+                FOR EACH ROW BEGIN
+                    INSERT INTO %(text)s(rowid, %(columns)s) VALUES (NEW.%(key)s, %(new)s);
+                END""" % d)
+            db.execute("INSERT INTO %(text)s(%(text)s) VALUES ('rebuild')" % d)
+        db.execute("""
+        CREATE TRIGGER program_text_delete AFTER DELETE ON program
+        FOR EACH ROW BEGIN
+            DELETE FROM program_text WHERE rowid = OLD.rowid;
+        END""")
+
+    def _text_index(self, db):
+        """Return the module of the repository's full-text indexes.
+
+        This is ``'fts5'``, ``'fts4'``, or ``None`` if the repository
+        has no full-text indexes, as set by :meth:`_add_text_index`.
+        """
+        row = db.execute("""select sql from sqlite_master
+                            where type='table' and name='file_text'""").fetchone()
+        if row == None:
+            return None
+        for module in ['fts5', 'fts4']:
+            if module in row[0].lower():
+                return module
+        return None
+
+    def _compress_program_output(self, db):
+        """Migration: move the output of programs into a compressed side table.
+
+        The stdout and stderr of programs made the program table, and
+        so every scan of it, very large.  They are now kept
+        zlib-compressed in program_output, and the columns in program
+        are left empty.  Run ``minilims vacuum`` afterwards to give
+        the space back to the filesystem.
+        """
+        db.execute("""
+        CREATE TABLE program_output (
+            execution integer,
+            pos integer,
+            stdout blob,
+            stderr blob,
+            primary key (execution, pos)
+        )""")
+        db.execute("""
+        CREATE TRIGGER delete_program_output AFTER DELETE ON program
+        FOR EACH ROW BEGIN
+            DELETE FROM program_output WHERE execution = OLD.execution AND pos = OLD.pos;
+        END""")
+        # Output which is not valid UTF-8 was stored all the same.
+        text_factory = db.text_factory
+        db.text_factory = str
+        try:
+            rows = db.execute("""select execution, pos, stdout, stderr from program
+                                 where stdout != '' or stderr != ''""")
+            while True:
+                batch = rows.fetchmany(1000)
+                if batch == []:
+                    break
+                db.executemany("""insert into program_output(execution,pos,stdout,stderr)
+                                  values (?,?,?,?)""",
+                               [(e, p, _compress_output(o or ""), _compress_output(r or ""))
+                                for (e, p, o, r) in batch])
+        finally:
+            db.text_factory = text_factory
+        # Programs of immutable executions cannot be updated, so lift
+        # that while emptying the columns.
+        db.execute("DROP TRIGGER prevent_command_update")
+        db.execute("""update program set stdout = null, stderr = null
+                      where stdout is not null or stderr is not null""")
+        db.execute("""
+        CREATE TRIGGER prevent_command_update BEFORE UPDATE ON program
+        FOR EACH ROW WHEN
+            (SELECT immutable_outputs FROM execution WHERE id = OLD.execution) > 0
+        BEGIN
+            SELECT RAISE(FAIL, 'Execution is immutable; cannot update commands.');
+        END
+        """)
+
+    migrations = [_add_blob_store, _add_settings, _add_indexes,
+                  _materialize_immutability, _add_text_index,
+                  _compress_program_output]
+
+    def _location(self, directory, name, layout=None):
+        """Return where the file called name belongs in directory.
+
+        directory is one of the repository's files, memopad, or blobs
+        directories.  layout defaults to the repository's layout.
+        """
+        if layout == None:
+            layout = self.layout
+        if layout == 'sharded':
+            h = hashlib.md5(name).hexdigest()
+            return os.path.join(directory, h[0:2], h[2:4], name)
+        else:
+            return os.path.join(directory, name)
 
-    def _copy_file_to_repository(self,src):
+    def _find(self, directory, name):
+        """Return the path of the existing file name in directory.
+
+        While a repository's layout is being changed, a file may still
+        be where the other layout would put it, so look there if it is
+        not where it should be.
+        """
+        path = self._location(directory, name)
+        if not(os.path.lexists(path)):
+            other_layout = self.layout == 'flat' and 'sharded' or 'flat'
+            other_path = self._location(directory, name, other_layout)
+            if os.path.lexists(other_path):
+                return other_path
+        return path
+
+    def _file_location(self, name):
+        """Return the path of the repository file with repository name name."""
+        return self._find(self.file_path, name)
+
+    def _memopad_location(self, name):
+        """Return the path of the memopad file name."""
+        return self._find(self.memopad_path, name)
+
+    def _blob_location(self, blob):
+        """Return the path of the blob with hash blob."""
+        return self._find(self.blob_path, blob)
+
+    def _reserve_name(self, directory, name=None):
+        """Reserve a new file name in directory (see _reserve_filename_in).
+
+        If name is given, reserve exactly that name, raising
+        ValueError if a file of that name already exists.
+        """
+        if name == None:
+            return _reserve_filename_in(directory,
+                                        lambda name: self._location(directory, name))
+        path = self._location(directory, name)
+        _make_parent_directory(path)
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666))
+        except OSError, ose:
+            if ose.errno == errno.EEXIST:
+                raise ValueError("There is already a file named %s in the repository." % name)
+            raise
+        return name
+
+    def set_layout(self, layout):
+        """Change the layout of the repository to *layout*.
+
+        *layout* is ``'flat'`` or ``'sharded'``.  All files in the
+        ``files``, ``memopad``, and ``blobs`` directories are moved to
+        where the new layout puts them.  The repository can be used
+        while this runs, including by other processes, since files are
+        looked for in both places until they have been moved.  Files
+        created by processes which opened the repository before the
+        change end up in the old layout, so run ``set_layout`` again
+        after they have finished.
+        """
+        if not(layout in ('flat', 'sharded')):
+            raise ValueError("Layout must be 'flat' or 'sharded', not %s" % layout)
+        with self._transaction() as db:
+            db.execute("""update setting set value=? where key='layout'""",
+                       (layout,))
+        self.layout = layout
+        other_layout = layout == 'flat' and 'sharded' or 'flat'
+        files = [(self.file_path, n) for (n,) in
+                 self.db.execute("select repository_name from file")] + \
+                [(self.memopad_path, n) for (n,) in
+                 self.db.execute("select filename from memopad")] + \
+                [(self.blob_path, n) for (n,) in
+                 self.db.execute("select hash from blob")]
+        for (directory, name) in files:
+            src = self._location(directory, name, other_layout)
+            dst = self._location(directory, name)
+            if os.path.lexists(src) and not(os.path.lexists(dst)):
+                _make_parent_directory(dst)
+                os.rename(src, dst)
+
+    def _copy_file_to_repository(self, src, repository_name=None, move=False):
         """Copy a file src into the MiniLIMS repository.
         
         src can be a fairly arbitrary path, either from the CWD, or
-        using .. and other such shortcuts.  This function should only
-        be called from SQLite3, not Python.
+        using .. and other such shortcuts.  Returns a tuple of the
+        repository name of the new file and the hash of the blob
+        holding its contents, or ``None`` in place of the hash if the
+        MiniLIMS is not content addressed.  The file gets a new,
+        random repository name unless repository_name is given.  If
+        move is ``True``, src is renamed into the repository instead
+        of copied where possible, and may be gone afterwards.
         """
-        filename = unique_filename_in(self.file_path)
-        shutil.copyfile(src,os.path.abspath(os.path.join(self.file_path,filename)))
-        return filename
+        filename = self._reserve_name(self.file_path, repository_name)
+        dst = os.path.abspath(self._file_location(filename))
+        try:
+            if self.content_addressed:
+                return (filename, self._store_blob(src, dst, move))
+            else:
+                if not(move and _move_file(src, dst)):
+                    fastcopy.copyfile(src,dst)
+                _make_read_only(dst)
+                return (filename, None)
+        except:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            raise
+
+    def _store_blob(self, src, dst, move=False):
+        """Put the contents of src at dst, in the blob store, and return their hash.
+
+        dst is linked to the blob with the same contents if there is
+        one, and nothing is copied.  Otherwise src is copied to dst,
+        or renamed there if move is ``True`` and it can be, and dst
+        becomes the blob.  The contents are always in dst, which the
+        caller owns, so a blob removed by another thread or process at
+        the same time never takes them away.
+        """
+        blob = _content_hash(src)
+        try:
+            self._link_blob(blob, dst)
+            return blob
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+        if not(move and _move_file(src, dst)):
+            fastcopy.copyfile(src, dst)
+        _make_read_only(dst)
+        blob_file = self._blob_location(blob)
+        _make_parent_directory(blob_file)
+        try:
+            os.link(dst, blob_file)
+        except OSError, ose:
+            if ose.errno == errno.EEXIST:
+                # Another writer stored the same contents meanwhile.
+                # dst stays a separate copy of them.
+                return blob
+            # The filesystem has no hard links.
+            (fd, tmp) = tempfile.mkstemp(dir=self.blob_path)
+            os.close(fd)
+            try:
+                fastcopy.copyfile(dst, tmp)
+                _make_read_only(tmp)
+                os.rename(tmp, blob_file)
+            except:
+                os.remove(tmp)
+                raise
+        return blob
+
+    def _link_blob(self, blob, dst):
+        """Make dst a hard link to the blob with hash blob.
+
+        dst may already exist, such as a name reserved with
+        _reserve_filename_in, in which case it is replaced at once,
+        so it is never missing.  Raises OSError or IOError with errno
+        ENOENT if there is no such blob.
+        """
+        blob_file = self._blob_location(blob)
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)))
+        os.close(fd)
+        os.remove(tmp)
+        try:
+            try:
+                os.link(blob_file, tmp)
+            except OSError, ose:
+                if ose.errno == errno.ENOENT:
+                    raise
+                # The blob has reached the filesystem's maximum number
+                # of links, or the filesystem has no hard links at all.
+                fastcopy.copyfile(blob_file, tmp)
+                _make_read_only(tmp)
+            os.rename(tmp, dst)
+        except:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _release_blob(self, blob):
+        """Drop the row of the blob with hash blob if no file refers to it anymore.
+
+        The blob itself is left for :meth:`_remove_unused_blob`, to be
+        called once the transaction this is part of has committed.
+        """
+        self.db.execute("delete from blob where hash=? and refcount<=0", (blob,))
+
+    def _remove_unused_blob(self, blob):
+        """Remove the blob with hash blob if nothing uses it.
+
+        A blob is used if a file in the database refers to it, or if
+        an entry of the files directory is linked to it, as when
+        another thread or process has stored the same contents and
+        not yet committed.  The blob is renamed out of the way before
+        its links are counted, so no one can link to it after that,
+        and it is put back if someone did before.  Returns the number
+        of bytes freed.
+        """
+        refcount = self.db.execute("select refcount from blob where hash=?",
+                                   (blob,)).fetchone()
+        if refcount != None and refcount[0] > 0:
+            return 0
+        blob_file = self._blob_location(blob)
+        (fd, tmp) = tempfile.mkstemp(dir=self.blob_path)
+        os.close(fd)
+        try:
+            os.rename(blob_file, tmp)
+        except OSError, ose:
+            os.remove(tmp)
+            if ose.errno == errno.ENOENT:
+                return 0
+            raise
+        st = os.stat(tmp)
+        if st.st_nlink > 1:
+            try:
+                os.link(tmp, blob_file)
+            except OSError, ose:
+                if ose.errno != errno.EEXIST:
+                    raise
+            os.remove(tmp)
+            return 0
+        os.remove(tmp)
+        return st.st_size
 
     def _delete_repository_file(self,filename):
         """Delete a file from the MiniLIMS repository.
 
         This function should only be called from SQLite3, not from Python.
         """
-        os.remove(os.path.join(self.file_path,filename))
+        os.remove(self._file_location(filename))
         return None
 
-    def _export_file_from_repository(self,fileid,dst):
+    def _export_file_from_repository(self,fileid,dst,staging,writable):
         """Write a file with id fileid to the directory dst.
 
-        This function should only be called from SQLite3, not Python.
+        staging and writable are as for _stage_file.  This function
+        should only be called from SQLite3, not Python.
         """
         if os.path.isdir(dst):
             filename = unique_filename_in(dst)
@@ -893,13 +2786,14 @@ class MiniLIMS(object):
         try:
             [repository_filename] = [x for (x,) in self.db.execute("select repository_name from file where id=?", 
                                                                    (fileid,))]
-            shutil.copyfile(os.path.abspath(os.path.join(self.file_path,repository_filename)),
-                            os.path.abspath(os.path.join(dst, filename)))
+            _stage_file(os.path.abspath(self._file_location(repository_filename)),
+                        os.path.abspath(os.path.join(dst, filename)),
+                        staging, writable)
             return filename
         except ValueError, v:
             return None
 
-    def write(self, ex, description = "", exception_string=None):
+    def write(self, ex, description = "", exception_string=None, move=False):
         """Write an execution to the MiniLIMS.
 
         The overall Execution object is recorded in the execution
@@ -910,120 +2804,481 @@ class MiniLIMS(object):
         added to the execution_use table.  Any files which were added
         to the repository are copied to the repository and entered in
         the file table.
+
+        If ex is journaled and was already recorded with
+        :meth:`journal`, its programs are already written, and its
+        record is only brought up to date.
+
+        If *move* is ``True``, files in ex's working directory added
+        only once are renamed into the repository instead of copied,
+        where the working directory is on the same filesystem.  They
+        are then gone from the working directory, so this is only for
+        executions which are finished with it, as :func:`execution`
+        does.
         """
-        self.db.execute("""insert into execution
-                           (started_at, finished_at, working_directory,
-                            description, exception) 
-                           values (?,?,?,?,?)""",
-                        (ex.started_at, ex.finished_at, ex.working_directory, 
-                         description, exception_string))
-        exid = self.db.execute("select last_insert_rowid()").fetchone()[0]
-
-        # Write all the programs
-        for i,p in enumerate(ex.programs):
-            if p.stdout == None:
-                stdout_value = ""
-            else:
-                stdout_value = "".join(p.stdout)
-            if p.stderr == None:
-                stderr_value = ""
+        # Copy the added files into the repository before taking the
+        # database's write lock, since copying can take a long time.
+        # Associated files are named from the files they are
+        # associated to, so a file's name is known only once its
+        # target's is, hence the order.  Files the execution already
+        # began copying are only waited for.  copies is keyed by the
+        # index of each file in ex.files, since a filename may be
+        # added more than once.
+        copies = {}
+        try:
+            order = self._association_order(ex.files)
+            last_added = self._last_added(ex.files)
+            # A file can only be moved if no other entry of ex.files
+            # names it, by the same filename or any other path.
+            sources = [os.path.realpath(os.path.join(ex.working_directory, f[0]))
+                       for f in ex.files]
+            added = {}
+            for src in sources:
+                added[src] = added.get(src, 0) + 1
+            working_directory = os.path.realpath(ex.working_directory) + os.sep
+            for i in order:
+                (filename, file_description, associate_to_id, associate_to_filename,
+                 template, alias) = ex.files[i]
+                if ex._imports.has_key(i):
+                    (target_index, future) = ex._imports.pop(i)
+                    if associate_to_filename == None or associate_to_id != None or \
+                            target_index == last_added[associate_to_filename]:
+                        copies[i] = future.wait()
+                        continue
+                    # The file it is associated to was added again
+                    # afterwards, so the copy has the wrong name.
+                    self._remove_copies({i: future.wait()})
+                if associate_to_id != None:
+                    target_name = self.db.execute("""select repository_name from file
+                                                     where id=?""",
+                                                  (self.resolve_alias(associate_to_id),)).fetchone()[0]
+                    repository_name = template % target_name
+                elif associate_to_filename != None:
+                    repository_name = template % copies[last_added[associate_to_filename]][0]
+                else:
+                    repository_name = None
+                src = os.path.abspath(os.path.join(ex.working_directory, filename))
+                movable = move and added[sources[i]] == 1 and \
+                    sources[i].startswith(working_directory)
+                copies[i] = self._copy_file_to_repository(src, repository_name,
+                                                          movable)
+        except:
+            (exc_type, exc_value, exc_traceback) = sys.exc_info()
+            for (i, (target_index, future)) in ex._imports.items():
+                try:
+                    self._remove_copies({i: future.wait()})
+                except Exception:
+                    pass
+            self._remove_copies(copies)
+            raise exc_type, exc_value, exc_traceback
+
+        try:
+            with self._transaction():
+                exid = self._write_records(ex, description, exception_string, copies)
+        except:
+            self._remove_copies(copies)
+            raise
+        return exid
+
+    def _association_order(self, files):
+        """Check the associations among files, and sort them.
+
+        files is a list of tuples as in ``Execution.files``.  Returns
+        the indices of the tuples in files, ordered so that every file
+        comes after the file it is associated to by filename.  If
+        several files were added with the same filename, associations
+        by that filename are to the last of them.  Raises ValueError
+        if an association has a bad template, names a file which was
+        not added, or the associations form a cycle.
+        """
+        added = self._last_added(files)
+        roots = []
+        children = {}
+        for (i, f) in enumerate(files):
+            (filename, description, associate_to_id, associate_to_filename,
+             template, alias) = f
+            if associate_to_id != None or associate_to_filename != None:
+                if template == None:
+                    raise ValueError("Must provide a template for an association.")
+                elif template == "%s":
+                    raise ValueError("Template must be more than just %s")
+                elif template.find("%s") == -1:
+                    raise ValueError("Template must contain %s")
+            if associate_to_filename != None and associate_to_id == None:
+                if not(added.has_key(associate_to_filename)):
+                    raise ValueError("File %s is associated to %s, which was not added." % \
+                                         (filename, associate_to_filename))
+                children.setdefault(added[associate_to_filename], []).append(i)
             else:
-                stderr_value = "".join(p.stderr)
-
-            self.db.execute("""insert into program(pos,execution,pid,
-                                                   return_code,stdout,stderr)
-                               values (?,?,?,?,?,?)""",
-                            (i, exid, p.pid, p.return_code,
-                             stdout_value, stderr_value))
-            for j,a in enumerate(p.arguments):
-                self.db.execute("""insert into argument(pos,program,execution,
-                                   argument) values (?,?,?,?)""",
-                                (j,i,exid,a))
-
-        # Write the files
-
-        # This section is rather complicated due to the necessity of
-        # handling hierarchies of associations correctly.  The
-        # algorithm is roughly as follows:
-
-        # remaining = files which have yet to be inserted
-        # removed = those files already processed
-        # while True:
-        #     these = all files to be processed this round,
-        #             defined as those whose associate_to_file field
-        #             (field 3 of the tuple) is in removed.
-        #     for file in these:
-        #         insert the file
-        #         add any alias
-        #         associate the file, renaming it so association namings are
-        #             preserved even in the repository
-
-        fileids = {}
-        removed = [(None,)]
-        remaining = ex.files
-        while remaining != []:
-            these = [k for k in ex.files if k[3] in [x[0] for x in removed]]
-
-            for (filename,description,associate_to_id,associate_to_filename,
-                 template,alias) in these:
-
-                fileids[filename] = self._insert_file(ex, exid, filename, description)
-
-                if alias != None:
-                    self.add_alias(fileids[filename], alias)
-
-                if associate_to_id != None or associate_to_filename != None:
-                    if template == None:
-                        raise ValueError("Must provide a template for an association.")
-                    elif template == "%s":
-                        raise ValueError("Template must be more than just %s")
-                    elif template.index("%s") == -1:
-                        raise ValueError("Template must contain %s")
-                    elif associate_to_id != None:
-                        self._associate_file(fileids[filename], associate_to_id, template)
-                    else:
-                        self._associate_file(fileids[filename], fileids[associate_to_filename], template)
+                roots.append(i)
+        order = roots
+        i = 0
+        while i < len(order):
+            order.extend(children.get(order[i], []))
+            i += 1
+        if len(order) != len(files):
+            ordered = set(order)
+            cycle = [f[0] for (i, f) in enumerate(files) if not(i in ordered)]
+            raise ValueError("Files %s are associated to each other in a cycle." % \
+                                 ", ".join(cycle))
+        return order
+
+    def _last_added(self, files):
+        """Map each filename in files to the index of the last file added with it."""
+        added = {}
+        for (i, f) in enumerate(files):
+            added[f[0]] = i
+        return added
+
+    def journal(self, ex, description=""):
+        """Record the running execution ex, and return its id.
+
+        Only the execution itself is recorded, with no finishing time.
+        ex should have *journal* set, so its programs are written as
+        it reports them, and it should be passed to :meth:`write` as
+        usual when it finishes.
+        """
+        with self._transaction() as db:
+            exid = db.execute("""insert into execution
+                                 (started_at, working_directory, description)
+                                 values (?,?,?)""",
+                              (ex.started_at, ex.working_directory,
+                               description)).lastrowid
+        return exid
 
-            [remaining.remove(t) for t in these]
-            removed.extend(these)
+    def _journal_program(self, exid, pos, program):
+        """Write program as the pos'th program of the journaled execution exid."""
+        with self._transaction():
+            self._write_programs(exid, [(pos, program)])
 
+    def _remove_copies(self, copies):
+        """Remove files copied into the repository for a write which failed.
 
-        for used_file in set(ex.used_files):
-            self.db.execute("""insert into execution_use(execution,file) 
-                               values (?,?)""", (exid,used_file))
-        self.db.commit()
+        copies maps to (repository_name, blob) pairs, as returned by
+        _copy_file_to_repository.  Blobs which were made for them, and
+        which nothing else uses, are removed as well.
+        """
+        for (repository_name, blob) in copies.itervalues():
+            path = self._file_location(repository_name)
+            if os.path.lexists(path):
+                os.remove(path)
+        for blob in set([b for (n, b) in copies.itervalues() if b != None]):
+            self._remove_unused_blob(blob)
+
+    def _write_records(self, ex, description, exception_string, copies):
+        """Insert the rows recording ex, without committing them.
+
+        copies maps the names of the files ex added to the
+        (repository_name, blob) pairs they were copied to.  All the
+        rows of each table are inserted with one executemany, and the
+        ids of the new files are assigned here instead of read back
+        one at a time.
+        """
+        if ex.journal and ex.id != None:
+            exid = ex.id
+            self.db.execute("""update execution set finished_at=?, description=?,
+                                                    exception=?
+                               where id=?""",
+                            (ex.finished_at, description, exception_string, exid))
+        else:
+            exid = self.db.execute("""insert into execution
+                                      (started_at, finished_at, working_directory,
+                                       description, exception)
+                                      values (?,?,?,?,?)""",
+                                   (ex.started_at, ex.finished_at, ex.working_directory,
+                                    description, exception_string)).lastrowid
+            self._write_programs(exid, list(enumerate(ex.programs)))
+
+        # Write the files.  The transaction holds the write lock, so
+        # no one else can take the ids after the largest one used.
+        last_fileid = self.db.execute("""select max(n) from
+                                         (select seq as n from sqlite_sequence
+                                          where name='file'
+                                          union all select max(id) from file)""").fetchone()[0] or 0
+        # The file added k'th gets id last_fileid + k + 1, and copies
+        # is keyed by k.
+        last_added = self._last_added(ex.files)
+        self.db.executemany("""insert into file(id,external_name,repository_name,
+                                                description,origin,origin_value,
+                                                blob)
+                               values (?,?,?,?,?,?,?)""",
+                            ((last_fileid + k + 1, f[0], copies[k][0],
+                              f[1], 'execution', exid, copies[k][1])
+                             for (k, f) in enumerate(ex.files)))
+        self.db.executemany("""insert into file_alias(alias,file) values (?,?)""",
+                            ((f[5], last_fileid + k + 1)
+                             for (k, f) in enumerate(ex.files) if f[5] != None))
+
+        def association_row(k, f):
+            (filename, description, associate_to_id, associate_to_filename,
+             template, alias) = f
+            if associate_to_id != None:
+                return (last_fileid + k + 1, self.resolve_alias(associate_to_id), template)
+            else:
+                return (last_fileid + k + 1,
+                        last_fileid + last_added[associate_to_filename] + 1, template)
+        self.db.executemany("""insert into file_association(fileid,associated_to,template)
+                               values (?,?,?)""",
+                            [association_row(k, f) for (k, f) in enumerate(ex.files)
+                             if f[2] != None or f[3] != None])
+
+        self.db.executemany("""insert into execution_use(execution,file)
+                               values (?,?)""",
+                            ((exid,used_file) for used_file in set(ex.used_files)))
         return exid
 
-    def _insert_file(self, ex, exid, filename, description):
-        self.db.execute("""insert into file(external_name,repository_name,
-                                            description,origin,origin_value) 
-                           values (?,importfile(?),?,?,?)""",
-                        (filename,
-                         os.path.abspath(os.path.join(ex.working_directory,filename)),
-                         description, 'execution', exid))
-        return self.db.execute("""select last_insert_rowid()""").fetchone()[0]
-
-    def _rename_in_repository(self, fileid, new_repository_name):
-        old_target_name = self.db.execute("""select repository_name from file
-                                             where id=?""", (fileid,)).fetchone()[0]
-        self.db.execute("""drop trigger prevent_repository_name_change""")
-        self.db.execute("""update file set repository_name=? where id=?""",
-                        (new_repository_name, fileid))
-        self.db.execute("""CREATE TRIGGER prevent_repository_name_change
-                           BEFORE UPDATE ON file
-                           FOR EACH ROW WHEN (OLD.repository_name != NEW.repository_name) BEGIN
-                           SELECT RAISE(FAIL, 'Cannot change the repository name of a file.');
-                           END""")
-        shutil.move(os.path.join(self.file_path, old_target_name),
-                    os.path.join(self.file_path, new_repository_name))
-
-    def _associate_file(self, thisid, targetid, template):
-        # Make the filename in the repository match this association
-        raw_name = self.db.execute("""select repository_name from file where id=?""", 
-                                   (targetid,)).fetchone()[0]
-        new_target_name = template % raw_name
-        self._rename_in_repository(thisid, new_target_name)
-        self.associate_file(thisid, targetid, template)
+    def _write_programs(self, exid, programs):
+        """Insert the rows recording programs in execution exid.
+
+        programs is a list of pairs of a position and a ProgramOutput,
+        in increasing order of position, and after any programs of
+        exid already written.
+        """
+        # Their output is stored compressed in program_output, with
+        # no row for programs with no output.
+        outputs = []
+        for (i,p) in programs:
+            stdout_value = p.stdout_bytes or ""
+            stderr_value = p.stderr_bytes or ""
+            if stdout_value != "" or stderr_value != "":
+                outputs.append((i, stdout_value, stderr_value))
+        self.db.executemany("""insert into program(pos,execution,pid,return_code)
+                               values (?,?,?,?)""",
+                            ((i, exid, p.pid, p.return_code) for (i,p) in programs))
+        self.db.executemany("""insert into program_output(execution,pos,stdout,stderr)
+                               values (?,?,?,?)""",
+                            ((exid, i, _compress_output(o), _compress_output(e))
+                             for (i, o, e) in outputs))
+        self.db.executemany("""insert into argument(pos,program,execution,
+                               argument) values (?,?,?,?)""",
+                            ((j,i,exid,a) for (i,p) in programs
+                             for j,a in enumerate(p.arguments)))
+        if programs == []:
+            return
+        if self.text_index == None:
+            return
+        first = programs[0][0]
+        self.db.execute("""insert into argument_text(rowid, argument)
+                           select rowid, argument from argument
+                           where execution=? and program>=?""", (exid, first))
+        if self.index_output:
+            rowids = dict(self.db.execute("""select pos, rowid from program
+                                             where execution=? and pos>=?""",
+                                          (exid, first)).fetchall())
+            # Output is usually raw bytes, which SQLite only takes as
+            # text once decoded.
+            self.db.executemany("""insert into program_text(rowid, stdout, stderr)
+                                   values (?,?,?)""",
+                                ((rowids[i], _output_text(o), _output_text(e))
+                                 for (i, o, e) in outputs))
+
+    def _where(self, criteria):
+        """Build a WHERE clause from the criteria which are not None.
+
+        criteria is a list of pairs of an SQL condition and the tuple
+        of values for its placeholders.  Conditions whose first value
+        is None are left out, so SQLite can use indexes for the
+        others.  Returns the clause and the list of values.
+        """
+        clauses = ["1"]
+        values = []
+        for (clause, params) in criteria:
+            if params[0] != None:
+                clauses.append(clause)
+                values.extend(params)
+        return (" and ".join(clauses), values)
+
+    def _text_query(self, text, tables):
+        """Return the full-text query to search the tables for text.
+
+        text is used as a full-text query if it is one for each of the
+        tables, so that prefix (``bowtie*``) and phrase (``"chr1
+        chr2"``) queries and boolean operators work.  If it is not,
+        such as a file name with punctuation in it, it is searched for
+        as a phrase instead.
+        """
+        try:
+            for table in tables:
+                self.db.execute("select rowid from %s where %s match ? limit 1" % \
+                                    (table, table), (text,))
+            return text
+        except sqlite3.OperationalError:
+            return '"' + text.replace('"', '""') + '"'
+
+    def _like_pattern(self, text):
+        """Return the LIKE pattern to search for text without full-text indexes.
+
+        Quotes are dropped, and ``*`` matches anything, as in a
+        full-text query.  The pattern is to be used with ``escape
+        '\\'``.
+        """
+        for c in '\\%_':
+            text = text.replace(c, '\\' + c)
+        return '%' + text.replace('"', '').replace('*', '%') + '%'
+
+    def _file_query(self, with_text, with_description, older_than, newer_than, source):
+        """Return SQL selecting the id and rank of files matching the criteria.
+
+        The criteria are those of search_files.  Returns the SQL and
+        the list of values for its placeholders.
+        """
+        if not(isinstance(source, tuple)):  # If source is not a tuple,
+            source = (source,None)          # make it be a tuple.
+        source = source != None and source or (None,None)
+        (where, values) = self._where([("file.description like ?", (with_description,)),
+                                       ("file.created >= ?", (newer_than,)),
+                                       ("file.created <= ?", (older_than,)),
+                                       ("file.origin = ?", (source[0],)),
+                                       ("file.origin_value = ?", (source[1],))])
+        if with_text == None:
+            return ("select file.id as id, 0 as rank from file where " + where, values)
+        elif self.text_index == None:
+            pattern = self._like_pattern(with_text)
+            return ("""select file.id as id, 0 as rank from file
+                       where (file.external_name like ? escape '\\'
+                              or file.description like ? escape '\\') and """ + where,
+                    [pattern, pattern] + values)
+        else:
+            rank = self.text_index == 'fts5' and "file_text.rank" or "0"
+            return ("""select file.id as id, %s as rank from file_text
+                       join file on file.id = file_text.rowid
+                       where file_text match ? and """ % rank + where,
+                    [self._text_query(with_text, ['file_text'])] + values)
+
+    def _execution_query(self, with_text, started_before, started_after,
+                         ended_before, ended_after):
+        """Return SQL selecting the id and rank of executions matching the criteria.
+
+        The criteria are those of search_executions.  Returns the SQL
+        and the list of values for its placeholders.
+        """
+        (where, values) = self._where([("execution.started_at <= ?", (started_before,)),
+                                       ("execution.started_at >= ?", (started_after,)),
+                                       ("execution.finished_at <= ?", (ended_before,)),
+                                       ("execution.finished_at >= ?", (ended_after,))])
+        if with_text == None:
+            return ("select execution.id as id, 0 as rank from execution where " + where,
+                    values)
+        elif self.text_index == None:
+            return ("""
+                select execution.id as id, 0 as rank from execution
+                where (execution.description like ?1 escape '\\'
+                       or execution.id in (select execution from argument
+                                           where argument like ?1 escape '\\'))
+                and """ + where,
+                    [self._like_pattern(with_text)] + values)
+        else:
+            # The same query is matched against each table, so reuse
+            # its placeholder with ?1.  The plain ? placeholders after
+            # it are numbered from 2 on.
+            tables = ['execution_text', 'argument_text', 'program_text']
+            rank = dict([(t, self.text_index == 'fts5' and t + ".rank" or "0")
+                         for t in tables])
+            return ("""
+                select execution.id as id, min(matches.rank) as rank from
+                    (select rowid as id, %(execution_text)s as rank from execution_text
+                     where execution_text match ?1
+                     union all
+                     select argument.execution as id, %(argument_text)s as rank
+                     from argument_text join argument
+                     on argument.rowid = argument_text.rowid
+                     where argument_text match ?1
+                     union all
+                     select program.execution as id, %(program_text)s as rank
+                     from program_text join program
+                     on program.rowid = program_text.rowid
+                     where program_text match ?1) as matches
+                join execution on execution.id = matches.id
+                where """ % rank + where + """
+                group by execution.id""",
+                    [self._text_query(with_text, tables)] + values)
+
+    def _iter_ids(self, query, order, after_id, limit, batch_size):
+        """Yield the ids selected by query, a pair as from _file_query.
+
+        The ids are fetched batch_size at a time, each batch with its
+        own statement which picks up after the last id of the one
+        before, so the caller may write to the MiniLIMS between ids.
+        """
+        (sql, values) = query
+        if order == 'id':
+            after = "id > ?"
+            order_by = "id asc"
+        elif order == '-id':
+            after = "id < ?"
+            order_by = "id desc"
+        elif order == 'rank':
+            if after_id != None:
+                raise ValueError("after_id can only be used when ordering by id.")
+            after = "(rank > ? or (rank = ? and id > ?))"
+            order_by = "rank asc, id asc"
+        else:
+            raise ValueError("order must be 'id', '-id', or 'rank', not %s" % order)
+        last = after_id
+        n = 0
+        while limit == None or n < limit:
+            size = batch_size
+            if limit != None:
+                size = min(size, limit - n)
+            if last == None:
+                batch_sql = "select id, rank from (%s) order by %s limit ?" % (sql, order_by)
+                batch_values = values + [size]
+            elif order == 'rank':
+                batch_sql = "select id, rank from (%s) where %s order by %s limit ?" % \
+                    (sql, after, order_by)
+                batch_values = values + [last[1], last[1], last[0], size]
+            else:
+                batch_sql = "select id, rank from (%s) where %s order by %s limit ?" % \
+                    (sql, after, order_by)
+                batch_values = values + [last, size]
+            rows = self.db.execute(batch_sql, batch_values).fetchall()
+            for (i, rank) in rows:
+                yield i
+            n += len(rows)
+            if len(rows) < size:
+                return
+            if order == 'rank':
+                last = rows[-1]
+            else:
+                last = rows[-1][0]
+
+    def iter_files(self, with_text=None, with_description=None, older_than=None,
+                   newer_than=None, source=None, order='id', after_id=None,
+                   limit=None, batch_size=1000):
+        """Iterate over the ids of files matching the given criteria.
+
+        The criteria are the same as for :meth:`search_files`, but
+        instead of a list, ``iter_files`` returns a generator, which
+        reads the ids from the database *batch_size* at a time, so
+        any number of files can be gone through in constant memory.
+        The MiniLIMS may be changed while iterating, such as to
+        delete each file as it comes.
+
+        *order* is ``'id'`` (the default) for increasing file ids,
+        ``'-id'`` for decreasing ones, or ``'rank'`` for the best
+        matches of *with_text* first.  When ordering by id, iteration
+        starts after the file id *after_id* if it is given, so a long
+        list can be shown a page at a time by passing the last id of
+        each page as *after_id* for the next.  At most *limit* ids
+        are returned if it is given.
+        """
+        return self._iter_ids(self._file_query(with_text, with_description,
+                                               older_than, newer_than, source),
+                              order, after_id, limit, batch_size)
+
+    def iter_executions(self, with_text=None, started_before=None, started_after=None,
+                        ended_before=None, ended_after=None, order='id',
+                        after_id=None, limit=None, batch_size=1000):
+        """Iterate over the ids of executions matching the given criteria.
+
+        The criteria are the same as for :meth:`search_executions`.
+        *order*, *after_id*, *limit*, and *batch_size* are as for
+        :meth:`iter_files`.
+        """
+        return self._iter_ids(self._execution_query(with_text, started_before,
+                                                    started_after, ended_before,
+                                                    ended_after),
+                              order, after_id, limit, batch_size)
 
     def search_files(self, with_text=None, with_description=None, older_than=None, newer_than=None, source=None):
         """Find files matching given criteria in the LIMS.
@@ -1032,7 +3287,14 @@ class MiniLIMS(object):
         The criteria are:
 
            * *with_text*: The file's external_name or description
-             contains *with_text*
+             contains the words in *with_text*.  *with_text* is a
+             SQLite full-text query, so it may contain prefixes such
+             as ``bowtie*``, phrases in double quotes, and ``AND``,
+             ``OR``, and ``NOT``.  Files are returned with the best
+             matches first.
+
+           * *with_description*: The file's description matches the
+             SQL ``LIKE`` pattern *with_description*.
 
            * *older_than*: The file's created time is earlier than
              *older_than*.  This should be of the form "YYYY-MM-DD
@@ -1048,25 +3310,14 @@ class MiniLIMS(object):
              ``exid`` is the numeric ID of the execution that created
              this file, and ``srcid`` is the file ID of the file which
              was copied to create this one.
+
+        To go through a large number of files without building a
+        list of them, use :meth:`iter_files`.
         """
-        if not(isinstance(source, tuple)):  # If source is not a tuple,
-            source = (source,None)          # make it be a tuple.
-        source = source != None and source or (None,None)
-        with_text = with_text != None and '%' + with_text + '%' or None
-        sql = """select id from file where ((external_name like ? or ? is null) or (description like ? or ? is null))
-                                          and (description like ? or ? is null)
-                                          and (created >= ? or ? is null)
-                                          and (created <= ? or ? is null)
-                                          and (origin = ? or ? is null)
-                                          and (origin_value = ? or ? is null)"""
-        matching_files = self.db.execute(sql, (with_text, with_text,
-                                               with_text, with_text,
-                                               with_description, with_description,
-                                               newer_than, newer_than,
-                                               older_than, older_than,
-                                               source[0], source[0],
-                                               source[1], source[1]))
-        return [x for (x,) in matching_files]
+        (sql, values) = self._file_query(with_text, with_description,
+                                         older_than, newer_than, source)
+        return [x for (x,) in self.db.execute("select id from (%s) order by rank, id" % sql,
+                                              values)]
 
     def search_executions(self, with_text=None, started_before=None,
                           started_after=None, ended_before=None, ended_after=None):
@@ -1076,7 +3327,12 @@ class MiniLIMS(object):
         all the criteria which are not None.  The criteria are:
 
            * *with_text*: The execution's description or one of the
-             program arguments in the execution contains *with_text*.
+             program arguments in the execution contains the words in
+             *with_text*, which is a full-text query as for
+             :meth:`search_files`.  If the MiniLIMS was opened with
+             *index_output*, the output of its programs is searched
+             as well.  Executions are returned with the best matches
+             first.
 
            * *started_before*: The execution started running before
              *start_before*.  This should be of the form "YYYY:MM:DD
@@ -1094,35 +3350,14 @@ class MiniLIMS(object):
            * *ended_after*: The execution finished running after
              *ended_after*.  The format is the same as for
              *started_before*.
+
+        To go through a large number of executions without building
+        a list of them, use :meth:`iter_executions`.
         """
-        with_text = with_text != None and '%'+with_text+'%' or None
-        sql = """select id from execution where 
-                 (started_at <= ? or ? is null) and 
-                 (started_at >= ? or ? is null) and
-                 (finished_at <= ? or ? is null) and 
-                 (finished_at >= ? or ? is null) and
-                 (description like ? or ? is null)
-              """
-        matching_executions = [x for (x,) in 
-                               self.db.execute(sql, 
-                                               (started_before,
-                                                started_before,
-                                                started_after,
-                                                started_after,
-                                                ended_before,
-                                                ended_before,
-                                                ended_after, 
-                                                ended_after,
-                                                with_text,
-                                                with_text))]
-        if with_text != None:
-            sql = """select distinct execution from argument
-                     where argument like ?"""
-            matching_programs = [x for (x,) in 
-                                 self.db.execute(sql, (with_text,))]
-        else:
-            matching_programs = []
-        return list(set(matching_executions+matching_programs))
+        (sql, values) = self._execution_query(with_text, started_before,
+                                              started_after, ended_before, ended_after)
+        return [x for (x,) in self.db.execute("select id from (%s) order by rank, id" % sql,
+                                              values)]
 
     def last_id(self):
         """Return the id of the last thing written to the repository."""
@@ -1130,88 +3365,150 @@ class MiniLIMS(object):
 
     def fetch_file(self, id_or_alias):
         """Returns a dictionary describing the given file."""
-        fileid = self.resolve_alias(id_or_alias)
-        fields = self.db.execute("""select external_name, repository_name,
-                                    created, description, origin, origin_value
-                                    from file where id=?""", 
-                                 (fileid,)).fetchone()
-        if fields == None:
-            raise ValueError("No such file " + str(id_or_alias) + " in MiniLIMS.")
-        else:
-            [external_name, repository_name, created, description,
-             origin_type, origin_value] = fields
-        if origin_type == 'copy':
-            origin = ('copy',origin_value)
-        elif origin_type == 'execution':
-            origin = ('execution',origin_value)
-        elif origin_type == 'import':
-            origin = 'import'
-        aliases = [a for (a,) in 
-                   self.db.execute("select alias from file_alias where file=?",
-                                   (fileid,))]
-        associations = self.db.execute("""select fileid,template from file_association where
-                                          associated_to=?""", (fileid,)).fetchall()
-        associated_to = self.db.execute("""select associated_to,template from file_association
-                                           where fileid=?""", (fileid,)).fetchall()
-        immutable = self.db.execute("select immutable from file_immutability where id=?",
-                                    (fileid,)).fetchone()[0]
-        return {'external_name': external_name,
-                'repository_name': repository_name,
-                'created': created,
-                'description': description,
-                'origin': origin,
-                'aliases': aliases,
-                'associations': associations,
-                'associated_to': associated_to,
-                'immutable': immutable == 1}
- 
-    
+        return self.fetch_files([id_or_alias])[0]
+
+    def fetch_files(self, ids_or_aliases):
+        """Returns a list of dictionaries describing the given files.
+
+        ``fetch_files(ids)`` returns the same as ``[fetch_file(i) for
+        i in ids]``, but looks up the files together in a few queries
+        for every 500 of them, instead of several queries per file.
+        """
+        ids_or_aliases = list(ids_or_aliases)
+        fileids = []
+        for i in ids_or_aliases:
+            if isinstance(i, int):
+                fileids.append(i)
+            else:
+                fileids.append(self.resolve_alias(i))
+        files = {}
+        for chunk in _chunks(fileids, 500):
+            marks = ",".join("?" * len(chunk))
+            for (fileid, external_name, repository_name, created, description,
+                 origin_type, origin_value, immutable) in \
+                    self.db.execute("""select id, external_name, repository_name,
+                                       created, description, origin, origin_value,
+                                       immutable
+                                       from file where id in (%s)""" % marks, chunk):
+                if origin_type == 'copy':
+                    origin = ('copy',origin_value)
+                elif origin_type == 'execution':
+                    origin = ('execution',origin_value)
+                elif origin_type == 'import':
+                    origin = 'import'
+                files[fileid] = {'external_name': external_name,
+                                 'repository_name': repository_name,
+                                 'created': created,
+                                 'description': description,
+                                 'origin': origin,
+                                 'aliases': [],
+                                 'associations': [],
+                                 'associated_to': [],
+                                 'immutable': immutable == 1}
+            for (fileid, alias) in \
+                    self.db.execute("""select file, alias from file_alias
+                                       where file in (%s) order by rowid""" % marks, chunk):
+                files[fileid]['aliases'].append(alias)
+            for (fileid, associated_to, template) in \
+                    self.db.execute("""select fileid, associated_to, template
+                                       from file_association
+                                       where associated_to in (%s) or fileid in (%s)
+                                       order by id""" % (marks, marks), chunk + chunk):
+                if files.has_key(associated_to):
+                    files[associated_to]['associations'].append((fileid, template))
+                if files.has_key(fileid):
+                    files[fileid]['associated_to'].append((associated_to, template))
+        result = []
+        for (i, fileid) in zip(ids_or_aliases, fileids):
+            if not(files.has_key(fileid)):
+                raise ValueError("No such file " + str(i) + " in MiniLIMS.")
+            # Each file gets its own dictionary, even if asked for twice.
+            f = dict(files[fileid])
+            for k in ['aliases', 'associations', 'associated_to']:
+                f[k] = list(f[k])
+            result.append(f)
+        return result
+
     def fetch_execution(self, exid):
         """Returns a dictionary of all the data corresponding to the given execution id."""
-        def fetch_program(exid, progid):
-            fields = self.db.execute("""select pid,return_code,stdout,stderr
-                                        from program where execution=? and pos=?""",
-                                     (exid, progid)).fetchone()
-            if fields == None:
-                raise ValueError("No such program: execution %d, program %d" % (exid, progid))
+        return self.fetch_executions([exid])[0]
+
+    def fetch_executions(self, exids, lazy=False):
+        """Returns a list of dictionaries describing the given executions.
+
+        ``fetch_executions(exids)`` returns the same as
+        ``[fetch_execution(i) for i in exids]``, but looks up the
+        executions together in a few queries for every 500 of them,
+        instead of several queries for each program of each one.
+
+        If *lazy* is ``True``, the ``stdout`` and ``stderr`` of each
+        program, which can be large, are only read from the database
+        when they are looked up in its dictionary.
+        """
+        exids = list(exids)
+        executions = {}
+        for chunk in _chunks(exids, 500):
+            marks = ",".join("?" * len(chunk))
+            for (exid, started_at, finished_at, working_directory, description,
+                 exception, immutable) in \
+                    self.db.execute("""select id, started_at, finished_at,
+                                       working_directory, description, exception,
+                                       immutable_outputs > 0
+                                       from execution where id in (%s)""" % marks, chunk):
+                executions[exid] = {'started_at': started_at,
+                                    'finished_at': finished_at,
+                                    'working_directory': working_directory,
+                                    'description': description,
+                                    'exception_string': exception,
+                                    'programs': [],
+                                    'added_files': [],
+                                    'used_files': [],
+                                    'immutable': immutable == 1}
+            if lazy:
+                sql = """select execution, pos, pid, return_code, null, null
+                         from program where execution in (%s)
+                         order by execution, pos"""
             else:
-                [pid, return_code, stdout, stderr] = fields
-            arguments = [a for (a,) in self.db.execute("""select argument from argument
-                                                          where execution=? and program=?
-                                                          order by pos asc""", (exid,progid))]
-            return {'pid': pid,
-                    'return_code': return_code,
-                    'stdout': stdout,
-                    'stderr': stderr,
-                    'arguments': arguments}
-        exfields = self.db.execute("""select started_at, finished_at, working_directory,
-                                           description, exception from execution
-                                    where id=?""", (exid,)).fetchone()
-        if exfields == None:
-            raise ValueError("No such execution with id %d" % (exid,))
-        else:
-            (started_at,finished_at,working_directory,
-             description, exception) = exfields
-        progids = [a for (a,) in self.db.execute("""select pos from program where execution=?
-                                                  order by pos asc""", (exid,))]
-        progs = [fetch_program(exid,i) for i in progids]
-        added_files = [a for (a,) in self.db.execute("""select id from file where
-                                                        origin='execution' and origin_value=?""",
-                                                     (exid,))]
-        used_files = [a for (a,) in self.db.execute("""select file from execution_use
-                                                       where execution=?""", (exid,))]
-        immutability = self.db.execute("""select immutable from execution_immutability
-            where id=?""", (exid,)).fetchone()[0]
-            
-        return {'started_at': started_at,
-                'finished_at': finished_at,
-                'working_directory': working_directory,
-                'description': description,
-                'exception_string': exception,
-                'programs': progs,
-                'added_files': added_files,
-                'used_files': used_files,
-                'immutable': immutability == 1}
+                sql = """select p.execution, p.pos, p.pid, p.return_code,
+                                o.stdout, o.stderr
+                         from program as p left join program_output as o
+                         on o.execution = p.execution and o.pos = p.pos
+                         where p.execution in (%s)
+                         order by p.execution, p.pos"""
+            programs = {}
+            for (exid, pos, pid, return_code, stdout, stderr) in \
+                    self.db.execute(sql % marks, chunk):
+                p = {'pid': pid,
+                     'return_code': return_code,
+                     'arguments': []}
+                if lazy:
+                    p = _LazyProgram(self, exid, pos, p)
+                else:
+                    p['stdout'] = _decompress_output(stdout)
+                    p['stderr'] = _decompress_output(stderr)
+                programs[(exid, pos)] = p
+                executions[exid]['programs'].append(p)
+            for (exid, pos, argument) in \
+                    self.db.execute("""select execution, program, argument
+                                       from argument where execution in (%s)
+                                       order by execution, program, pos""" % marks, chunk):
+                programs[(exid, pos)]['arguments'].append(argument)
+            for (exid, fileid) in \
+                    self.db.execute("""select origin_value, id from file
+                                       where origin='execution' and origin_value in (%s)
+                                       order by id""" % marks, chunk):
+                executions[exid]['added_files'].append(fileid)
+            for (exid, fileid) in \
+                    self.db.execute("""select execution, file from execution_use
+                                       where execution in (%s)
+                                       order by rowid""" % marks, chunk):
+                executions[exid]['used_files'].append(fileid)
+        result = []
+        for exid in exids:
+            if not(executions.has_key(exid)):
+                raise ValueError("No such execution with id %d" % (exid,))
+            result.append(executions[exid])
+        return result
 
     def copy_file(self, file_or_alias):
         """Copy the given file in the MiniLIMS repository.
@@ -1223,22 +3520,30 @@ class MiniLIMS(object):
         """
         fileid = self.resolve_alias(file_or_alias)
         try:
-            sql = """select external_name,repository_name,description 
+            sql = """select external_name,repository_name,description,blob
                      from file where id = ?"""
             [(external_name, 
               repository_name, 
-              description)] = [x for x in self.db.execute(sql, (fileid, ))]
-            new_repository_name = unique_filename_in(self.file_path)
+              description,
+              blob)] = [x for x in self.db.execute(sql, (fileid, ))]
+            if blob != None and self.content_addressed:
+                new_repository_name = self._reserve_name(self.file_path)
+                self._link_blob(blob, self._file_location(new_repository_name))
+            else:
+                (new_repository_name, blob) = self._copy_file_to_repository(
+                    self._file_location(repository_name))
             sql = """insert into file(external_name,repository_name,
-                                      origin,origin_value) values (?,?,?,?)"""
-            [x for x in self.db.execute(sql, (external_name, 
-                                              new_repository_name, 
-                                              'copy', fileid))]
-            [new_id] = [x for (x,) in 
-                        self.db.execute("select last_insert_rowid()")]
-            shutil.copyfile(os.path.join(self.file_path, repository_name),
-                            os.path.join(self.file_path, new_repository_name))
-            self.db.commit()
+                                      origin,origin_value,blob) values (?,?,?,?,?)"""
+            try:
+                with self._transaction() as db:
+                    [x for x in db.execute(sql, (external_name, 
+                                                 new_repository_name, 
+                                                 'copy', fileid, blob))]
+                    [new_id] = [x for (x,) in 
+                                db.execute("select last_insert_rowid()")]
+            except:
+                self._remove_copies({0: (new_repository_name, blob)})
+                raise
             return new_id
         except ValueError, v:
             raise ValueError("No such file id " + str(fileid))
@@ -1252,14 +3557,18 @@ class MiniLIMS(object):
                     self.delete_file(f)
             except ValueError, v:
                 pass
-            sql = "select repository_name from file where id = ?"
-            [repository_name] = [x for (x,) in self.db.execute(sql, (fileid,))]
-            sql = "delete from file where id = ?"
-            [x for (x,) in self.db.execute(sql, (fileid, ))]
-            os.remove(os.path.join(self.file_path, repository_name))
-            sql = "delete from file_alias where file=?"
-            self.db.execute(sql, (fileid,)).fetchone()
-            self.db.commit()
+            with self._transaction() as db:
+                sql = "select repository_name, blob from file where id = ?"
+                [(repository_name, blob)] = [x for x in db.execute(sql, (fileid,))]
+                sql = "delete from file where id = ?"
+                [x for (x,) in db.execute(sql, (fileid, ))]
+                if blob != None:
+                    self._release_blob(blob)
+                sql = "delete from file_alias where file=?"
+                db.execute(sql, (fileid,)).fetchone()
+            os.remove(self._file_location(repository_name))
+            if blob != None:
+                self._remove_unused_blob(blob)
         except ValueError:
             raise ValueError("No such file id " + str(fileid))
 
@@ -1272,15 +3581,15 @@ class MiniLIMS(object):
                     self.delete_file(i)
                 except ValueError, v:
                     pass
-            self.db.execute("delete from argument where execution = ?",
-                            (execution_id,))
-            self.db.execute("delete from program where execution = ?", 
-                            (execution_id,))
-            self.db.execute("delete from execution where id = ?", 
-                            (execution_id,))
-            self.db.execute("delete from execution_use where execution=?",
-                            (execution_id,))
-            self.db.commit()
+            with self._transaction() as db:
+                db.execute("delete from argument where execution = ?",
+                           (execution_id,))
+                db.execute("delete from program where execution = ?", 
+                           (execution_id,))
+                db.execute("delete from execution where id = ?", 
+                           (execution_id,))
+                db.execute("delete from execution_use where execution=?",
+                           (execution_id,))
         except ValueError, v:
             raise ValueError("No such execution id " + str(execution_id) + ": " + v.message)
 
@@ -1292,14 +3601,68 @@ class MiniLIMS(object):
         the file in the repository.  ``import_file`` returns the file id
         in the repository of the newly imported file.
         """
-        self.db.execute("""insert into file(external_name,repository_name,
-                                            description,origin,origin_value)
-                           values (?,importfile(?),?,?,?)""",
-                        (os.path.basename(src),os.path.abspath(src),
-                         description,'import',None))
-        self.db.commit()
-        return [x for (x,) in 
-                self.db.execute("""select last_insert_rowid()""")][0]
+        return self.import_files([src], [description])[0]
+
+    def import_files(self, srcs, descriptions=None, aliases=None):
+        """Add the external files *srcs* to the MiniLIMS repository.
+
+        ``import_files(srcs)`` returns the same as ``[import_file(s)
+        for s in srcs]``, but copies up to ``import_threads`` files at
+        once, and records them all in one transaction.  Either all of
+        the files are imported, or, if any of them fails, none are.
+
+        *descriptions*, if given, is a list of strings to attach to
+        each file, and *aliases* a list of an alias or ``None`` for
+        each file.
+        """
+        if descriptions == None:
+            descriptions = [""] * len(srcs)
+        if aliases == None:
+            aliases = [None] * len(srcs)
+        if len(descriptions) != len(srcs) or len(aliases) != len(srcs):
+            raise ValueError("import_files needs as many descriptions and aliases as files.")
+        pool = _WorkerPool(self.import_threads)
+        futures = []
+        for src in srcs:
+            f = Future()
+            def job(f=f, src=os.path.abspath(src)):
+                try:
+                    f._finish(self._copy_file_to_repository(src))
+                except Exception, e:
+                    f._finish(exception=e)
+            pool.submit(job)
+            futures.append(f)
+        pool.shutdown()
+        copies = {}
+        errors = []
+        for (i, f) in enumerate(futures):
+            try:
+                copies[i] = f.wait()
+            except Exception, e:
+                errors.append(e)
+        if errors != []:
+            self._remove_copies(copies)
+            raise errors[0]
+
+        try:
+            with self._transaction() as db:
+                fileids = []
+                for (i, src) in enumerate(srcs):
+                    (repository_name, blob) = copies[i]
+                    fileids.append(
+                        db.execute("""insert into file(external_name,repository_name,
+                                                       description,origin,origin_value,
+                                                       blob)
+                                      values (?,?,?,?,?,?)""",
+                                   (os.path.basename(src), repository_name,
+                                    descriptions[i], 'import', None, blob)).lastrowid)
+                db.executemany("""insert into file_alias(alias,file) values (?,?)""",
+                               ((a, fileids[i]) for (i, a) in enumerate(aliases)
+                                if a != None))
+        except:
+            self._remove_copies(copies)
+            raise
+        return fileids
         
     def export_file(self, file_or_alias, dst, with_associated=False):
         """Write *file_or_alias* from the MiniLIMS repository to *dst*.
@@ -1311,7 +3674,7 @@ class MiniLIMS(object):
         Associated files will also be copied if *with_associated=True*.
         """
         src = self.path_to_file(file_or_alias)
-        shutil.copy(src, dst) 
+        _export_copy(src, dst)
         if with_associated:
             if os.path.isdir(dst):
                 dst = os.path.join(dst, self.fetch_file(file_or_alias)['repository_name'])
@@ -1319,7 +3682,43 @@ class MiniLIMS(object):
                 fileid = association[0]
                 template = association[1][2:] #removes %s
                 dst = dst + template
-                shutil.copy(src,dst)
+                _export_copy(src,dst)
+
+    def deduplicate(self):
+        """Move every file of the repository into the content addressed store.
+
+        Files which were added without content addressing are hashed.
+        The first file with a given content becomes the blob for that
+        content.  Every other file with the same content is replaced by
+        a hard link to that blob.  The repository is changed in place;
+        file ids, repository names, and paths are unchanged.  Blobs
+        no file uses anymore, such as those left by a write which
+        failed, are removed.  Returns the number of bytes freed.
+        """
+        if not(os.path.exists(self.blob_path)):
+            os.mkdir(self.blob_path)
+        freed = 0
+        files = self.db.execute("""select id, repository_name from file
+                                   where blob is null""").fetchall()
+        for (fileid, repository_name) in files:
+            path = self._file_location(repository_name)
+            blob = _content_hash(path)
+            blob_file = self._blob_location(blob)
+            if not(os.path.exists(blob_file)):
+                _make_parent_directory(blob_file)
+                os.link(path, blob_file)
+                _make_read_only(blob_file)
+            elif not(os.path.samefile(path, blob_file)):
+                size = os.path.getsize(path)
+                self._link_blob(blob, path)
+                freed += size
+            with self._transaction() as db:
+                db.execute("update file set blob=? where id=?", (blob, fileid))
+        for (directory, subdirectories, names) in os.walk(self.blob_path):
+            for name in names:
+                if re.match(r'^[0-9a-f]{40}$', name):
+                    freed += self._remove_unused_blob(name)
+        return freed
 
     def path_to_file(self, file_or_alias):
         """Return the full path to a file in the repository.
@@ -1333,7 +3732,7 @@ class MiniLIMS(object):
                     self.db.execute("""select repository_name
                                        from file where id = ?""",
                                     (fileid, ))][0]
-        return(os.path.join(self.file_path,filename))
+        return(self._file_location(filename))
 
     def resolve_alias(self, alias):
         """Resolve an alias to an integer file id.
@@ -1361,17 +3760,18 @@ class MiniLIMS(object):
         An alias can be used in place of an integer file ID in 
         all methods that take a file ID.
         """
-        self.db.execute("""insert into file_alias(alias,file) values (?,?)""",
-                        (alias, self.resolve_alias(fileid)))
-        self.db.commit()
+        fileid = self.resolve_alias(fileid)
+        with self._transaction() as db:
+            db.execute("""insert into file_alias(alias,file) values (?,?)""",
+                       (alias, fileid))
 
     def delete_alias(self, alias):
         """Delete the alias *alias* from the repository.
 
         The file itself is untouched.  This only affects the alias.
         """
-        self.db.execute("""delete from file_alias where alias = ?""", (alias,))
-        self.db.commit()
+        with self._transaction() as db:
+            db.execute("""delete from file_alias where alias = ?""", (alias,))
 
     def associated_files_of(self, file_or_alias):
         """Find all files associated to *file_or_alias*.
@@ -1398,8 +3798,8 @@ class MiniLIMS(object):
         if template.find("%s") == -1:
             raise ValueError("Template of a file association must contain exactly one %s.")
         else:
-            self.db.execute("""insert into file_association(fileid,associated_to,template) values (?,?,?)""", (src, dst, template))
-            self.db.commit()
+            with self._transaction() as db:
+                db.execute("""insert into file_association(fileid,associated_to,template) values (?,?,?)""", (src, dst, template))
             
     def delete_file_association(self, file_or_alias, associated_to):
         """Remove the file association from *file_or_alias* to *associated_to*.
@@ -1408,8 +3808,8 @@ class MiniLIMS(object):
         """
         src = self.resolve_alias(file_or_alias)
         dst = self.resolve_alias(associated_to)
-        self.db.execute("""delete from file_association where fileid=? and associated_to=?""", (src,dst))
-        self.db.commit()
+        with self._transaction() as db:
+            db.execute("""delete from file_association where fileid=? and associated_to=?""", (src,dst))
 
 
 def task(f):
@@ -1475,7 +3875,8 @@ def task(f):
         ex_id = ex.id
         if isinstance(lims, MiniLIMS):
             file_ids = lims.search_files(source=('execution', ex_id))
-            files = dict([(lims.fetch_file(i)['description'],i) for i in file_ids])
+            files = dict([(d['description'],i) for (d,i) in
+                          zip(lims.fetch_files(file_ids), file_ids)])
         else:
             files = {}
         return {'value': v, 'files': files, 'execution': ex_id}
@@ -1525,11 +3926,11 @@ class memoize(object):
                 call_string = "%s(ex, %s)" % (f.__name__, (', '.join([repr(a) for a in args])) + \
                                                   (', '.join(['%s=%s' % (k,repr(q)) 
                                                               for k,q in kwargs.iteritems()])))
-                ex.lims.db.execute("""insert into memopad (call_hash, filename, call)
-                                      values (?, ?, ?)""", (call_hash, filename, call_string))
-                ex.lims.db.commit()
+                with ex.lims._transaction() as db:
+                    db.execute("""insert into memopad (call_hash, filename, call)
+                                  values (?, ?, ?)""", (call_hash, filename, call_string))
                 return r
             else:
                 [filename] = v
-                return self.return_store.restore(ex, os.path.join(ex.lims.memopad_path, filename))
+                return self.return_store.restore(ex, ex.lims._memopad_location(filename))
         return wrapper
@@ -0,0 +1,259 @@
+# bein/fastcopy.py
+# Copyright 2010, Frederick Ross
+
+# This file is part of bein.
+
+# Bein is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+
+# Bein is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with bein.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod:`bein.fastcopy` -- Copying large files
+===========================================
+
+.. module:: bein.fastcopy
+   :platform: Unix
+   :synopsis: Copying large files for bein
+.. moduleauthor:: Fred Ross <madhadron at gmail dot com>
+
+All the files bein copies into, within, and out of a MiniLIMS
+repository go through :func:`copyfile`.  It copies the same way as
+``shutil.copyfile``, but much faster for large files.  On Linux, it
+has the kernel copy the data with ``copy_file_range`` or
+``sendfile``, so it never passes through Python, and filesystems
+which can share or copy data on the server side do so.  Elsewhere, or
+if the kernel refuses, it copies through a buffer of ``buffer_size``
+bytes.
+
+Files of at least ``parallel_threshold`` bytes are copied in
+``threads`` chunks at once, which helps on network and parallel
+filesystems.  If ``fsync`` is ``True``, each copy is flushed to disk
+before :func:`copyfile` returns, so a repository survives a crash of
+the machine right after files are added to it, at the cost of
+waiting for the disk.  These are module attributes, so set them for
+all of bein, as in::
+
+    import bein.fastcopy
+    bein.fastcopy.fsync = True
+"""
+import os
+import sys
+import stat
+import errno
+import fcntl
+import shutil
+import threading
+
+buffer_size = 8*1024*1024
+parallel_threshold = 1024*1024*1024
+threads = 4
+fsync = False
+
+# Errors with which the kernel refuses a copy which can still be
+# done another way.
+_unsupported = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                    errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF])
+
+_copy_file_range = None
+_sendfile = None
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if hasattr(_libc, 'copy_file_range'):
+            _copy_file_range = _libc.copy_file_range
+            _copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                         ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                         ctypes.c_size_t, ctypes.c_uint]
+            _copy_file_range.restype = ctypes.c_ssize_t
+        if hasattr(_libc, 'sendfile64'):
+            _sendfile = _libc.sendfile64
+            _sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                                  ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+            _sendfile.restype = ctypes.c_ssize_t
+    except (ImportError, OSError), e:
+        pass
+
+
+def _copy_with_copy_file_range(fd_in, fd_out, offset, end):
+    off_in = ctypes.c_int64(offset)
+    off_out = ctypes.c_int64(offset)
+    while off_in.value < end:
+        n = _copy_file_range(fd_in, ctypes.byref(off_in), fd_out, ctypes.byref(off_out),
+                             min(end - off_in.value, 1024*1024*1024), 0)
+        if n == 0:
+            break
+        elif n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            elif err in _unsupported:
+                break
+            raise OSError(err, os.strerror(err))
+    return off_in.value
+
+def _copy_with_sendfile(fd_in, fd_out, offset, end):
+    os.lseek(fd_out, offset, os.SEEK_SET)
+    off_in = ctypes.c_int64(offset)
+    while off_in.value < end:
+        n = _sendfile(fd_out, fd_in, ctypes.byref(off_in),
+                      min(end - off_in.value, 1024*1024*1024))
+        if n == 0:
+            break
+        elif n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            elif err in _unsupported:
+                break
+            raise OSError(err, os.strerror(err))
+    return off_in.value
+
+def _copy_with_buffer(fd_in, fd_out, offset, end):
+    os.lseek(fd_in, offset, os.SEEK_SET)
+    os.lseek(fd_out, offset, os.SEEK_SET)
+    while offset < end:
+        data = os.read(fd_in, min(end - offset, buffer_size))
+        if not(data):
+            break
+        written = 0
+        while written < len(data):
+            written += os.write(fd_out, buffer(data, written))
+        offset += len(data)
+    return offset
+
+_methods = []
+if _copy_file_range != None:
+    _methods.append(_copy_with_copy_file_range)
+if _sendfile != None:
+    _methods.append(_copy_with_sendfile)
+_methods.append(_copy_with_buffer)
+
+
+def _copy_range(fd_in, fd_out, offset, end):
+    """Copy bytes offset to end of fd_in to the same place in fd_out.
+
+    Each way of copying is tried in turn, continuing where the last
+    one stopped.  Returns the offset reached, which is less than end
+    if fd_in ended first.
+    """
+    for method in _methods:
+        offset = method(fd_in, fd_out, offset, end)
+        if offset >= end:
+            break
+    return offset
+
+def _copy_chunk(src, dst, offset, end):
+    fd_in = os.open(src, os.O_RDONLY)
+    try:
+        fd_out = os.open(dst, os.O_WRONLY)
+        try:
+            _copy_range(fd_in, fd_out, offset, end)
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+
+def _copy_in_parallel(src, dst, size, n):
+    """Copy the first size bytes of src to dst in n chunks at once."""
+    chunk = (size + n - 1) // n
+    errors = []
+    def copy(offset):
+        try:
+            _copy_chunk(src, dst, offset, min(offset + chunk, size))
+        except Exception, e:
+            errors.append(e)
+    workers = [threading.Thread(target=copy, args=(offset,))
+               for offset in range(0, size, chunk)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    if errors != []:
+        raise errors[0]
+
+def _fsync_directory(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError, ose:
+        # Some filesystems cannot sync directories.
+        if ose.errno != errno.EINVAL:
+            raise
+    finally:
+        os.close(fd)
+
+def _samefile(src, dst):
+    """Return whether *src* and *dst* are both the same existing file."""
+    if not(os.path.exists(src)) or not(os.path.exists(dst)):
+        return False
+    (s, d) = (os.stat(src), os.stat(dst))
+    return s.st_dev == d.st_dev and s.st_ino == d.st_ino
+
+
+def copyfile(src, dst, sync=None):
+    """Copy the contents of the file *src* to *dst*.
+
+    Like ``shutil.copyfile``, *dst* is created or truncated, and its
+    permissions are left alone.  The copy is flushed to disk if *sync*
+    is ``True``, or if *sync* is ``None`` and the module's ``fsync``
+    is ``True``.
+    """
+    if _samefile(src, dst):
+        raise shutil.Error("`%s` and `%s` are the same file" % (src, dst))
+    if sync == None:
+        sync = fsync
+    with open(src, 'rb') as s:
+        st = os.fstat(s.fileno())
+        with open(dst, 'wb') as d:
+            if stat.S_ISREG(st.st_mode) and threads > 1 and \
+                    st.st_size >= parallel_threshold:
+                d.truncate(st.st_size)
+                _copy_in_parallel(src, dst, st.st_size, threads)
+            else:
+                # A source which is not a regular file is read to its end.
+                end = stat.S_ISREG(st.st_mode) and st.st_size or sys.maxint
+                offset = _copy_range(s.fileno(), d.fileno(), 0, end)
+                if offset >= end and end != sys.maxint:
+                    # The file grew since it was opened.
+                    _copy_with_buffer(s.fileno(), d.fileno(), offset, sys.maxint)
+            if sync:
+                os.fsync(d.fileno())
+    if sync:
+        _fsync_directory(dst)
+
+def copy(src, dst, sync=None):
+    """Copy the file *src* to the file or directory *dst*.
+
+    Like ``shutil.copy``, the permission bits of *src* are copied too.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    copyfile(src, dst, sync)
+    shutil.copymode(src, dst)
+
+def reflink(src, dst):
+    """Make *dst* a copy-on-write clone of *src*.
+
+    Only works on filesystems with reflinks (btrfs, XFS) on Linux.
+    Raises IOError or OSError if the clone cannot be made, in which
+    case *dst* does not exist afterwards.
+    """
+    FICLONE = 0x40049409
+    with open(src, 'rb') as s:
+        try:
+            with open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except:
+            if os.path.exists(dst):
+                os.remove(dst)
+            raise
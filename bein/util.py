@@ -271,17 +271,18 @@ def parallel_bowtie(ex, index, reads, n_lines = 1000000, bowtie_args="-Sra", add
 
     The *via* argument determines how the jobs will be run.  The
     default, ``'local'``, runs them on the same machine in separate
-    threads.  ``'lsf'`` submits them via LSF.
+    threads.  ``'lsf'`` submits them via LSF, with each step submitted
+    as a single job array.
     """
     subfiles = split_file(ex, reads, n_lines = n_lines)
-    futures = [bowtie.nonblocking(ex, index, sf, args=bowtie_args, via=via)
-               for sf in subfiles]
+    futures = bowtie.map(ex, [(index, sf) for sf in subfiles],
+                         args=bowtie_args, via=via)
     samfiles = [f.wait() for f in futures]
     if add_nh_flags:
-        futures = [external_add_nh_flag.nonblocking(ex, sf, via=via) for sf in samfiles]
+        futures = external_add_nh_flag.map(ex, samfiles, via=via)
         bamfiles = [f.wait() for f in futures]
     else:
-        futures = [sam_to_bam.nonblocking(ex, sf, via=via) for sf in samfiles]
+        futures = sam_to_bam.map(ex, samfiles, via=via)
         bamfiles = [f.wait() for f in futures]
     return merge_bam.nonblocking(ex, bamfiles, via=via).wait()
 
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Benchmark executions written to one MiniLIMS by several processes.
+
+Each of n_processes processes opens the same scratch MiniLIMS and
+writes executions to it for a fixed time.  Each execution runs one
+program and adds one file.  Reports the executions written per
+second, in total and by the slowest process, for the write-ahead log
+and for SQLite's default rollback journal, and the number of
+processes which failed with "database is locked".
+
+Usage: python bench/concurrent_writes.py [n_processes [seconds]]
+
+n_processes defaults to 8 and seconds to 10.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bein import MiniLIMS, execution
+from bein.util import touch
+
+def writer(path, journal_mode, seconds, counts, i):
+    MiniLIMS.journal_mode = journal_mode
+    L = MiniLIMS(path)
+    n = 0
+    stop = time.time() + seconds
+    while time.time() < stop:
+        with execution(L) as ex:
+            touch(ex, "boris")
+            ex.add("boris")
+        n += 1
+    counts[i] = n
+
+def run(journal_mode, n_processes, seconds):
+    path = tempfile.mkdtemp(dir='.')
+    try:
+        MiniLIMS.journal_mode = journal_mode
+        lims = os.path.join(path, 'lims')
+        MiniLIMS(lims)
+        counts = multiprocessing.Array('i', n_processes)
+        workers = [multiprocessing.Process(target=writer,
+                                           args=(lims, journal_mode, seconds, counts, i))
+                   for i in range(n_processes)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        failed = len([w for w in workers if w.exitcode != 0])
+        return (sum(counts) / float(seconds), min(counts) / float(seconds), failed)
+    finally:
+        shutil.rmtree(path)
+
+def main(argv):
+    n_processes = len(argv) > 1 and int(argv[1]) or 8
+    seconds = len(argv) > 2 and float(argv[2]) or 10
+    print "%d processes for %g s" % (n_processes, seconds)
+    print "%12s %16s %20s %8s" % ("journal", "executions/s", "slowest process/s", "failed")
+    for journal_mode in ['delete', 'wal']:
+        (total, slowest, failed) = run(journal_mode, n_processes, seconds)
+        print "%12s %16.1f %20.1f %8d" % (journal_mode, total, slowest, failed)
+
+if __name__ == '__main__':
+    main(sys.argv)
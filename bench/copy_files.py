@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Benchmark copying large files with bein.fastcopy against shutil.
+
+Writes a scratch file of size_mb megabytes of random data, then times
+copying it with ``shutil.copyfile``, which bein used before, and with
+``bein.fastcopy.copyfile`` using each way of copying it knows on its
+own, in parallel chunks, and flushed to disk.  The source is likely
+to be in the page cache, so this measures the cost of the copy itself
+more than that of the disk.
+
+Usage: python bench/copy_files.py [size_mb [directory]]
+
+size_mb defaults to 4096 and directory, where the scratch files are
+made, to the current directory.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bein import fastcopy
+
+def fill(path, size_mb):
+    block = os.urandom(1024*1024)
+    with open(path, 'wb') as f:
+        for i in xrange(size_mb):
+            f.write(block)
+
+def timed(f):
+    t = time.time()
+    f()
+    return time.time() - t
+
+def fastcopy_with(methods, threads, sync):
+    def copy(src, dst):
+        saved = (fastcopy._methods, fastcopy.threads, fastcopy.parallel_threshold)
+        try:
+            fastcopy._methods = methods
+            fastcopy.threads = threads
+            fastcopy.parallel_threshold = 0
+            fastcopy.copyfile(src, dst, sync=sync)
+        finally:
+            (fastcopy._methods, fastcopy.threads, fastcopy.parallel_threshold) = saved
+    return copy
+
+def shutil_copyfile_fsync(src, dst):
+    shutil.copyfile(src, dst)
+    fd = os.open(dst, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    fastcopy._fsync_directory(dst)
+
+def main(argv):
+    size_mb = len(argv) > 1 and int(argv[1]) or 4096
+    directory = len(argv) > 2 and argv[2] or '.'
+    path = tempfile.mkdtemp(dir=directory)
+    try:
+        src = os.path.join(path, 'src')
+        dst = os.path.join(path, 'dst')
+        fill(src, size_mb)
+        copies = [("shutil.copyfile", shutil.copyfile)]
+        for m in fastcopy._methods:
+            copies.append(("fastcopy " + m.__name__[len('_copy_with_'):],
+                           fastcopy_with([m], 1, False)))
+        copies.extend([("fastcopy, %d threads" % fastcopy.threads,
+                        fastcopy_with(fastcopy._methods, fastcopy.threads, False)),
+                       ("shutil.copyfile + fsync", shutil_copyfile_fsync),
+                       ("fastcopy, fsync",
+                        fastcopy_with(fastcopy._methods, 1, True))])
+        print "%d MB file" % size_mb
+        print "%28s %10s %10s" % ("copy", "s", "MB/s")
+        for (name, copy) in copies:
+            if os.path.exists(dst):
+                os.remove(dst)
+            elapsed = timed(lambda: copy(src, dst))
+            print "%28s %10.2f %10.0f" % (name, elapsed, size_mb / elapsed)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main(sys.argv)
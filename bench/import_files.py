@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Benchmark importing many files into a MiniLIMS.
+
+Writes n_files scratch files of size_kb kilobytes each, as from a
+sequencing run, then times importing them into one scratch MiniLIMS
+with ``import_file`` on each file, and into another with one call to
+``import_files``.
+
+Usage: python bench/import_files.py [n_files [size_kb]]
+
+n_files defaults to 2000 and size_kb to 1024.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bein import MiniLIMS
+
+def main(argv):
+    n_files = len(argv) > 1 and int(argv[1]) or 2000
+    size_kb = len(argv) > 2 and int(argv[2]) or 1024
+    path = tempfile.mkdtemp(dir='.')
+    try:
+        block = os.urandom(size_kb * 1024)
+        srcs = []
+        for i in xrange(n_files):
+            src = os.path.join(path, 'reads_%d.fastq' % i)
+            with open(src, 'wb') as f:
+                f.write(block)
+            srcs.append(src)
+        L = MiniLIMS(os.path.join(path, 'one_by_one'))
+        t = time.time()
+        for src in srcs:
+            L.import_file(src)
+        one_by_one = time.time() - t
+        L = MiniLIMS(os.path.join(path, 'bulk'))
+        t = time.time()
+        L.import_files(srcs)
+        bulk = time.time() - t
+        print "%d files of %d kB" % (n_files, size_kb)
+        print "%24s %10s" % ("import", "s")
+        print "%24s %10.2f" % ("import_file each", one_by_one)
+        print "%24s %10.2f" % ("import_files", bulk)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main(sys.argv)
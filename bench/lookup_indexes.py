@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Benchmark MiniLIMS lookups with and without secondary indexes.
+
+Builds a scratch MiniLIMS whose database holds n_files files, half as
+many executions, each with one program of three arguments, and an
+alias, an association, and a use by an execution for every tenth
+file.  The rows are written straight into the database, so the
+files themselves are never created.  It then drops the indexes
+added by the ``_add_indexes`` migration, times some lookups, runs
+the migration again, and times the same lookups.
+``fetch_file`` and ``fetch_execution`` are made of several of these
+lookups plus a query of the immutability views, which indexes alone
+do not speed up, so they are not timed here.
+
+Usage: python bench/lookup_indexes.py [n_files [calls]]
+
+n_files defaults to 1000000 and calls (per lookup) to 20.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bein import MiniLIMS
+
+indexes = ['file_origin', 'program_execution', 'argument_execution',
+           'execution_use_file', 'execution_use_execution', 'file_alias_file',
+           'file_association_associated_to', 'file_association_fileid']
+
+def fill(M, n_files):
+    n_executions = n_files / 2
+    db = M.db
+    db.executemany("""insert into execution(id,started_at,finished_at,working_directory)
+                      values (?,0,1,'/tmp')""",
+                   ((i,) for i in xrange(1, n_executions+1)))
+    db.executemany("""insert into program(pos,execution,pid,return_code)
+                      values (0,?,1,0)""",
+                   ((i,) for i in xrange(1, n_executions+1)))
+    db.executemany("""insert into argument(pos,program,execution,argument)
+                      values (?,0,?,'arg')""",
+                   ((j, i) for i in xrange(1, n_executions+1) for j in range(3)))
+    db.executemany("""insert into file(id,external_name,repository_name,origin,origin_value)
+                      values (?,'',?,'execution',?)""",
+                   ((i, 'f%09d' % i, (i+1)/2) for i in xrange(1, n_files+1)))
+    db.executemany("""insert into file_alias(alias,file) values (?,?)""",
+                   (('a%d' % i, i) for i in xrange(1, n_files+1, 10)))
+    db.executemany("""insert into file_association(fileid,associated_to,template)
+                      values (?,?,'%s.idx')""",
+                   ((i+1, i) for i in xrange(1, n_files, 10)))
+    db.executemany("""insert into execution_use(execution,file) values (?,?)""",
+                   (((i+1)/2, i) for i in xrange(1, n_files+1, 10)))
+    db.commit()
+    return n_executions
+
+def per_call(f, ids):
+    t = time.time()
+    for i in ids:
+        f(i)
+    return (time.time() - t) / len(ids)
+
+lookups = [("search_files(source=)", 'execution',
+            lambda M, e: M.search_files(source=('execution', e))),
+           ("associated_files_of", 'file',
+            lambda M, f: M.associated_files_of(f)),
+           ("aliases of a file", 'file',
+            lambda M, f: M.db.execute("select alias from file_alias where file=?",
+                                      (f,)).fetchall()),
+           ("files associated to", 'file',
+            lambda M, f: M.db.execute("""select associated_to from file_association
+                                         where fileid=?""", (f,)).fetchall()),
+           ("programs of execution", 'execution',
+            lambda M, e: M.db.execute("select pos from program where execution=?",
+                                      (e,)).fetchall()),
+           ("arguments of program", 'execution',
+            lambda M, e: M.db.execute("""select argument from argument
+                                         where execution=? and program=0""",
+                                      (e,)).fetchall()),
+           ("files used by execution", 'execution',
+            lambda M, e: M.db.execute("select file from execution_use where execution=?",
+                                      (e,)).fetchall()),
+           ("executions using file", 'file',
+            lambda M, f: M.db.execute("select execution from execution_use where file=?",
+                                      (f,)).fetchall())]
+
+def measure(M, n_files, n_executions, calls):
+    ids = {'file': [random.randint(1, n_files) for i in range(calls)],
+           'execution': [random.randint(1, n_executions) for i in range(calls)]}
+    return [per_call(lambda i: f(M, i), ids[kind]) for (name, kind, f) in lookups]
+
+def main(argv):
+    n_files = len(argv) > 1 and int(argv[1]) or 1000000
+    calls = len(argv) > 2 and int(argv[2]) or 20
+    path = tempfile.mkdtemp(dir='.')
+    try:
+        M = MiniLIMS(os.path.join(path, 'lims'))
+        n_executions = fill(M, n_files)
+        for i in indexes:
+            M.db.execute("drop index %s" % i)
+        M.db.commit()
+        before = measure(M, n_files, n_executions, calls)
+        t = time.time()
+        M._add_indexes(M.db)
+        M.db.commit()
+        migration = time.time() - t
+        after = measure(M, n_files, n_executions, calls)
+        print "%d files, %d executions; migration took %.1f s" % \
+            (n_files, n_executions, migration)
+        print "%24s %16s %16s" % ("lookup", "before (ms)", "after (ms)")
+        for ((name, kind, f), b, a) in zip(lookups, before, after):
+            print "%24s %16.3f %16.3f" % (name, b*1000, a*1000)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main(sys.argv)
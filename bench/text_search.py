@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Benchmark search_executions(with_text=...) on many program arguments.
+
+Builds a scratch MiniLIMS holding n_arguments program arguments, ten
+per execution, written straight into the database and then added to
+the full-text index as ``MiniLIMS.write`` does.  Each argument is a
+path made of common words and a few rare ones.  Then times
+``search_executions`` for a rare word, a prefix, and a phrase,
+against the ``LIKE`` scan which ``search_executions`` used before the
+full-text index.
+
+Usage: python bench/text_search.py [n_arguments [calls]]
+
+n_arguments defaults to 10000000 and calls (per search) to 10.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bein import MiniLIMS
+
+common = ['sample', 'reads', 'bam', 'sorted', 'chr1', 'chr2', 'data', 'run']
+
+def argument(i):
+    if i % 100000 == 0:
+        return '/data/bowtie_index/hg19_%d.ebwt' % i
+    return '/%s/%s_%d.%s' % (common[i % 8], common[(i / 8) % 8], i, common[(i / 64) % 8])
+
+def fill(M, n_arguments):
+    n_executions = n_arguments / 10
+    db = M.db
+    db.executemany("""insert into execution(id,started_at,finished_at,working_directory)
+                      values (?,0,1,'/tmp')""",
+                   ((i,) for i in xrange(1, n_executions+1)))
+    db.executemany("""insert into program(pos,execution,pid,return_code)
+                      values (0,?,1,0)""",
+                   ((i,) for i in xrange(1, n_executions+1)))
+    db.executemany("""insert into argument(pos,program,execution,argument)
+                      values (?,0,?,?)""",
+                   ((i % 10, i / 10 + 1, argument(i)) for i in xrange(n_arguments)))
+    db.execute("""insert into argument_text(rowid, argument)
+                  select rowid, argument from argument""")
+    db.commit()
+
+def per_call(f, calls):
+    t = time.time()
+    for i in range(calls):
+        f()
+    return (time.time() - t) / calls
+
+def main(argv):
+    n_arguments = len(argv) > 1 and int(argv[1]) or 10000000
+    calls = len(argv) > 2 and int(argv[2]) or 10
+    path = tempfile.mkdtemp(dir='.')
+    try:
+        M = MiniLIMS(os.path.join(path, 'lims'))
+        t = time.time()
+        fill(M, n_arguments)
+        print "%d arguments written in %.1f s" % (n_arguments, time.time() - t)
+        print "%24s %10s %16s %16s" % ("search", "matches", "full-text (ms)", "like scan (ms)")
+        for (query, pattern) in [("bowtie_index", "%bowtie_index%"),
+                                 ("hg19*", "%hg19%"),
+                                 ('"bowtie index hg19"', "%bowtie_index/hg19%")]:
+            matches = len(M.search_executions(with_text=query))
+            indexed = per_call(lambda: M.search_executions(with_text=query), calls)
+            scan = per_call(lambda: M.db.execute("""select distinct execution from argument
+                                                    where argument like ?""",
+                                                 (pattern,)).fetchall(), 1)
+            print "%24s %10d %16.3f %16.3f" % (query, matches, indexed*1000, scan*1000)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main(sys.argv)
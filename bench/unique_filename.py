@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Benchmark filename allocation in large directories.
+
+Fills a scratch directory with empty files, and at several sizes
+times ``unique_filename_in``, which lists the directory on every
+call, against ``_reserve_filename_in``, which the MiniLIMS uses for
+its ``files`` and ``memopad`` directories and never lists it.
+
+Usage: python bench/unique_filename.py [max_entries [calls]]
+
+max_entries defaults to 1000000 and calls (per measurement) to 20.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bein import unique_filename_in, _reserve_filename_in
+
+def fill(path, start, stop):
+    for i in xrange(start, stop):
+        os.close(os.open(os.path.join(path, 'f%09d' % i), os.O_WRONLY | os.O_CREAT))
+
+def per_call(f, path, calls):
+    t = time.time()
+    for i in range(calls):
+        name = f(path)
+    return (time.time() - t) / calls
+
+def main(argv):
+    max_entries = len(argv) > 1 and int(argv[1]) or 1000000
+    calls = len(argv) > 2 and int(argv[2]) or 20
+    path = tempfile.mkdtemp(dir='.')
+    try:
+        print "%12s %24s %24s" % ("entries", "unique_filename_in (ms)",
+                                  "_reserve_filename_in (ms)")
+        n = 0
+        size = 1000
+        while size <= max_entries:
+            fill(path, n, size)
+            n = size
+            listing = per_call(unique_filename_in, path, calls)
+            reserving = per_call(_reserve_filename_in, path, calls)
+            print "%12d %24.3f %24.3f" % (size, listing*1000, reserving*1000)
+            size *= 10
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main(sys.argv)
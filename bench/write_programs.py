@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Benchmark recording executions with many programs in a MiniLIMS.
+
+Builds an Execution by hand holding n_programs program records,
+each with n_arguments arguments and a few lines of stdout, plus
+n_files small files added from its working directory, each with an
+index file associated to it, as when a BAM file is split into
+chunks, and times ``MiniLIMS.write`` recording it in a scratch
+MiniLIMS.  No programs are actually run.
+
+Usage: python bench/write_programs.py [n_programs [n_arguments [n_files]]]
+
+n_programs defaults to 10000, n_arguments to 20, and n_files to 100.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bein import MiniLIMS, Execution, ProgramOutput
+
+def build_execution(L, path, n_programs, n_arguments, n_files):
+    ex = Execution(L, path)
+    for i in xrange(n_programs):
+        arguments = ['program%d' % i] + \
+            ['--argument-%d=/some/fairly/long/path/to/input/file/%d.bam' % (j, i)
+             for j in range(n_arguments - 1)]
+        ex.report(ProgramOutput(0, 1000 + i, arguments,
+                                ['line %d of stdout\n' % j for j in range(5)],
+                                ['']))
+    for i in xrange(n_files):
+        filename = 'output%d.bam' % i
+        for name in [filename, filename + '.bai']:
+            with open(os.path.join(path, name), 'w') as f:
+                f.write('x' * 1024)
+        ex.add(filename, description='output %d' % i)
+        ex.add(filename + '.bai', associate_to_filename=filename, template='%s.bai')
+    ex.finished_at = int(time.time())
+    return ex
+
+def main(argv):
+    n_programs = len(argv) > 1 and int(argv[1]) or 10000
+    n_arguments = len(argv) > 2 and int(argv[2]) or 20
+    n_files = len(argv) > 3 and int(argv[3]) or 100
+    path = os.path.abspath(tempfile.mkdtemp(dir='.'))
+    try:
+        L = MiniLIMS(os.path.join(path, 'lims'))
+        working_directory = os.path.join(path, 'work')
+        os.mkdir(working_directory)
+        # Like in an execution, files are added from the working directory.
+        cwd = os.getcwd()
+        os.chdir(working_directory)
+        try:
+            ex = build_execution(L, working_directory, n_programs, n_arguments, n_files)
+            t = time.time()
+            L.write(ex, "benchmark")
+            elapsed = time.time() - t
+        finally:
+            os.chdir(cwd)
+        print "%d programs of %d arguments, %d indexed files: written in %.2f s" % \
+            (n_programs, n_arguments, n_files, elapsed)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main(sys.argv)
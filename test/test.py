@@ -4,14 +4,17 @@ import socket
 import re
 import sys
 import random
+import cPickle
 from unittest2 import TestCase, TestSuite, main, TestLoader, skipIf
 
+import bein
 from bein import *
-from bein.util import touch
+from bein.util import touch, background
 
 sys.path.insert(1, '../')
 
 M = MiniLIMS("testing_lims")
+FAKE_LSF = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_lsf')
 
 
 def hostname_contains(pattern):
@@ -94,6 +97,140 @@ class TestProgramBinding(TestCase):
         with self.assertRaises(SyntaxError):
             touch.nonblocking(ex)
 
+@program
+def sleep_and_date(n):
+    return {'arguments': ['sh', '-c', 'sleep %s; date +%%s.%%N' % n],
+            'return_value': lambda p: float(p.stdout[0])}
+
+@program
+def count_running(n):
+    """Return how many count_running jobs are running, including this one."""
+    return {'arguments': ['sh', '-c', 'touch running.$$; ls running.* | wc -l; '
+                          'sleep %s; rm running.$$' % n],
+            'return_value': lambda p: int(p.stdout[0])}
+
+class TestLocalPool(TestCase):
+    def test_jobs_are_limited(self):
+        with execution(None, max_local_jobs=2) as ex:
+            futures = [count_running.nonblocking(ex, 0.2) for i in range(6)]
+            self.assertEqual(max([f.wait() for f in futures]), 2)
+
+    def test_limit_from_minilims(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("pooled", max_local_jobs=3)
+            with execution(L) as ex:
+                self.assertEqual(ex.max_local_jobs, 3)
+            with execution(L, max_local_jobs=1) as ex:
+                self.assertEqual(ex.max_local_jobs, 1)
+
+    def test_queued_jobs_open_no_files(self):
+        with execution(None, max_local_jobs=1) as ex:
+            first = sleep_and_date.nonblocking(ex, 0.5)
+            rest = [echo.nonblocking(ex, i, stdout="out%d" % i)
+                    for i in range(1, 4)]
+            time.sleep(0.2)
+            self.assertEqual(sorted(f for f in os.listdir('.')
+                                    if f.startswith('out')), [])
+            gather([first] + rest)
+            for i in range(1, 4):
+                with open("out%d" % i) as q:
+                    self.assertEqual(q.read(), "%d\n" % i)
+
+class TestRunAsync(TestCase):
+    def test_run_async(self):
+        with execution(None) as ex:
+            with open('boris','w') as f:
+                f.write("This is a test\nof the emergency broadcast\nsystem.\n")
+            q = count_lines.run_async(ex, 'boris')
+            self.assertEqual(q.wait(), 3)
+            self.assertEqual(len(ex.programs), 1)
+
+    def test_gather_many(self):
+        with execution(None) as ex:
+            futures = [seq.run_async(ex, i) for i in range(1, 201)]
+            values = gather(futures)
+        self.assertEqual([len(v) for v in values], range(1, 201))
+
+    def test_as_completed(self):
+        with execution(None) as ex:
+            slow = sleep_and_date.run_async(ex, 0.5)
+            fast = sleep_and_date.run_async(ex, 0)
+            self.assertEqual(list(as_completed([slow, fast])), [fast, slow])
+
+    def test_redirected_stdout(self):
+        with execution(None) as ex:
+            echo.run_async(ex, "boris!", stdout="out").wait()
+            with open("out") as q:
+                self.assertEqual(q.read(), "boris!\n")
+
+    def test_failure_raises(self):
+        with execution(None) as ex:
+            f = count_lines.run_async(ex, 'nonexistent_file')
+            self.assertRaises(ProgramFailed, f.wait)
+            f = TestNoSuchProgramError.nonexistent.run_async(ex)
+            self.assertRaises(ValueError, f.wait)
+
+    def test_raising_callback(self):
+        def callback(line):
+            raise IOError("boris")
+        with execution(None) as ex:
+            f = seq.run_async(ex, 200000, on_stdout=callback)
+            self.assertRaises(IOError, f.wait)
+            self.assertEqual(len(seq.run_async(ex, 10).wait()), 10)
+
+class TestFakeLSF(TestCase):
+    def setUp(self):
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = FAKE_LSF + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+
+    def test_lsf_works(self):
+        with execution(None) as ex:
+            with open('boris','w') as f:
+                f.write("This is a test\nof the emergency broadcast\nsystem.\n")
+            q = count_lines._lsf(ex, 'boris')
+            self.assertEqual(str(q.__class__), "<class 'bein.Future'>")
+            self.assertEqual(q.wait(), 3)
+            self.assertEqual(len(ex.programs), 1)
+
+    def test_many_jobs_one_thread(self):
+        with execution(None) as ex:
+            with open('boris','w') as f:
+                f.write("This is a test\nof the emergency broadcast\nsystem.\n")
+            n_threads = threading.active_count()
+            futures = [count_lines.nonblocking(ex, 'boris', via='lsf')
+                       for i in range(20)]
+            self.assertTrue(threading.active_count() <= n_threads + 1)
+            self.assertEqual([f.wait() for f in futures], [3]*20)
+
+    def test_map_lsf_job_array(self):
+        with execution(None) as ex:
+            names = []
+            for i in range(5):
+                with open('boris%d' % i,'w') as f:
+                    f.write("line\n" * i)
+                names.append('boris%d' % i)
+            futures = count_lines.map(ex, names, via='lsf')
+            self.assertEqual([f.wait() for f in futures], range(5))
+            self.assertEqual(len(set([p.pid for p in ex.programs])), 1)
+            self.assertEqual(len(set([p.arguments[-1] for p in ex.programs])), 5)
+            count_lines._lsf(ex, 'boris0').wait()
+            self.assertEqual(set([p.arguments[0] for p in ex.programs]), set(["bsub"]))
+
+    def test_map_local(self):
+        with execution(None) as ex:
+            futures = echo.map(ex, [("a",), ("b",)])
+            self.assertEqual([f.wait() for f in futures], [None, None])
+            self.assertEqual([p.stdout for p in ex.programs], [['a\n'], ['b\n']])
+
+    def test_lsf_failure(self):
+        with execution(None) as ex:
+            q = count_lines.nonblocking(ex, 'nonexistent', via='lsf')
+            self.assertEqual(q.wait(), None)
+            self.assertNotEqual(ex.programs[0].return_code, 0)
+
 class TestUniqueFilenameIn(TestCase):
     def test_state_determines_filename(self):
         with execution(None) as ex:
@@ -120,6 +257,15 @@ class TestUniqueFilenameIn(TestCase):
             g = touch(ex)
             self.assertNotEqual(f, g)
 
+    def test_reserve_filename_creates_file(self):
+        with execution(None) as ex:
+            st = random.getstate()
+            f = bein._reserve_filename_in(ex.working_directory)
+            self.assertTrue(os.path.exists(f))
+            random.setstate(st)
+            g = bein._reserve_filename_in(ex.working_directory)
+            self.assertNotEqual(f, g)
+
 class TestMiniLIMS(TestCase):
     def test_resolve_alias_exception_on_no_file(self):
         with execution(None) as ex:
@@ -216,6 +362,63 @@ class TestStdoutStderrRedirect(TestCase):
         finally:
             M.delete_execution(ex.id)
 
+@program
+def seq(n):
+    return {'arguments': ['seq', str(n)],
+            'return_value': lambda p: p.stdout}
+
+class TestStreamCapture(TestCase):
+    def test_large_output_does_not_block(self):
+        with execution(None) as ex:
+            lines = seq(ex, 200000)
+        self.assertEqual(len(lines), 200000)
+        self.assertEqual(lines[-1], '200000\n')
+
+    def test_large_output_does_not_block_nonblocking(self):
+        with execution(None) as ex:
+            lines = seq.nonblocking(ex, 200000).wait()
+        self.assertEqual(len(lines), 200000)
+
+    def test_limit_keeps_head_and_tail(self):
+        try:
+            seq.stdout_limit = 12
+            with execution(None) as ex:
+                lines = seq(ex, 10000)
+        finally:
+            del seq.stdout_limit
+        self.assertEqual(lines[:3], ['1\n', '2\n', '3\n'])
+        self.assertEqual(lines[-2:], ['9999\n', '10000\n'])
+        self.assertTrue(lines[6].startswith('[...'))
+
+    def test_long_output_is_kept_in_a_file(self):
+        try:
+            seq.spool_size = 1000
+            with execution(None) as ex:
+                lines = seq(ex, 10000)
+        finally:
+            del seq.spool_size
+        self.assertEqual(len(lines), 10000)
+        [p] = ex.programs
+        self.assertEqual(p.stdout_bytes, ''.join(lines))
+        path = p._stdout.path
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(p.stderr, [])
+        self.assertEqual(cPickle.loads(cPickle.dumps(p)).stdout, lines)
+        del ex.programs[:], p
+        self.assertFalse(os.path.exists(path))
+
+    def test_line_callback(self):
+        seen = []
+        with execution(None) as ex:
+            seq(ex, 1000, on_stdout=seen.append)
+        self.assertEqual(seen, ['%d\n' % i for i in range(1, 1001)])
+
+    def test_raising_callback(self):
+        def callback(line):
+            raise IOError("boris")
+        with execution(None) as ex:
+            self.assertRaises(IOError, seq, ex, 200000, on_stdout=callback)
+
 class TestNoSuchProgramError(TestCase):
     @program
     def nonexistent():
@@ -313,6 +516,778 @@ class TestAssociatePreservesFilenames(TestCase):
             except:
                 pass
 
+class TestContentAddressed(TestCase):
+    def test_identical_imports_share_blob(self):
+        with execution(None) as ex:
+            C = MiniLIMS("cas", content_addressed=True)
+            a = C.import_file("../../LICENSE")
+            b = C.import_file("../../LICENSE")
+            self.assertTrue(os.path.samefile(C.path_to_file(a), C.path_to_file(b)))
+            [blob] = [x for (x,) in C.db.execute("select blob from file where id=?", (a,))]
+            self.assertEqual(C.db.execute("select refcount from blob where hash=?",
+                                          (blob,)).fetchone()[0], 2)
+            C.delete_file(a)
+            self.assertTrue(os.path.exists(os.path.join(C.blob_path, blob)))
+            C.delete_file(b)
+            self.assertFalse(os.path.exists(os.path.join(C.blob_path, blob)))
+
+    def test_execution_outputs_share_blob(self):
+        with execution(None) as ignoreme:
+            C = MiniLIMS("cas", content_addressed=True)
+            for i in range(2):
+                with execution(C) as ex:
+                    touch(ex, "boris")
+                    ex.add("boris")
+            [a, b] = C.search_files(with_text="boris")
+            self.assertTrue(os.path.samefile(C.path_to_file(a), C.path_to_file(b)))
+            c = C.copy_file(a)
+            self.assertTrue(os.path.samefile(C.path_to_file(a), C.path_to_file(c)))
+
+    def test_deduplicate(self):
+        with execution(None) as ex:
+            C = MiniLIMS("cas")
+            a = C.import_file("../../LICENSE")
+            b = C.import_file("../../LICENSE")
+            self.assertFalse(os.path.samefile(C.path_to_file(a), C.path_to_file(b)))
+            C = MiniLIMS("cas", content_addressed=True)
+            self.assertEqual(C.deduplicate(), os.path.getsize("../../LICENSE"))
+            self.assertTrue(os.path.samefile(C.path_to_file(a), C.path_to_file(b)))
+            with open(C.path_to_file(b)) as f:
+                self.assertTrue(f.read().startswith("                    GNU GENERAL PUBLIC LICENSE"))
+
+    def test_failed_write_leaves_no_blobs(self):
+        with execution(None) as ignoreme:
+            C = MiniLIMS("cas", content_addressed=True)
+            C.add_alias(C.import_file("../../LICENSE"), "boris")
+            self.assertRaises(sqlite3.IntegrityError, C.import_files,
+                              ["../../LICENSE", "../../doc/bein.rst"],
+                              aliases=[None, "boris"])
+            with self.assertRaises(sqlite3.IntegrityError):
+                with execution(C) as ex:
+                    echo(ex, "hilda", stdout="hilda")
+                    ex.add("hilda", alias="boris")
+            self.assertEqual(len(os.listdir(C.blob_path)), 1)
+            self.assertEqual(len(os.listdir(C.file_path)), 1)
+
+    def test_blob_in_use_is_kept(self):
+        with execution(None) as ignoreme:
+            C = MiniLIMS("cas", content_addressed=True)
+            (name, blob) = C._copy_file_to_repository("../../LICENSE")
+            self.assertEqual(C._remove_unused_blob(blob), 0)
+            self.assertTrue(os.path.samefile(C._blob_location(blob),
+                                             C._file_location(name)))
+            os.remove(C._file_location(name))
+            self.assertEqual(C._remove_unused_blob(blob),
+                             os.path.getsize("../../LICENSE"))
+            self.assertEqual(os.listdir(C.blob_path), [])
+
+    def test_deduplicate_removes_unused_blobs(self):
+        with execution(None) as ignoreme:
+            C = MiniLIMS("cas", content_addressed=True)
+            a = C.import_file("../../LICENSE")
+            (name, blob) = C._copy_file_to_repository("../../doc/bein.rst")
+            os.remove(C._file_location(name))
+            self.assertEqual(C.deduplicate(), os.path.getsize("../../doc/bein.rst"))
+            self.assertEqual(len(os.listdir(C.blob_path)), 1)
+            with open(C.path_to_file(a)) as f:
+                self.assertTrue(f.read().startswith("                    GNU GENERAL PUBLIC LICENSE"))
+
+class TestStaging(TestCase):
+    def test_link_staging(self):
+        fid = M.import_file("../LICENSE")
+        try:
+            with execution(M) as ex:
+                f = ex.use(fid, staging='link')
+                self.assertTrue(os.path.samefile(f, M.path_to_file(fid)))
+                g = ex.use(fid, staging='link', writable=True)
+                self.assertFalse(os.path.samefile(g, M.path_to_file(fid)))
+            M.delete_execution(ex.id)
+        finally:
+            M.delete_file(fid)
+
+    def test_link_staged_input_is_read_only(self):
+        with execution(None) as ignoreme:
+            for content_addressed in [False, True]:
+                L = MiniLIMS("staged%s" % content_addressed,
+                             content_addressed=content_addressed)
+                fid = L.import_file("../../LICENSE")
+                with open(L.path_to_file(fid)) as f:
+                    original = f.read()
+                with execution(L) as ex:
+                    f = ex.use(fid, staging='link')
+                    self.assertEqual(os.stat(f).st_mode & 0222, 0)
+                    if os.geteuid() != 0:
+                        self.assertRaises(IOError, open, f, 'a')
+                    g = ex.use(fid, staging='link', writable=True)
+                    with open(g, 'a') as h:
+                        h.write("boris")
+                with open(L.path_to_file(fid)) as f:
+                    self.assertEqual(f.read(), original)
+
+    def test_writable_repository_file_is_not_linked(self):
+        fid = M.import_file("../LICENSE")
+        try:
+            os.chmod(M.path_to_file(fid), 0644)
+            with open(M.path_to_file(fid)) as f:
+                original = f.read()
+            with execution(M) as ex:
+                f = ex.use(fid, staging='link')
+                self.assertFalse(os.path.samefile(f, M.path_to_file(fid)))
+                os.chmod(f, 0644)
+                with open(f, 'a') as h:
+                    h.write("boris")
+            with open(M.path_to_file(fid)) as f:
+                self.assertEqual(f.read(), original)
+            M.delete_execution(ex.id)
+        finally:
+            M.delete_file(fid)
+
+    def test_link_staging_associated(self):
+        fa = M.import_file("../LICENSE")
+        fb = M.import_file("../doc/bein.rst")
+        M.associate_file(fb, fa, "%s.linked")
+        try:
+            with execution(M) as ex:
+                f = ex.use(fa, staging='link')
+                self.assertTrue(os.path.samefile(f + ".linked", M.path_to_file(fb)))
+            M.delete_execution(ex.id)
+        finally:
+            M.delete_file(fa)
+
+    def test_staging_from_minilims(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("staged", staging='link')
+            fid = L.import_file("../../LICENSE")
+            with execution(L) as ex:
+                f = ex.use(fid)
+                self.assertTrue(os.path.samefile(f, L.path_to_file(fid)))
+
+class TestMigrations(TestCase):
+    def test_new_database_is_current(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("migrated")
+            self.assertEqual(L.db.execute("pragma user_version").fetchone()[0],
+                             len(MiniLIMS.migrations))
+
+    def test_old_database_is_upgraded(self):
+        with execution(None) as ignoreme:
+            migrations = MiniLIMS.migrations
+            MiniLIMS.migrations = migrations[:2]
+            try:
+                L = MiniLIMS("migrated")
+                fa = L.import_file("../../LICENSE")
+                fb = L.import_file("../../LICENSE")
+                fc = L.import_file("../../LICENSE")
+                L.associate_file(fb, fa, "%s.assoc")
+                L.db.execute("""insert into execution(id,started_at,finished_at,working_directory)
+                                values (1,0,1,'/tmp')""")
+                L.db.execute("""insert into program(pos,execution,pid,return_code,stdout,stderr)
+                                values (0,1,1,0,'hilda\n','')""")
+                L.db.execute("""insert into argument(pos,program,execution,argument)
+                                values (0,0,1,'boris')""")
+                L.db.execute("insert into execution_use(execution,file) values (1,?)", (fa,))
+                L.db.execute("pragma user_version = 0")
+                L.db.commit()
+            finally:
+                MiniLIMS.migrations = migrations
+            L = MiniLIMS("migrated")
+            self.assertEqual(L.db.execute("pragma user_version").fetchone()[0],
+                             len(MiniLIMS.migrations))
+            indexes = [n for (n,) in L.db.execute("""select name from sqlite_master
+                                                     where type='index'""")]
+            self.assertTrue('file_origin' in indexes)
+            self.assertEqual(L.search_files(source='import'), [fa, fb, fc])
+            self.assertEqual(L.search_executions(with_text="boris"), [1])
+            self.assertTrue(L.fetch_file(fa)['immutable'])
+            self.assertTrue(L.fetch_file(fb)['immutable'])
+            self.assertFalse(L.fetch_file(fc)['immutable'])
+            self.assertFalse(L.fetch_execution(1)['immutable'])
+            self.assertEqual(L.fetch_execution(1)['programs'][0]['stdout'], u"hilda\n")
+            self.assertEqual(L.db.execute("select stdout from program").fetchall(), [(None,)])
+            self.assertRaises(sqlite3.IntegrityError, L.db.execute,
+                              "delete from file where id=?", (fa,))
+            L.delete_file(fc)
+
+class TestProgramOutput(TestCase):
+    def test_output_is_stored_compressed(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("program_output")
+            with execution(L) as ex:
+                echo(ex, "boris " * 100)
+                touch(ex, "hilda")
+            [echoed, touched] = L.fetch_execution(ex.id)['programs']
+            self.assertEqual(echoed['stdout'], u"boris " * 100 + u"\n")
+            self.assertEqual(touched['stdout'], u"")
+            self.assertEqual(touched['stderr'], u"")
+            [(stdout,)] = L.db.execute("""select stdout from program_output
+                                          where execution=?""", (ex.id,)).fetchall()
+            self.assertTrue(len(stdout) < 100)
+            self.assertEqual(L.fetch_executions([ex.id], lazy=True)[0]['programs'][0]['stdout'],
+                             echoed['stdout'])
+            L.delete_execution(ex.id)
+            self.assertEqual(L.db.execute("select count(*) from program_output").fetchone(),
+                             (0,))
+
+class TestJournal(TestCase):
+    def test_programs_are_written_as_reported(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("journal")
+            with execution(L, description="journaled", journal=True) as ex:
+                self.assertNotEqual(ex.id, None)
+                echo(ex, "boris")
+                touch(ex, "hilda")
+                self.assertEqual(ex.programs, [])
+                e = MiniLIMS(L.path).fetch_execution(ex.id)
+                self.assertEqual(e['finished_at'], None)
+                self.assertEqual([p['stdout'] for p in e['programs']], [u"boris\n", u""])
+                ex.add("hilda")
+            e = L.fetch_execution(ex.id)
+            self.assertNotEqual(e['finished_at'], None)
+            self.assertEqual(e['description'], "journaled")
+            self.assertEqual([p['arguments'] for p in e['programs']],
+                             [['echo', 'boris'], ['touch', 'hilda']])
+            self.assertEqual(len(L.search_files(source=('execution', ex.id))), 1)
+            self.assertEqual(L.search_executions(with_text="hilda"), [ex.id])
+
+    def test_exception_is_recorded(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("journal")
+            try:
+                with execution(L, journal=True) as ex:
+                    echo(ex, "boris")
+                    raise IOError("meep")
+            except IOError:
+                pass
+            e = L.fetch_execution(ex.id)
+            self.assertTrue("meep" in e['exception_string'])
+            self.assertEqual(len(e['programs']), 1)
+
+class TestFinalizeInBackground(TestCase):
+    def test_finalizer_returns_id(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("finalize")
+            with execution(L, description="boris", finalize_in_background=True) as ex:
+                touch(ex, "hilda")
+                ex.add("hilda")
+            exid = ex.finalizer.wait()
+            self.assertEqual(exid, ex.id)
+            self.assertEqual(L.fetch_execution(exid)['description'], "boris")
+            self.assertEqual(len(L.search_files(source=('execution', exid))), 1)
+            self.assertFalse(os.path.exists(ex.working_directory))
+
+    def test_finalizers_are_flushed_at_exit(self):
+        with execution(None) as ignoreme:
+            script = ("import bein\n"
+                      "L = bein.MiniLIMS('flushed')\n"
+                      "with bein.execution(L, finalize_in_background=True) as ex:\n"
+                      "    pass\n")
+            subprocess.check_call([sys.executable, "-c", script])
+            self.assertEqual(len(MiniLIMS("flushed").search_executions()), 1)
+
+class TestEagerImport(TestCase):
+    def test_files_are_copied_when_added(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("eager")
+            with execution(L, eager_import=True) as ex:
+                touch(ex, "boris")
+                touch(ex, "hilda")
+                ex.add("boris", description="boris")
+                ex.add("hilda", associate_to_filename="boris", template="%s.meep")
+                (boris_name, blob) = ex._imports[0][1].wait()
+                ex._imports[1][1].wait()
+                self.assertTrue(os.path.exists(L._file_location(boris_name)))
+                self.assertTrue(os.path.exists(L._file_location(boris_name + ".meep")))
+            [boris] = L.search_files(with_text="boris")
+            self.assertEqual(L.fetch_file(boris)['repository_name'], boris_name)
+            [(hilda, template)] = L.associated_files_of(boris)
+            self.assertEqual(template, "%s.meep")
+
+    def test_same_filename_added_twice(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("eager")
+            with execution(L, eager_import=True) as ex:
+                touch(ex, "boris")
+                touch(ex, "hilda")
+                ex.add("boris", description="a")
+                ex.add("hilda", associate_to_filename="boris", template="%s.meep")
+                ex.add("boris", description="b", alias="second")
+            files = [L.fetch_file(i) for i in L.search_files(source=('execution', ex.id))]
+            self.assertEqual(sorted(f['description'] for f in files), ["", "a", "b"])
+            [(hilda, template)] = L.associated_files_of("second")
+            self.assertEqual(L.fetch_file(hilda)['repository_name'],
+                             L.fetch_file("second")['repository_name'] + ".meep")
+            self.assertEqual(len([f for (d, ds, fs) in os.walk(L.file_path) for f in fs]), 3)
+
+    def test_copies_are_removed_on_failure(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("eager")
+            try:
+                with execution(L, eager_import=True) as ex:
+                    touch(ex, "boris")
+                    touch(ex, "hilda")
+                    ex.add("boris")
+                    ex.add("hilda", associate_to_filename="boris", template="meep")
+            except ValueError:
+                pass
+            self.assertEqual(L.search_files(), [])
+            self.assertEqual([f for (d, ds, fs) in os.walk(L.file_path) for f in fs], [])
+
+class TestMoveOnWrite(TestCase):
+    def test_outputs_are_moved(self):
+        with execution(None) as ignoreme:
+            for content_addressed in [False, True]:
+                L = MiniLIMS("moved%s" % content_addressed,
+                             content_addressed=content_addressed)
+                touch(ignoreme, "outside")
+                with execution(L) as ex:
+                    touch(ex, "boris")
+                    inode = os.stat("boris").st_ino
+                    ex.add("boris", description="boris")
+                    ex.add("../outside", description="outside")
+                [boris] = L.search_files(with_text="boris")
+                self.assertEqual(os.stat(L.path_to_file(boris)).st_ino, inode)
+                [outside] = L.search_files(with_text="outside")
+                self.assertNotEqual(os.stat(L.path_to_file(outside)).st_ino,
+                                    os.stat("outside").st_ino)
+
+    def test_file_added_under_two_paths_is_copied(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("moved")
+            with execution(L) as ex:
+                touch(ex, "boris")
+                ex.add("boris", description="a")
+                ex.add("./boris", description="b")
+            self.assertEqual(len(L.search_files(source=('execution', ex.id))), 2)
+
+class TestFastCopy(TestCase):
+    def test_each_method_copies(self):
+        with execution(None) as ignoreme:
+            data = os.urandom(3*1024*1024 + 17)
+            with open("src", "wb") as f:
+                f.write(data)
+            methods = fastcopy._methods
+            try:
+                for m in methods:
+                    fastcopy._methods = [m]
+                    fastcopy.copyfile("src", "dst", sync=True)
+                    with open("dst", "rb") as f:
+                        self.assertEqual(f.read(), data)
+            finally:
+                fastcopy._methods = methods
+
+    def test_parallel_copy(self):
+        with execution(None) as ignoreme:
+            data = os.urandom(1024*1024 + 3)
+            with open("src", "wb") as f:
+                f.write(data)
+            threshold = fastcopy.parallel_threshold
+            try:
+                fastcopy.parallel_threshold = 1024
+                fastcopy.copy("src", "dst")
+            finally:
+                fastcopy.parallel_threshold = threshold
+            with open("dst", "rb") as f:
+                self.assertEqual(f.read(), data)
+
+    def test_same_file(self):
+        with execution(None) as ignoreme:
+            with open("src", "wb") as f:
+                f.write("boris")
+            os.link("src", "linked")
+            self.assertRaises(shutil.Error, fastcopy.copyfile, "src", "src")
+            self.assertRaises(shutil.Error, fastcopy.copyfile, "src", "linked")
+            with open("linked", "rb") as f:
+                self.assertEqual(f.read(), "boris")
+
+class TestImportFiles(TestCase):
+    def test_ids_in_order(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("import_files")
+            names = ["f%d" % i for i in range(20)]
+            for n in names:
+                with open(n, "w") as f:
+                    f.write(n)
+            ids = L.import_files(names, descriptions=names,
+                                 aliases=[i % 2 and n or None for (i, n) in enumerate(names)])
+            self.assertEqual(len(set(ids)), 20)
+            for (i, n) in zip(ids, names):
+                self.assertEqual(L.fetch_file(i)['description'], n)
+                with open(L.path_to_file(i)) as f:
+                    self.assertEqual(f.read(), n)
+            self.assertEqual(L.resolve_alias("f3"), ids[3])
+            self.assertRaises(ValueError, L.resolve_alias, "f2")
+
+    def test_nothing_imported_on_failure(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("import_files")
+            touch(ignoreme, "boris")
+            touch(ignoreme, "hilda")
+            self.assertRaises(IOError, L.import_files, ["boris", "nonexistent", "hilda"])
+            self.assertRaises(sqlite3.IntegrityError, L.import_files,
+                              ["boris", "hilda"], aliases=["meep", "meep"])
+            self.assertEqual(L.search_files(), [])
+            self.assertEqual([f for (d, ds, fs) in os.walk(L.file_path) for f in fs], [])
+
+class TestImmutability(TestCase):
+    def test_associations_and_uses(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("immutability")
+            with execution(L) as ex:
+                touch(ex, "boris")
+                touch(ex, "hilda")
+                ex.add("boris")
+                ex.add("hilda", associate_to_filename="boris", template="%s.meep")
+            [boris] = L.search_files(with_text="boris")
+            [hilda] = L.search_files(with_text="hilda")
+            self.assertFalse(L.fetch_execution(ex.id)['immutable'])
+            with execution(L) as ex2:
+                ex2.use(boris)
+            self.assertTrue(L.fetch_file(boris)['immutable'])
+            self.assertTrue(L.fetch_file(hilda)['immutable'])
+            self.assertTrue(L.fetch_execution(ex.id)['immutable'])
+            self.assertRaises(sqlite3.IntegrityError, L.delete_execution, ex.id)
+            L.db.execute("update execution set description='still allowed' where id=?",
+                         (ex.id,))
+            self.assertRaises(sqlite3.IntegrityError, L.db.execute,
+                              "update execution set finished_at=0 where id=?", (ex.id,))
+            L.delete_execution(ex2.id)
+            self.assertFalse(L.fetch_file(boris)['immutable'])
+            self.assertFalse(L.fetch_file(hilda)['immutable'])
+            self.assertFalse(L.fetch_execution(ex.id)['immutable'])
+            L.delete_execution(ex.id)
+            self.assertEqual(L.search_files(), [])
+
+class TestWrite(TestCase):
+    def test_many_programs(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("written")
+            ex = Execution(L, os.getcwd())
+            for i in range(500):
+                ex.report(ProgramOutput(0, i, ['prog%d' % i, 'a', 'b'], ['out\n'], []))
+            for i in range(5):
+                open("f%d" % i, 'w').close()
+                ex.add("f%d" % i, alias="written%d" % i)
+            ex.finished_at = ex.started_at
+            exid = L.write(ex, "many programs")
+            e = L.fetch_execution(exid)
+            self.assertEqual(len(e['programs']), 500)
+            self.assertEqual(e['programs'][499]['arguments'], ['prog499', 'a', 'b'])
+            self.assertEqual(e['programs'][0]['stdout'], 'out\n')
+            self.assertEqual(sorted(e['added_files']),
+                             [L.resolve_alias("written%d" % i) for i in range(5)])
+
+    def test_same_filename_added_twice(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("written")
+            with execution(L) as ex:
+                touch(ex, "boris")
+                ex.add("boris", description="a")
+                ex.add("boris", description="b", alias="second")
+                touch(ex, "hilda")
+                ex.add("hilda", associate_to_filename="boris", template="%s.meep")
+            files = [L.fetch_file(i) for i in L.search_files(source=('execution', ex.id))]
+            self.assertEqual(sorted(f['description'] for f in files), ["", "a", "b"])
+            self.assertEqual(L.fetch_file("second")['description'], "b")
+            [(hilda, template)] = L.associated_files_of("second")
+            self.assertEqual(L.fetch_file(hilda)['repository_name'],
+                             L.fetch_file("second")['repository_name'] + ".meep")
+
+    def test_failed_write_leaves_nothing(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("written")
+            ex = Execution(L, os.getcwd())
+            touch(ex, "boris")
+            touch(ex, "hilda")
+            ex.add("boris")
+            ex.add("hilda", associate_to_filename="boris", template="%s")
+            self.assertRaises(ValueError, L.write, ex)
+            self.assertEqual(L.search_executions(), [])
+            self.assertEqual(L.search_files(), [])
+            self.assertEqual(os.listdir(L.file_path), [])
+
+    def test_bad_associations(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("written")
+            for (f, g) in [("nobody", "hilda"), ("hilda", "boris")]:
+                ex = Execution(L, os.getcwd())
+                touch(ex, "boris")
+                touch(ex, "hilda")
+                ex.add("boris", associate_to_filename=f, template="%s.a")
+                ex.add("hilda", associate_to_filename=g, template="%s.b")
+                self.assertRaises(ValueError, L.write, ex)
+                self.assertEqual(len(ex.files), 2)
+            self.assertEqual(L.search_files(), [])
+            self.assertEqual(os.listdir(L.file_path), [])
+
+class TestFetch(TestCase):
+    def test_fetch_many(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("fetched")
+            fid = L.import_file("../../LICENSE")
+            L.add_alias(fid, "license")
+            exids = []
+            for i in range(3):
+                with execution(L, description="run %d" % i) as ex:
+                    ex.use(fid)
+                    touch(ex, "boris")
+                    touch(ex, "hilda")
+                    ex.add("boris", alias="boris%d" % i)
+                    ex.add("hilda", associate_to_filename="boris", template="%s.idx")
+                exids.append(ex.id)
+            exids.reverse()
+            self.assertEqual(L.fetch_executions(exids),
+                             [L.fetch_execution(i) for i in exids])
+            fids = L.search_files() + ["license", "boris1"]
+            self.assertEqual(L.fetch_files(fids), [L.fetch_file(i) for i in fids])
+            self.assertEqual(L.fetch_file("boris1")['aliases'], ["boris1"])
+            self.assertEqual(len(L.fetch_file("boris1")['associations']), 1)
+            self.assertRaises(ValueError, L.fetch_executions, [exids[0], 10000])
+
+    def test_lazy_output(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("fetched")
+            with execution(L) as ex:
+                echo(ex, "hello")
+            [e] = L.fetch_executions([ex.id], lazy=True)
+            p = e['programs'][0]
+            self.assertFalse('stdout' in p)
+            self.assertEqual(p['stdout'], "hello\n")
+            self.assertEqual(p.get('stderr'), "")
+            self.assertEqual(p['arguments'], ['echo', 'hello'])
+
+@program
+def printf(format):
+    return {'arguments': ['printf', format],
+            'return_value': None}
+
+class TestTextSearch(TestCase):
+    def test_search_files(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("searched")
+            fa = L.import_file("../../LICENSE", description="alignment of sample_1")
+            fb = L.import_file("../../doc/bein.rst", description="sample_2 reads")
+            self.assertEqual(L.search_files(with_text="align*"), [fa])
+            self.assertEqual(L.search_files(with_text='"sample 2"'), [fb])
+            self.assertEqual(L.search_files(with_text="sample_1"), [fa])
+            self.assertEqual(L.search_files(with_text="bein.rst"), [fb])
+            self.assertEqual(sorted(L.search_files(with_text="sample*")), [fa, fb])
+            self.assertEqual(L.search_files(with_text="sample*", source='import',
+                                            with_description="%reads"), [fb])
+            L.db.execute("update file set description='nothing' where id=?", (fb,))
+            L.db.commit()
+            self.assertEqual(L.search_files(with_text="reads"), [])
+            L.delete_file(fa)
+            self.assertEqual(L.search_files(with_text="alignment"), [])
+
+    def test_search_executions(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("searched", index_output=True)
+            with execution(L, description="first run") as ex1:
+                echo(ex1, "bowtie_index")
+            with execution(L, description="second run") as ex2:
+                echo(ex2, "first")
+            self.assertEqual(L.search_executions(with_text="bowtie*"), [ex1.id])
+            self.assertEqual(L.search_executions(with_text="bowtie_index"), [ex1.id])
+            self.assertEqual(sorted(L.search_executions(with_text="first")),
+                             [ex1.id, ex2.id])
+            self.assertEqual(L.search_executions(with_text="first",
+                                                 started_after=time.time() + 1000), [])
+            self.assertEqual(L.search_executions(with_text="second"), [ex2.id])
+            L.delete_execution(ex1.id)
+            self.assertEqual(L.search_executions(with_text="bowtie*"), [])
+
+    def test_search_non_ascii_output(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("searched", index_output=True)
+            with execution(L) as ex:
+                printf(ex, r"caf\303\251\n")
+                printf(ex, r"broken\377\n")
+            self.assertEqual(L.search_executions(with_text=u"caf\xe9"), [ex.id])
+            self.assertEqual(L.search_executions(with_text="broken*"), [ex.id])
+
+    def test_search_unicode_output(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("searched", index_output=True)
+            with execution(L) as ex:
+                ex.programs.append(ProgramOutput(0, 1, ['echo'],
+                                                 [u"na\xefve\n"], u""))
+            self.assertEqual(L.search_executions(with_text=u"na\xefve"), [ex.id])
+
+    def test_query_checked_against_searched_tables(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("searched")
+            with execution(L, description="first run") as ex:
+                echo(ex, "boris")
+            # Only execution_text has a description column.  FTS4
+            # ignores the filter elsewhere, and FTS5 refuses it, so
+            # the query is searched for as a phrase.
+            self.assertTrue(L.search_executions(with_text="description:first")
+                            in ([], [ex.id]))
+
+class TestTextSearchFTS4(TestTextSearch):
+    def setUp(self):
+        self.text_index_modules = MiniLIMS.text_index_modules
+        MiniLIMS.text_index_modules = ['fts4']
+
+    def tearDown(self):
+        MiniLIMS.text_index_modules = self.text_index_modules
+
+    def test_fts4_is_used(self):
+        with execution(None) as ignoreme:
+            self.assertEqual(MiniLIMS("searched").text_index, 'fts4')
+
+class TestTextSearchWithoutIndex(TestCase):
+    def setUp(self):
+        self.text_index_modules = MiniLIMS.text_index_modules
+        MiniLIMS.text_index_modules = []
+
+    def tearDown(self):
+        MiniLIMS.text_index_modules = self.text_index_modules
+
+    def test_search_with_like(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("searched", index_output=True)
+            self.assertEqual(L.text_index, None)
+            fa = L.import_file("../../LICENSE", description="alignment of sample_1")
+            fb = L.import_file("../../doc/bein.rst", description="sample%2 reads")
+            self.assertEqual(L.search_files(with_text="align*"), [fa])
+            self.assertEqual(L.search_files(with_text="sample_1"), [fa])
+            self.assertEqual(L.search_files(with_text="sample%"), [fb])
+            self.assertEqual(L.search_files(with_text="bein.rst"), [fb])
+            with execution(L, description="first run") as ex1:
+                echo(ex1, "bowtie_index")
+            with execution(L, description="second run") as ex2:
+                echo(ex2, "first")
+            self.assertEqual(L.search_executions(with_text="bowtie*"), [ex1.id])
+            self.assertEqual(L.search_executions(with_text="first"), [ex1.id, ex2.id])
+            L.delete_execution(ex1.id)
+            self.assertEqual(L.search_executions(with_text="bowtie*"), [])
+
+class TestIterSearch(TestCase):
+    def test_pages(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("paged")
+            fids = [L.import_file("../../LICENSE") for i in range(7)]
+            self.assertEqual(list(L.iter_files(batch_size=2)), fids)
+            self.assertEqual(list(L.iter_files(order='-id', batch_size=3)),
+                             list(reversed(fids)))
+            self.assertEqual(list(L.iter_files(after_id=fids[2], limit=3, batch_size=2)),
+                             fids[3:6])
+            self.assertEqual(list(L.iter_files(order='-id', after_id=fids[2])), fids[1::-1])
+            self.assertEqual(list(L.iter_files(with_text="LICENSE", order='rank',
+                                               batch_size=2)), fids)
+            self.assertRaises(ValueError, list, L.iter_files(order='rank', after_id=1))
+            for f in L.iter_files(source='import', batch_size=2):
+                L.delete_file(f)
+            self.assertEqual(L.search_files(), [])
+
+    def test_executions(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("paged")
+            exids = []
+            for i in range(5):
+                with execution(L) as ex:
+                    echo(ex, i % 2 and "odd" or "even")
+                exids.append(ex.id)
+            self.assertEqual(list(L.iter_executions(with_text="even", batch_size=1)),
+                             exids[0::2])
+            self.assertEqual(list(L.iter_executions(after_id=exids[1], limit=2)),
+                             exids[2:4])
+
+class TestLayout(TestCase):
+    def test_sharded_files(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("sharded", layout='sharded')
+            fa = L.import_file("../../LICENSE")
+            with execution(L) as ex:
+                touch(ex, "boris")
+                touch(ex, "hilda")
+                ex.add("boris")
+                ex.add("hilda", associate_to_filename="boris", template="%s.assoc")
+            [fb] = L.search_files(with_text="boris")
+            [fh] = L.search_files(with_text="hilda")
+            for f in [fa, fb, fh]:
+                path = L.path_to_file(f)
+                self.assertTrue(os.path.exists(path))
+                self.assertEqual(os.path.dirname(os.path.dirname(os.path.dirname(path))),
+                                 L.file_path)
+            self.assertEqual(os.path.basename(L.path_to_file(fh)),
+                             "%s.assoc" % os.path.basename(L.path_to_file(fb)))
+            self.assertRaises(ValueError, MiniLIMS, "sharded", layout='flat')
+
+    def test_set_layout(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("flat")
+            fa = L.import_file("../../LICENSE")
+            flat_path = L.path_to_file(fa)
+            L.set_layout('sharded')
+            self.assertFalse(os.path.exists(flat_path))
+            self.assertEqual(L.layout, 'sharded')
+            self.assertEqual(MiniLIMS("flat").layout, 'sharded')
+            with open(L.path_to_file(fa)) as f:
+                self.assertTrue(f.read().startswith("                    GNU GENERAL PUBLIC LICENSE"))
+            L.set_layout('flat')
+            self.assertEqual(L.path_to_file(fa), flat_path)
+            self.assertTrue(os.path.exists(flat_path))
+
+    def test_stale_layout(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("flat")
+            fa = L.import_file("../../LICENSE")
+            MiniLIMS("flat").set_layout('sharded')
+            self.assertTrue(os.path.exists(L.path_to_file(fa)))
+            L.delete_file(fa)
+
+def write_executions(path, n):
+    L = MiniLIMS(path)
+    for i in range(n):
+        with execution(L) as ex:
+            touch(ex, "boris")
+            ex.add("boris")
+
+class TestConcurrency(TestCase):
+    def test_connection_per_thread(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("concurrent")
+            fid = background(L.import_file, "../../LICENSE").wait()
+            self.assertEqual(L.search_files(), [fid])
+            self.assertEqual(L.db.execute("pragma journal_mode").fetchone()[0], 'wal')
+
+    def test_failed_write_releases_lock(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("concurrent")
+            L.busy_timeout = 2
+            fid = L.import_file("../../LICENSE")
+            L.add_alias(fid, "boris")
+            with execution(L) as ex:
+                ex.use(fid)
+            self.assertRaises(sqlite3.IntegrityError, L.delete_file, fid)
+            self.assertRaises(sqlite3.IntegrityError, L.add_alias, fid, "boris")
+            imported = []
+            def import_license():
+                try:
+                    imported.append(L.import_file("../../LICENSE"))
+                except Exception, e:
+                    imported.append(e)
+            t = threading.Thread(target=import_license)
+            t.start()
+            t.join()
+            self.assertEqual(L.search_files(), [fid] + imported)
+
+    def test_processes_writing(self):
+        with execution(None) as ignoreme:
+            L = MiniLIMS("concurrent")
+            workers = [multiprocessing.Process(target=write_executions,
+                                               args=("concurrent", 10))
+                       for i in range(4)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            self.assertEqual([w.exitcode for w in workers], [0]*4)
+            self.assertEqual(len(L.search_executions()), 40)
+            self.assertEqual(len(L.search_files()), 40)
+
 
 def test_given(tests):
     module = sys.modules[__name__]